@@ -0,0 +1,15 @@
+#! /usr/bin/env python3
+
+import configparser
+import DBAccess
+import CreateDBTables
+
+# Fills the temperature_rollups table from readings logged before it existed. Safe to stop and rerun
+if __name__ == "__main__":
+    config = configparser.ConfigParser()
+    config.read("Radiator_temp_logger.cnf")
+    databasePath = config["DatabaseSettings"].get("databasePath")
+    
+    connection = DBAccess.create_connection(databasePath)
+    CreateDBTables.upgradeDatabase(connection)
+    DBAccess.backfillRollups(connection)
@@ -0,0 +1,392 @@
+#! /usr/bin/env python3
+
+import sys
+import os
+import getopt
+import json
+import time
+import shutil
+import platform
+import statistics
+import subprocess
+import tempfile
+import contextlib
+import importlib
+import pandas as pd
+import DBAccess
+import CreateDBTables
+import RadiatorSummary
+import GenerateSyntheticDB
+
+# Times the main stages of the pipeline against a database and appends the results to a JSON lines file,
+# one line per benchmark per run, e.g.
+#   {"benchmark": "getAllData_DF", "median_sec": 1.2, "rowsPerSec": 650000, "dataset": {"nRows": 785059, ...}, ...}
+# Each run is compared with the last run of the same benchmark on the same size of dataset so regressions stand out.
+# Uses a synthetic database (see GenerateSyntheticDB.py) unless one is given. Nothing is written to the database
+# being measured, ingest is timed against a copy
+
+def getHelpText():
+    helpText = "\r\n"
+    helpText += "Benchmark.py times the main stages of the pipeline and records the results\r\n"
+    helpText += "\r\n"
+    helpText += "Options:-\r\n"
+    helpText += "\r\n"
+    helpText += "   -d  :   --database <file>       :   Database to measure, by default a synthetic one is generated\r\n"
+    helpText += "   -g  :   --groupings <n>         :   Radiators in the synthetic database (default 10)\r\n"
+    helpText += "   -c  :   --cycles <n>            :   Cycles in the synthetic database (default 10000)\r\n"
+    helpText += "   -b  :   --benchmark <name>      :   Only run this benchmark, can be given more than once\r\n"
+    helpText += "   -r  :   --repeats <n>           :   Times to run each benchmark (default 3)\r\n"
+    helpText += "   -o  :   --output <file>         :   JSON lines file to append results to (default benchmarkResults.jsonl)\r\n"
+    helpText += "       :   --label <text>          :   Label stored with the results, e.g. the change being tested\r\n"
+    helpText += "       :   --ingestCycles <n>      :   Cycles written by the ingest benchmark (default 100)\r\n"
+    helpText += "       :   --fleetDevices <n>      :   Simulated devices polled by the fleet benchmarks (default 100)\r\n"
+    helpText += "       :   --fleetProfile <file>   :   FleetSimulator.py profile for the simulated devices, e.g. to add faults\r\n"
+    helpText += "       :   --list                  :   List the benchmarks\r\n"
+
+    return helpText
+
+renderCycles = 1000
+fleetCycles = 10
+fleetBasePort = 28000
+
+def getGitCommit():
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return result.stdout.strip() if result.returncode == 0 else None
+
+def getDataset(connection, databasePath):
+    nRows, nCycles, firstSyncTimestamp, lastSyncTimestamp = connection.execute("SELECT sum(nReadings), count(*), min(syncTimestamp), max(syncTimestamp) FROM sync_cycles").fetchone()
+    nSensors = connection.execute("SELECT count(*) FROM sensors").fetchone()[0]
+    nGroupings = connection.execute("SELECT count(*) FROM groupings WHERE isGroupingActiveBool != 0").fetchone()[0]
+    return {
+        "databasePath": os.path.abspath(databasePath),
+        "nRows": nRows or 0,
+        "nCycles": nCycles,
+        "nSensors": nSensors,
+        "nGroupings": nGroupings,
+        "firstSyncTimestamp": firstSyncTimestamp,
+        "lastSyncTimestamp": lastSyncTimestamp
+    }
+
+# Some of the scripts read Radiator_temp_logger.cnf as they're imported, so their benchmarks are skipped
+# without one rather than stopping the run
+def importScript(name):
+    try:
+        return importlib.import_module(name)
+    except KeyError as e:
+        raise ImportError(f"{name} needs the {e} section in Radiator_temp_logger.cnf")
+
+# Fresh copy of the database to write to, set up as the logger would
+def getIngestConnection(context):
+    ReadDataIntoDB = importScript("ReadDataIntoDB")
+
+    ingestPath = os.path.join(context["workDirectory"], "ingest.sqlite")
+    for path in [ingestPath, ingestPath + "-wal", ingestPath + "-shm"]:
+        if os.path.exists(path):
+            os.remove(path)
+    shutil.copyfile(context["databasePath"], ingestPath)
+    connection = DBAccess.create_connection(ingestPath)
+    DBAccess.configureConnection(connection, ReadDataIntoDB.journalMode, ReadDataIntoDB.synchronous)
+    return connection
+
+# Started the first time a fleet benchmark needs it and left running for the rest
+def getFleet(context):
+    import FleetSimulator
+
+    if context.get("fleet") is None:
+        settings, deviceSettings = {}, {}
+        if context["fleetProfile"] is not None:
+            settings, deviceSettings = FleetSimulator.readProfile(context["fleetProfile"])
+        context["fleet"] = FleetSimulator.FleetSimulator(context["fleetDevices"], basePort=fleetBasePort, settings=settings, deviceSettings=deviceSettings)
+        context["fleet"].start()
+    return context["fleet"]
+
+# Each benchmark is set up afresh for every repeat. The setup function returns the function to time
+# and the number of rows it handles, or None if the timed function returns it instead
+
+def setupIngest(context):
+    ReadDataIntoDB = importScript("ReadDataIntoDB")
+
+    connection = getIngestConnection(context)
+
+    # One response per device, as the NodeMCUs would send them
+    sensors_DF = pd.read_sql_query("SELECT sensorID, grouping_id FROM sensors", connection)
+    responses = [[{"SensorID": sensorID, "TempDegC": 20.0} for sensorID in device_DF["sensorID"]] for groupingID, device_DF in sensors_DF.groupby("grouping_id")]
+    firstSyncTimestamp = int(DBAccess.getLatestSyncTimestamp(connection) or time.time()) + 60
+
+    def run():
+        with open(os.devnull, "w") as devNull, contextlib.redirect_stdout(devNull):
+            for cycle in range(context["ingestCycles"]):
+                syncTimestamp = firstSyncTimestamp + cycle * 60
+                for response in responses:
+                    ReadDataIntoDB.processResponse(response, connection, syncTimestamp, syncTimestamp + 0.5)
+        connection.close()
+
+    return run, context["ingestCycles"] * len(sensors_DF.index)
+
+def getDevicePoller():
+    ReadDataIntoDB = importScript("ReadDataIntoDB")
+    from DevicePoller import DevicePoller
+
+    return DevicePoller(ReadDataIntoDB.deviceTimeout_sec, ReadDataIntoDB.cycleDeadline_sec, ReadDataIntoDB.maxPollWorkers)
+
+def setupFleetPoll(context):
+    ipAddresses = getFleet(context).getIPAddresses()
+    devicePoller = getDevicePoller()
+
+    def run():
+        for cycle in range(fleetCycles):
+            devicePoller.pollDevices(ipAddresses)
+        devicePoller.close()
+
+    return run, fleetCycles * len(ipAddresses)
+
+# Poll and store, as ReadDataIntoDB.gatherTempsAndUpdate does. Returns the number of readings stored
+def setupFleetIngest(context):
+    ReadDataIntoDB = importScript("ReadDataIntoDB")
+
+    ipAddresses = getFleet(context).getIPAddresses()
+    devicePoller = getDevicePoller()
+    connection = getIngestConnection(context)
+    firstSyncTimestamp = int(DBAccess.getLatestSyncTimestamp(connection) or time.time()) + 60
+
+    def run():
+        nReadings = 0
+        with open(os.devnull, "w") as devNull, contextlib.redirect_stdout(devNull):
+            for cycle in range(fleetCycles):
+                syncTimestamp = firstSyncTimestamp + cycle * 60
+                readings = []
+                for pollResult in devicePoller.pollDevices(ipAddresses):
+                    if pollResult.error is None:
+                        readings += ReadDataIntoDB.getReadingsFromResponse(pollResult.response, syncTimestamp, pollResult.timestamp, pollResult.ipAddress)
+                if len(readings) > 0 and ReadDataIntoDB.storeReadings(connection, readings):
+                    nReadings += len(readings)
+        devicePoller.close()
+        connection.close()
+        return nReadings
+
+    return run, None
+
+def setupGetAllData(context):
+    return lambda: DBAccess.getAllData_DF(context["connection"]), context["dataset"]["nRows"]
+
+def setupTemperaturesForTimestamp(context):
+    connection = context["connection"]
+    latestSyncTimestamp = DBAccess.getLatestSyncTimestamp(connection)
+    return lambda: DBAccess.getTemperatureDataFrameForTimestamp(connection, latestSyncTimestamp), context["dataset"]["nSensors"]
+
+def setupRadiatorSummary(context):
+    connection = context["connection"]
+    temperatures_DF = DBAccess.getTemperatureDataFrameForTimestamp(connection, DBAccess.getLatestSyncTimestamp(connection))
+    return lambda: RadiatorSummary.loadRadiatorSummaries_DF(connection, temperatures_DF), len(temperatures_DF.index)
+
+def getLatestCyclesTemperatures_DF(connection, nCycles):
+    cycles_DF = DBAccess.getCompleteCycles_DF(connection, nLatest=nCycles)
+    return DBAccess.getTemperatureDataForSyncTimestamps_DF(connection, cycles_DF["syncTimestamp"])
+
+def setupRadiatorSummaryMany(context):
+    connection = context["connection"]
+    temperatures_DF = getLatestCyclesTemperatures_DF(connection, renderCycles)
+    return lambda: RadiatorSummary.loadRadiatorSummaries_DF(connection, temperatures_DF), len(temperatures_DF.index)
+
+def setupPrintDatabaseValues(context):
+    PrintDatabaseValues = importScript("PrintDatabaseValues")
+
+    connection = context["connection"]
+    sensors_DF = pd.read_sql_query(PrintDatabaseValues.sensors_data_query, connection)
+    sensors_DF = sensors_DF.loc[sensors_DF["isSensorActiveBool"] == 1].sort_values("sensorShortName")
+    temperatures_DF = getLatestCyclesTemperatures_DF(connection, renderCycles)
+    return lambda: PrintDatabaseValues.getTableLines(temperatures_DF, list(sensors_DF["sensorID"])), len(temperatures_DF.index)
+
+def setupPlotData(context):
+    PlotData = importScript("PlotData")
+
+    connection = context["connection"]
+    groupingIDs = pd.read_sql_query(RadiatorSummary.active_groupings_query, connection)["grouping_id"].tolist()
+
+    return lambda: PlotData.getPlotData_DF(connection, groupingIDs), context["dataset"]["nRows"]
+
+def setupExport(context):
+    import exportCSV
+
+    outputPath = os.path.join(context["workDirectory"], "export.csv")
+    return lambda: exportCSV.exportData(context["connection"], outputPath), context["dataset"]["nRows"]
+
+benchmarks = {
+    "ingest_processResponse": setupIngest,
+    "getAllData_DF": setupGetAllData,
+    "getTemperatureDataFrameForTimestamp": setupTemperaturesForTimestamp,
+    "radiatorSummary_latest": setupRadiatorSummary,
+    "radiatorSummary_1000cycles": setupRadiatorSummaryMany,
+    "printDatabaseValues_render_1000cycles": setupPrintDatabaseValues,
+    "plotData_prepare": setupPlotData,
+    "exportCSV": setupExport,
+    "fleet_pollCycle": setupFleetPoll,
+    "fleet_pollAndStore": setupFleetIngest
+}
+
+def runBenchmark(name, context, repeats):
+    times_sec = []
+    for repeat in range(repeats):
+        run, nRows = benchmarks[name](context)
+        startTime = time.perf_counter()
+        nRowsRun = run()
+        times_sec.append(time.perf_counter() - startTime)
+        # Only when the setup couldn't say, otherwise run() may return whatever it measured
+        if nRows is None:
+            nRows = nRowsRun
+
+    median_sec = statistics.median(times_sec)
+    return {
+        "benchmark": name,
+        "nRows": nRows,
+        "repeats": repeats,
+        "min_sec": min(times_sec),
+        "median_sec": median_sec,
+        "max_sec": max(times_sec),
+        "rowsPerSec": nRows / median_sec if median_sec > 0 else None
+    }
+
+def readPreviousResults(resultsPath):
+    results = []
+    if not os.path.exists(resultsPath):
+        return results
+    with open(resultsPath) as resultsFile:
+        for line in resultsFile:
+            try:
+                results.append(json.loads(line))
+            except ValueError:
+                continue
+    return results
+
+def getDatasetKey(dataset):
+    return (dataset["nRows"], dataset["nCycles"], dataset["nSensors"])
+
+# The most recent earlier result for the same benchmark on the same size of dataset
+def findPreviousResult(previousResults, result):
+    for previousResult in reversed(previousResults):
+        if previousResult["benchmark"] == result["benchmark"] and getDatasetKey(previousResult["dataset"]) == getDatasetKey(result["dataset"]):
+            return previousResult
+    return None
+
+def printResult(result, previousResult):
+    change = ""
+    if previousResult is not None and previousResult["median_sec"] > 0:
+        change = f"{(result['median_sec'] / previousResult['median_sec'] - 1) * 100:+.1f}% vs {previousResult.get('gitCommit') or previousResult['runTimestamp']}"
+    rowsPerSec = "" if result["rowsPerSec"] is None else f"{result['rowsPerSec']:.0f}"
+    print(f"{result['benchmark']:40.40}  {result['median_sec'] * 1000:10.1f} ms  {rowsPerSec:>12} rows/s  {change}")
+
+def runBenchmarks(databasePath, names, repeats, resultsPath, label=None, ingestCycles=100, fleetDevices=100, fleetProfile=None):
+    connection = DBAccess.create_connection(databasePath)
+    CreateDBTables.upgradeDatabase(connection)
+    previousResults = readPreviousResults(resultsPath)
+
+    with tempfile.TemporaryDirectory() as workDirectory:
+        context = {
+            "connection": connection,
+            "databasePath": databasePath,
+            "workDirectory": workDirectory,
+            "ingestCycles": ingestCycles,
+            "fleetDevices": fleetDevices,
+            "fleetProfile": fleetProfile,
+            "dataset": getDataset(connection, databasePath)
+        }
+        runInfo = {
+            "runTimestamp": time.time(),
+            "label": label,
+            "gitCommit": getGitCommit(),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "dataset": context["dataset"],
+            "fleetDevices": fleetDevices,
+            "fleetProfile": fleetProfile
+        }
+        print(f"Dataset: {context['dataset']['nRows']} rows, {context['dataset']['nCycles']} cycles, {context['dataset']['nSensors']} sensors")
+
+        results = []
+        for name in names:
+            try:
+                result = {**runBenchmark(name, context, repeats), **runInfo}
+            except ImportError as e:
+                print(f"{name:40.40}  skipped, {e}")
+                continue
+            printResult(result, findPreviousResult(previousResults, result))
+            results.append(result)
+
+        if context.get("fleet") is not None:
+            context["fleet"].stop()
+
+    connection.close()
+
+    with open(resultsPath, "a") as resultsFile:
+        for result in results:
+            resultsFile.write(json.dumps(result) + "\n")
+    return results
+
+if __name__ == "__main__":
+    databasePath = None
+    nGroupings = 10
+    nCycles = 10000
+    names = []
+    repeats = 3
+    resultsPath = "benchmarkResults.jsonl"
+    label = None
+    ingestCycles = 100
+    fleetDevices = 100
+    fleetProfile = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hd:g:c:b:r:o:", ["database=", "groupings=", "cycles=", "benchmark=", "repeats=", "output=", "label=", "ingestCycles=", "fleetDevices=", "fleetProfile=", "list"])
+    except getopt.GetoptError:
+        print("Benchmark.py options error occured")
+        sys.exit(2)
+    try:
+        for opt, arg in opts:
+            if opt == "-h":
+                print(getHelpText())
+                sys.exit()
+            elif opt == "--list":
+                print("\n".join(benchmarks))
+                sys.exit()
+            elif opt in ("-d", "--database"):
+                databasePath = arg
+            elif opt in ("-g", "--groupings"):
+                nGroupings = int(arg)
+            elif opt in ("-c", "--cycles"):
+                nCycles = int(arg)
+            elif opt in ("-b", "--benchmark"):
+                if arg not in benchmarks:
+                    print(f"Unknown benchmark {arg}, use --list to see them")
+                    sys.exit(2)
+                names.append(arg)
+            elif opt in ("-r", "--repeats"):
+                repeats = int(arg)
+            elif opt in ("-o", "--output"):
+                resultsPath = arg
+            elif opt == "--label":
+                label = arg
+            elif opt == "--ingestCycles":
+                ingestCycles = int(arg)
+            elif opt == "--fleetDevices":
+                fleetDevices = int(arg)
+            elif opt == "--fleetProfile":
+                fleetProfile = arg
+    except ValueError as e:
+        print(e)
+        print("Please supply whole numbers for counts and repeats")
+        sys.exit(2)
+
+    if len(names) == 0:
+        names = list(benchmarks)
+
+    if databasePath is not None:
+        runBenchmarks(databasePath, names, repeats, resultsPath, label, ingestCycles, fleetDevices, fleetProfile)
+        sys.exit()
+
+    # Same seed and start every time, so results from different runs are comparable
+    with tempfile.TemporaryDirectory() as dataDirectory:
+        databasePath = os.path.join(dataDirectory, "synthetic.sqlite")
+        GenerateSyntheticDB.generateDatabase(databasePath, nGroupings=nGroupings, nCycles=nCycles, startTimestamp=1600000000)
+        runBenchmarks(databasePath, names, repeats, resultsPath, label, ingestCycles, fleetDevices, fleetProfile)
@@ -0,0 +1,188 @@
+#! /usr/bin/env python3
+
+import sys
+import time
+import getopt
+import configparser
+import numpy as np
+import pandas as pd
+import DBAccess
+import CreateDBTables
+
+# Load settings
+config = configparser.ConfigParser()
+config.read("Radiator_temp_logger.cnf")
+
+# Fewer cycles than this with every sensor read isn't enough to fit anything
+minFitCycles = 10
+
+def getHelpText():
+    helpText = "\r\n"
+    helpText += "Calibrate.py manages the sensor calibrations. Each reading is corrected by its sensor's calibration at the time,\r\n"
+    helpText += "as tempDegC * gain + offset, and the corrected readings are kept in the calibrated_readings table\r\n"
+    helpText += "\r\n"
+    helpText += "Options:-\r\n"
+    helpText += "\r\n"
+    helpText += "   -l  :   --list                  :   List the calibrations\r\n"
+    helpText += "   -s  :   --sensor <sensorID>     :   Sensor to calibrate, can be given more than once\r\n"
+    helpText += "   -g  :   --grouping <id>         :   Calibrate the sensors in this grouping_id, can be given more than once\r\n"
+    helpText += "   -o  :   --offset <degC>         :   Add a calibration with this offset to the sensors\r\n"
+    helpText += "       :   --gain <gain>           :   ... and this gain (default 1)\r\n"
+    helpText += "       :   --from <timestamp>      :   The calibration applies to readings from this syncTimestamp on (default all of them)\r\n"
+    helpText += "       :   --delete <id>           :   Remove the calibration with this calibration_id\r\n"
+    helpText += "   -f  :   --fit                   :   Work out calibrations for sensors that have been reading the same temperature\r\n"
+    helpText += "       :   --start <timestamp>     :   ... from this syncTimestamp\r\n"
+    helpText += "       :   --end <timestamp>       :   ... up to this syncTimestamp\r\n"
+    helpText += "   -d  :   --days <n>              :   ... over the last n days\r\n"
+    helpText += "   -r  :   --reference <sensorID>  :   ... to match this sensor (default the median of all of them)\r\n"
+    helpText += "       :   --linear                :   ... fitting a gain as well as an offset\r\n"
+    helpText += "       :   --save                  :   ... and add them as calibrations\r\n"
+    helpText += "       :   --backfill              :   Calibrate the readings logged before the calibrated_readings table existed\r\n"
+
+    return helpText
+
+# One row per sensor with the offsetDegC and gain that best match it to the reference over the cycles where every
+# sensor was read, the residualDegC (standard deviation) left after correcting and how many cycles were used
+def fitCalibrations_DF(readings_DF, referenceSensorID=None, isLinear=False):
+    temperatures_DF = readings_DF.pivot_table(index="syncTimestamp", columns="sensorID", values="tempDegC", aggfunc="mean").dropna()
+    if referenceSensorID is None:
+        reference = temperatures_DF.median(axis=1).to_numpy()
+    else:
+        reference = temperatures_DF[referenceSensorID].to_numpy()
+    temperatures = temperatures_DF.to_numpy()
+
+    # Least squares for every sensor at once, one column each
+    if isLinear:
+        meanTemperatures = temperatures.mean(axis=0)
+        meanReference = reference.mean()
+        variances = ((temperatures - meanTemperatures) ** 2).sum(axis=0)
+        covariances = ((temperatures - meanTemperatures) * (reference - meanReference)[:, None]).sum(axis=0)
+        # A sensor that never changed can only be given an offset
+        gains = np.where(variances > 0, covariances / np.where(variances > 0, variances, 1), 1.0)
+        offsets = meanReference - gains * meanTemperatures
+    else:
+        gains = np.ones(temperatures.shape[1])
+        offsets = (reference[:, None] - temperatures).mean(axis=0)
+    residuals = (reference[:, None] - (temperatures * gains + offsets)).std(axis=0)
+
+    fits_DF = pd.DataFrame({
+        "sensorID": temperatures_DF.columns,
+        "offsetDegC": offsets,
+        "gain": gains,
+        "residualDegC": residuals,
+        "nCycles": len(temperatures_DF.index)
+    })
+    return fits_DF.loc[fits_DF["sensorID"] != referenceSensorID].reset_index(drop=True)
+
+if __name__ == "__main__":
+    isListing = False
+    sensorIDs = None
+    groupingIDs = None
+    offsetDegC = None
+    gain = 1.0
+    validFromTimestamp = 0
+    deleteCalibrationID = None
+    isFitting = False
+    startTimestamp = None
+    endTimestamp = None
+    referenceSensorID = None
+    isLinear = False
+    isSaving = False
+    isBackfilling = False
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hls:g:o:fd:r:", ["list", "sensor=", "grouping=", "offset=", "gain=", "from=", "delete=", "fit",
+                                                                  "start=", "end=", "days=", "reference=", "linear", "save", "backfill"])
+    except getopt.GetoptError:
+        print("Calibrate.py options error occured")
+        sys.exit(2)
+    try:
+        for opt, arg in opts:
+            if opt == "-h":
+                print(getHelpText())
+                sys.exit()
+            elif opt in ("-l", "--list"):
+                isListing = True
+            elif opt in ("-s", "--sensor"):
+                sensorIDs = (sensorIDs or []) + [arg]
+            elif opt in ("-g", "--grouping"):
+                groupingIDs = (groupingIDs or []) + [int(arg)]
+            elif opt in ("-o", "--offset"):
+                offsetDegC = float(arg)
+            elif opt == "--gain":
+                gain = float(arg)
+            elif opt == "--from":
+                validFromTimestamp = int(arg)
+            elif opt == "--delete":
+                deleteCalibrationID = int(arg)
+            elif opt in ("-f", "--fit"):
+                isFitting = True
+            elif opt == "--start":
+                startTimestamp = int(arg)
+            elif opt == "--end":
+                endTimestamp = int(arg)
+            elif opt in ("-d", "--days"):
+                startTimestamp = int(time.time() - float(arg) * 86400)
+            elif opt in ("-r", "--reference"):
+                referenceSensorID = arg
+            elif opt == "--linear":
+                isLinear = True
+            elif opt == "--save":
+                isSaving = True
+            elif opt == "--backfill":
+                isBackfilling = True
+    except ValueError as e:
+        print(e)
+        print("Please supply numbers for offsets and gains, and whole numbers for timestamps, groupings and calibration_ids")
+        sys.exit(2)
+
+    databasePath = config["DatabaseSettings"].get("databasePath")
+    connection = DBAccess.create_connection(databasePath)
+    CreateDBTables.upgradeDatabase(connection)
+
+    if groupingIDs is not None:
+        params = []
+        groupingSensors_query = "SELECT sensorID FROM sensors WHERE " + DBAccess.getInCondition("grouping_id", groupingIDs, params)
+        sensorIDs = (sensorIDs or []) + [row[0] for row in connection.execute(groupingSensors_query, params)]
+
+    if isBackfilling:
+        DBAccess.backfillCalibratedReadings(connection)
+
+    if deleteCalibrationID is not None:
+        if DBAccess.deleteCalibration(connection, deleteCalibrationID):
+            print(f"Removed calibration {deleteCalibrationID}")
+        else:
+            print(f"There is no calibration {deleteCalibrationID}")
+
+    if offsetDegC is not None:
+        if sensorIDs is None:
+            print("Please give the sensors to calibrate with -s or -g")
+            sys.exit(2)
+        DBAccess.addCalibrations(connection, [{"sensorID": sensorID, "validFromTimestamp": validFromTimestamp, "offsetDegC": offsetDegC, "gain": gain} for sensorID in sensorIDs])
+        print(f"Calibrated {len(sensorIDs)} sensors from syncTimestamp {validFromTimestamp}")
+
+    if isFitting:
+        if sensorIDs is None or len(sensorIDs) < 2:
+            print("Please give at least two sensors that were reading the same temperature, with -s or -g")
+            sys.exit(2)
+        if referenceSensorID is not None and referenceSensorID not in sensorIDs:
+            sensorIDs.append(referenceSensorID)
+        readings_DF = DBAccess.getJoinedData_DF(connection, sensorIDs=sensorIDs, startTimestamp=startTimestamp, endTimestamp=endTimestamp)
+        fits_DF = fitCalibrations_DF(readings_DF, referenceSensorID, isLinear)
+        if len(fits_DF.index) == 0 or fits_DF["nCycles"].iloc[0] < minFitCycles:
+            print(f"Need at least {minFitCycles} cycles where all of the sensors were read to fit calibrations")
+            sys.exit(1)
+        print(fits_DF.to_string(index=False))
+
+        if isSaving:
+            method = "linearFit" if isLinear else "offsetFit"
+            DBAccess.addCalibrations(connection, [{**fit, "validFromTimestamp": validFromTimestamp, "method": method, "referenceSensorID": referenceSensorID}
+                                                  for fit in fits_DF.drop(columns="nCycles").to_dict("records")])
+            print(f"Saved {len(fits_DF.index)} calibrations, applying from syncTimestamp {validFromTimestamp}")
+
+    if isListing:
+        calibrations_DF = DBAccess.getCalibrations_DF(connection, sensorIDs)
+        if len(calibrations_DF.index) == 0:
+            print("There are no calibrations")
+        else:
+            print(calibrations_DF.to_string(index=False))
@@ -0,0 +1,296 @@
+#! /usr/bin/env python3
+
+import sys
+import getopt
+import configparser
+import json
+import os
+import shutil
+import time
+from datetime import datetime, timezone
+from sqlite3 import Error
+import numpy as np
+import pandas as pd
+import CompactStorage
+
+# Moves old temperature_data rows out of SQLite into one directory per month of compact numpy arrays:
+#   data_id.npy              int64   original data_id
+#   syncTimestampOffset.npy  uint32  syncTimestamp minus the start of the month
+#   readOffset_ms.npy        int32   timestamp minus syncTimestamp in milliseconds
+#   sensorIndex.npy          uint16  index into sensorIDs.json
+#   temperature.npy          int16   tempDegC times temperatureScale (DS18B20s read in 1/16 degree steps)
+# Rows are sorted by syncTimestamp so a time range is found with a binary search on the memory-mapped offsets,
+# and only the rows in range are ever decoded. The archive_partitions table records where each month lives
+
+missingTemperature = np.iinfo(np.int16).min
+
+def getMonthStart(aTimestamp):
+    aDate = datetime.fromtimestamp(aTimestamp, timezone.utc)
+    return int(datetime(aDate.year, aDate.month, 1, tzinfo=timezone.utc).timestamp())
+
+def getNextMonthStart(monthStart):
+    aDate = datetime.fromtimestamp(monthStart, timezone.utc)
+    if aDate.month == 12:
+        return int(datetime(aDate.year + 1, 1, 1, tzinfo=timezone.utc).timestamp())
+    return int(datetime(aDate.year, aDate.month + 1, 1, tzinfo=timezone.utc).timestamp())
+
+def getPartitionName(monthStart):
+    return datetime.fromtimestamp(monthStart, timezone.utc).strftime("%Y-%m")
+
+def saveArray(directory, name, array):
+    with open(os.path.join(directory, name + ".npy"), "wb") as arrayFile:
+        np.save(arrayFile, array)
+        arrayFile.flush()
+        os.fsync(arrayFile.fileno())
+
+def loadArray(directory, name):
+    return np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+
+# Databases made before the archive existed don't have the table until they're upgraded
+def hasArchive(connection):
+    return connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'archive_partitions'").fetchone() is not None
+
+def getPartitions(connection, startTimestamp=None, endTimestamp=None, afterDataID=None):
+    partitions_query = "SELECT * FROM archive_partitions WHERE lastSyncTimestamp >= ? AND firstSyncTimestamp <= ? AND lastDataID > ? ORDER BY firstDataID"
+    params = (
+        startTimestamp if startTimestamp is not None else -2**62,
+        endTimestamp if endTimestamp is not None else 2**62,
+        afterDataID if afterDataID is not None else -1
+    )
+    return pd.read_sql_query(partitions_query, connection, params=params)
+
+# Rows are in syncTimestamp order, which is also data_id order unless readings were stored late (e.g. from
+# the spool). Checked once per partition, as archived, so afterDataID can be found with a binary search too
+dataIDOrderedPartitions = {} # (directory, archivedTimestamp) -> whether data_id.npy is sorted
+
+def isDataIDOrdered(partition):
+    key = (partition["directory"], partition["archivedTimestamp"])
+    if key not in dataIDOrderedPartitions:
+        dataIDs = loadArray(partition["directory"], "data_id")
+        dataIDOrderedPartitions[key] = bool(np.all(dataIDs[1:] > dataIDs[:-1]))
+    return dataIDOrderedPartitions[key]
+
+# With limit, only the first limit matching rows by data_id are decoded
+def readPartition_DF(partition, startTimestamp=None, endTimestamp=None, sensorIDs=None, afterDataID=None, limit=None):
+    directory = partition["directory"]
+    baseSyncTimestamp = int(partition["baseSyncTimestamp"])
+    syncTimestampOffsets = loadArray(directory, "syncTimestampOffset")
+
+    # Binary search for the time range, everything below is a view on the memory map until it's decoded
+    firstIndex = 0
+    lastIndex = len(syncTimestampOffsets)
+    if startTimestamp is not None:
+        firstIndex = np.searchsorted(syncTimestampOffsets, max(startTimestamp - baseSyncTimestamp, 0), side="left")
+    if endTimestamp is not None:
+        lastIndex = np.searchsorted(syncTimestampOffsets, max(endTimestamp - baseSyncTimestamp + 1, 0), side="left")
+
+    dataIDs = loadArray(directory, "data_id")
+    isOrdered = (afterDataID is not None or limit is not None) and isDataIDOrdered(partition)
+    if isOrdered and afterDataID is not None:
+        firstIndex += np.searchsorted(dataIDs[firstIndex:lastIndex], afterDataID, side="right")
+    if isOrdered and limit is not None and sensorIDs is None:
+        lastIndex = min(lastIndex, firstIndex + limit)
+
+    dataIDs = dataIDs[firstIndex:lastIndex]
+    sensorIndexes = loadArray(directory, "sensorIndex")[firstIndex:lastIndex]
+    with open(os.path.join(directory, "sensorIDs.json")) as sensorIDsFile:
+        partitionSensorIDs = np.array(json.load(sensorIDsFile), dtype=object)
+
+    rowMask = np.ones(len(dataIDs), dtype=bool)
+    if afterDataID is not None and not isOrdered:
+        rowMask &= dataIDs > afterDataID
+    if sensorIDs is not None:
+        rowMask &= np.isin(sensorIndexes, np.flatnonzero(np.isin(partitionSensorIDs, list(sensorIDs))))
+    rows = np.flatnonzero(rowMask)
+    if limit is not None:
+        if isOrdered:
+            rows = rows[:limit]
+        else:
+            rows = rows[np.argsort(dataIDs[rows], kind="stable")[:limit]]
+
+    syncTimestamps = loadArray(directory, "syncTimestampOffset")[firstIndex:lastIndex][rows].astype(np.int64) + baseSyncTimestamp
+    temperatures = loadArray(directory, "temperature")[firstIndex:lastIndex][rows]
+    tempDegC = temperatures / float(partition["temperatureScale"])
+    tempDegC[temperatures == missingTemperature] = np.nan
+
+    return pd.DataFrame({
+        "syncTimestamp": syncTimestamps,
+        "timestamp": syncTimestamps + loadArray(directory, "readOffset_ms")[firstIndex:lastIndex][rows] / 1000.0,
+        "sensorID": partitionSensorIDs[sensorIndexes[rows]],
+        "tempDegC": tempDegC
+    }, index=pd.Index(np.asarray(dataIDs[rows]), name="data_id"))
+
+# Archived rows in the same shape as "SELECT * FROM temperature_data", or None if nothing archived matches.
+# With limit, only the first limit rows by data_id, reading the partitions in data_id order until no later
+# one can have any of them
+def readArchive_DF(connection, startTimestamp=None, endTimestamp=None, sensorIDs=None, afterDataID=None, limit=None):
+    if not hasArchive(connection):
+        return None
+    partitions_DF = getPartitions(connection, startTimestamp, endTimestamp, afterDataID)
+
+    partitionData = []
+    nRows = 0
+    for index, partition in partitions_DF.iterrows():
+        if limit is not None and nRows >= limit and partition["firstDataID"] > partitionData[-1].index[-1]:
+            break
+        partition_DF = readPartition_DF(partition, startTimestamp, endTimestamp, sensorIDs, afterDataID, limit)
+        if len(partition_DF.index) == 0:
+            continue
+        partitionData.append(partition_DF)
+        if limit is not None:
+            partitionData = [pd.concat(partitionData).sort_index().head(limit)]
+            nRows = len(partitionData[0].index)
+
+    if len(partitionData) == 0:
+        return None
+    return pd.concat(partitionData).sort_index()
+
+def writePartition(directory, archive_DF, baseSyncTimestamp, temperatureScale):
+    archive_DF = archive_DF.sort_values(["syncTimestamp", "data_id"])
+    sensorIDs, sensorIndexes = np.unique(archive_DF["sensorID"].to_numpy(dtype=str), return_inverse=True)
+    temperatures = np.round(archive_DF["tempDegC"].to_numpy(dtype=float) * temperatureScale)
+    temperatures[np.isnan(temperatures)] = missingTemperature
+
+    os.makedirs(directory)
+    saveArray(directory, "data_id", archive_DF["data_id"].to_numpy(dtype=np.int64))
+    saveArray(directory, "syncTimestampOffset", (archive_DF["syncTimestamp"].to_numpy(dtype=np.int64) - baseSyncTimestamp).astype(np.uint32))
+    saveArray(directory, "readOffset_ms", np.round((archive_DF["timestamp"].to_numpy(dtype=float) - archive_DF["syncTimestamp"].to_numpy(dtype=float)) * 1000).astype(np.int32))
+    saveArray(directory, "sensorIndex", sensorIndexes.astype(np.uint16))
+    saveArray(directory, "temperature", np.clip(temperatures, missingTemperature, np.iinfo(np.int16).max).astype(np.int16))
+    with open(os.path.join(directory, "sensorIDs.json"), "w") as sensorIDsFile:
+        json.dump(sensorIDs.tolist(), sensorIDsFile)
+
+upsert_partition_query = """
+INSERT INTO archive_partitions (partitionName, directory, baseSyncTimestamp, firstSyncTimestamp, lastSyncTimestamp, firstDataID, lastDataID, nRows, temperatureScale, archivedTimestamp)
+  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+  ON CONFLICT(partitionName) DO UPDATE SET
+    directory = excluded.directory,
+    firstSyncTimestamp = excluded.firstSyncTimestamp,
+    lastSyncTimestamp = excluded.lastSyncTimestamp,
+    firstDataID = excluded.firstDataID,
+    lastDataID = excluded.lastDataID,
+    nRows = excluded.nRows,
+    archivedTimestamp = excluded.archivedTimestamp
+"""
+
+# Removes a month's directories that archive_partitions doesn't point at, left by a run that stopped part way
+def removeUnusedVersions(archiveDirectory, partitionName, directoryInUse):
+    if not os.path.isdir(archiveDirectory):
+        return
+    for name in os.listdir(archiveDirectory):
+        path = os.path.abspath(os.path.join(archiveDirectory, name))
+        if (name == partitionName or name.startswith(partitionName + ".")) and path != directoryInUse:
+            shutil.rmtree(path)
+
+# Moves the readings for one month that are older than cutoffTimestamp into its partition
+def archiveMonth(connection, archiveDirectory, monthStart, cutoffTimestamp, temperatureScale):
+    partitionName = getPartitionName(monthStart)
+    endTimestamp = min(getNextMonthStart(monthStart), cutoffTimestamp)
+
+    month_query = "SELECT data_id, syncTimestamp, timestamp, sensorID, tempDegC FROM temperature_data WHERE syncTimestamp >= ? AND syncTimestamp < ?"
+    month_DF = pd.read_sql_query(month_query, connection, params=(monthStart, endTimestamp))
+    if len(month_DF.index) == 0:
+        return 0
+    maxArchivedDataID = int(month_DF["data_id"].max())
+
+    # Merge with anything archived for this month by an earlier run. The files are only recorded in the same
+    # transaction that deletes the rows, so nothing is in both, but drop duplicates in case
+    existingPartitions_DF = pd.read_sql_query("SELECT * FROM archive_partitions WHERE partitionName = ?", connection, params=(partitionName,))
+    oldDirectory = None
+    if len(existingPartitions_DF.index) > 0:
+        existingPartition = existingPartitions_DF.iloc[0]
+        oldDirectory = existingPartition["directory"]
+        temperatureScale = int(existingPartition["temperatureScale"])
+        month_DF = pd.concat([readPartition_DF(existingPartition).reset_index(), month_DF])
+        month_DF = month_DF.drop_duplicates("data_id")
+    removeUnusedVersions(archiveDirectory, partitionName, oldDirectory)
+
+    # Each merge goes in a new directory, readers keep using the old one until archive_partitions points at this
+    directory = os.path.abspath(os.path.join(archiveDirectory, f"{partitionName}.{int(time.time() * 1000)}"))
+    writePartition(directory, month_DF, monthStart, temperatureScale)
+
+    cursor = connection.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute(upsert_partition_query, (partitionName, directory, monthStart,
+                       int(month_DF["syncTimestamp"].min()), int(month_DF["syncTimestamp"].max()),
+                       int(month_DF["data_id"].min()), int(month_DF["data_id"].max()),
+                       len(month_DF.index), temperatureScale, time.time()))
+        # Only rows that were read above, anything added to this range since has a higher data_id
+        cursor.execute(f"DELETE FROM {CompactStorage.getReadingsTableName(connection)} WHERE syncTimestamp >= ? AND syncTimestamp < ? AND data_id <= ?", (monthStart, endTimestamp, maxArchivedDataID))
+        nDeleted = cursor.rowcount
+        cursor.execute("DELETE FROM calibrated_readings WHERE data_id <= ? AND syncTimestamp >= ? AND syncTimestamp < ?", (maxArchivedDataID, monthStart, endTimestamp))
+        connection.commit()
+    except Error:
+        connection.rollback()
+        shutil.rmtree(directory)
+        raise
+
+    if oldDirectory is not None and os.path.exists(oldDirectory):
+        shutil.rmtree(oldDirectory)
+
+    print(f"Archived {nDeleted} readings to {directory}")
+    return nDeleted
+
+# Archives every reading older than archiveAfter_days, a month at a time
+def archiveOldReadings(connection, archiveDirectory, archiveAfter_days, temperatureScale=16):
+    cutoffTimestamp = int(time.time() - archiveAfter_days * 86400)
+    firstTimestamp = connection.execute(f"SELECT min(syncTimestamp) FROM {CompactStorage.getReadingsTableName(connection)}").fetchone()[0]
+    if firstTimestamp is None or firstTimestamp >= cutoffTimestamp:
+        print("Nothing old enough to archive")
+        return 0
+
+    nArchived = 0
+    monthStart = getMonthStart(firstTimestamp)
+    while monthStart < cutoffTimestamp:
+        nArchived += archiveMonth(connection, archiveDirectory, monthStart, cutoffTimestamp, temperatureScale)
+        monthStart = getNextMonthStart(monthStart)
+    return nArchived
+
+def getHelpText():
+    helpText = "\r\n"
+    helpText += "ColdArchive.py moves readings older than archiveAfter_days out of the database pointed to in Radiator_temp_logger.cnf\r\n"
+    helpText += "into the compact archive in archiveDirectory, and deletes them from the database. The other scripts read archived\r\n"
+    helpText += "readings as if they were still in the database\r\n"
+    helpText += "\r\n"
+    helpText += "Options:-\r\n"
+    helpText += "\r\n"
+    helpText += "   -d  :   --days <n>              :   Archive readings older than n days (default archiveAfter_days)\r\n"
+
+    return helpText
+
+if __name__ == "__main__":
+    import DBAccess
+    import CreateDBTables
+
+    archiveAfter_days = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hd:", ["days="])
+    except getopt.GetoptError:
+        print("ColdArchive.py options error occured")
+        sys.exit(2)
+    try:
+        for opt, arg in opts:
+            if opt == "-h":
+                print(getHelpText())
+                sys.exit()
+            elif opt in ("-d", "--days"):
+                archiveAfter_days = float(arg)
+    except ValueError as e:
+        print(e)
+        print("Please supply a number of days")
+        sys.exit(2)
+
+    config = configparser.ConfigParser()
+    config.read("Radiator_temp_logger.cnf")
+    databasePath = config["DatabaseSettings"].get("databasePath")
+    archiveDirectory = config["ArchiveSettings"].get("archiveDirectory")
+    if archiveAfter_days is None:
+        archiveAfter_days = config["ArchiveSettings"].getfloat("archiveAfter_days", 365)
+    temperatureScale = config["ArchiveSettings"].getint("temperatureScale", 16)
+
+    connection = DBAccess.create_connection(databasePath)
+    CreateDBTables.upgradeDatabase(connection)
+    nArchived = archiveOldReadings(connection, archiveDirectory, archiveAfter_days, temperatureScale)
+    print(f"Archived {nArchived} readings in total")
@@ -0,0 +1,266 @@
+#! /usr/bin/env python3
+
+import sys
+import os
+import getopt
+import time
+import configparser
+from sqlite3 import Error
+
+# Optional compact storage for the readings. Instead of repeating each sensor's 16 character ID and storing
+# two REALs for every reading, temperature_data_compact holds
+#   sensor_key      small integer standing for the sensorID, see the sensor_keys table
+#   syncTimestamp   as before
+#   data_id         as before, so everything that reads "the rows after data_id X" works unchanged
+#   readOffset_ms   timestamp minus syncTimestamp in milliseconds
+#   temperature     tempDegC times temperatureScale (DS18B20s read in 1/16 degree steps)
+# It's a WITHOUT ROWID table whose primary key is (sensor_key, syncTimestamp, data_id), so one sensor's readings over
+# a time range sit next to each other on disk. temperature_data becomes a view with the old columns, and triggers
+# on it mean rows can still be inserted and deleted through it, so every script reads it just as before.
+# The conversion is done by running this script, a chunk at a time while the logger keeps running
+
+compact_storage_queries = [
+    """
+    CREATE TABLE IF NOT EXISTS compact_storage (
+      id INTEGER PRIMARY KEY CHECK (id = 1),
+      temperatureScale INTEGER NOT NULL,
+      lastCopiedDataID INTEGER NOT NULL,
+      lastDataID INTEGER NOT NULL,
+      startedTimestamp REAL,
+      completedTimestamp REAL
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sensor_keys (
+      sensor_key INTEGER PRIMARY KEY,
+      sensorID TEXT NOT NULL UNIQUE
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS temperature_data_compact (
+      sensor_key INTEGER NOT NULL REFERENCES sensor_keys(sensor_key),
+      syncTimestamp INTEGER NOT NULL,
+      data_id INTEGER NOT NULL,
+      readOffset_ms INTEGER,
+      temperature INTEGER,
+      PRIMARY KEY (sensor_key, syncTimestamp, data_id)
+    ) WITHOUT ROWID;
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_temperature_data_compact_data_id ON temperature_data_compact (data_id)",
+    "CREATE INDEX IF NOT EXISTS idx_temperature_data_compact_syncTimestamp ON temperature_data_compact (syncTimestamp)"
+]
+
+def getViewQueries(temperatureScale):
+    return [
+        f"""
+        CREATE VIEW temperature_data AS
+          SELECT d.data_id AS data_id, d.syncTimestamp AS syncTimestamp, d.syncTimestamp + d.readOffset_ms / 1000.0 AS timestamp,
+                 k.sensorID AS sensorID, d.temperature / {float(temperatureScale)} AS tempDegC
+          FROM temperature_data_compact d JOIN sensor_keys k ON k.sensor_key = d.sensor_key
+        """,
+        f"""
+        CREATE TRIGGER trg_temperature_data_insert INSTEAD OF INSERT ON temperature_data
+        BEGIN
+          INSERT OR IGNORE INTO sensor_keys (sensorID) VALUES (NEW.sensorID);
+          UPDATE compact_storage SET lastDataID = max(lastDataID + 1, ifnull(NEW.data_id, 0)) WHERE id = 1;
+          INSERT INTO temperature_data_compact (sensor_key, syncTimestamp, data_id, readOffset_ms, temperature)
+            VALUES ((SELECT sensor_key FROM sensor_keys WHERE sensorID = NEW.sensorID), NEW.syncTimestamp,
+                    ifnull(NEW.data_id, (SELECT lastDataID FROM compact_storage WHERE id = 1)),
+                    CAST(round((NEW.timestamp - NEW.syncTimestamp) * 1000) AS INTEGER), CAST(round(NEW.tempDegC * {int(temperatureScale)}) AS INTEGER));
+        END
+        """,
+        """
+        CREATE TRIGGER trg_temperature_data_delete INSTEAD OF DELETE ON temperature_data
+        BEGIN
+          DELETE FROM temperature_data_compact WHERE data_id = OLD.data_id;
+        END
+        """
+    ]
+
+# Copies temperature_data rows with data_id in (afterDataID, upToDataID] into the compact table
+def getCopyQueries(temperatureScale):
+    return [
+        "INSERT OR IGNORE INTO sensor_keys (sensorID) SELECT DISTINCT sensorID FROM temperature_data WHERE data_id > ? AND data_id <= ?",
+        f"""
+        INSERT OR IGNORE INTO temperature_data_compact (sensor_key, syncTimestamp, data_id, readOffset_ms, temperature)
+          SELECT k.sensor_key, ifnull(d.syncTimestamp, CAST(d.timestamp AS INTEGER)), d.data_id,
+                 CAST(round((d.timestamp - d.syncTimestamp) * 1000) AS INTEGER), CAST(round(d.tempDegC * {int(temperatureScale)}) AS INTEGER)
+          FROM temperature_data d JOIN sensor_keys k ON k.sensorID = d.sensorID
+          WHERE d.data_id > ? AND d.data_id <= ?
+        """
+    ]
+
+# True once temperature_data has been replaced by the view
+def isCompact(connection):
+    return connection.execute("SELECT type FROM sqlite_master WHERE name = 'temperature_data'").fetchone() == ("view",)
+
+# The temperatureScale readings are stored with, or None if the database isn't using compact storage
+def getTemperatureScale(connection):
+    if not isCompact(connection):
+        return None
+    return connection.execute("SELECT temperatureScale FROM compact_storage WHERE id = 1").fetchone()[0]
+
+# The table to use for plain deletes and min/max lookups, which can't see through the view's join
+def getReadingsTableName(connection):
+    return "temperature_data_compact" if isCompact(connection) else "temperature_data"
+
+# Writes readings (dicts as for DBAccess.insertReadings) straight into the compact table, inside the caller's
+# transaction, and returns the last data_id used
+def insertReadings(cursor, readings, temperatureScale):
+    sensorIDs = {reading["sensorID"] for reading in readings}
+    cursor.executemany("INSERT OR IGNORE INTO sensor_keys (sensorID) VALUES (?)", [(sensorID,) for sensorID in sensorIDs])
+    sensorKeys = dict(cursor.execute("SELECT sensorID, sensor_key FROM sensor_keys").fetchall())
+
+    firstDataID = cursor.execute("SELECT lastDataID + 1 FROM compact_storage WHERE id = 1").fetchone()[0]
+    rows = []
+    for index, reading in enumerate(readings):
+        rows.append((
+            sensorKeys[reading["sensorID"]],
+            reading["syncTimestamp"],
+            firstDataID + index,
+            None if reading["timestamp"] is None else round((reading["timestamp"] - reading["syncTimestamp"]) * 1000),
+            None if reading["tempDegC"] is None else round(reading["tempDegC"] * temperatureScale)
+        ))
+    cursor.executemany("INSERT INTO temperature_data_compact (sensor_key, syncTimestamp, data_id, readOffset_ms, temperature) VALUES (?, ?, ?, ?, ?)", rows)
+    lastDataID = firstDataID + len(readings) - 1
+    cursor.execute("UPDATE compact_storage SET lastDataID = ? WHERE id = 1", (lastDataID,))
+    return lastDataID
+
+# Creates the compact tables alongside temperature_data. A conversion that was already started carries on with its own scale
+def startCompacting(connection, temperatureScale=16):
+    cursor = connection.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        for query in compact_storage_queries:
+            cursor.execute(query)
+        cursor.execute("INSERT OR IGNORE INTO compact_storage (id, temperatureScale, lastCopiedDataID, lastDataID, startedTimestamp) VALUES (1, ?, 0, 0, ?)",
+                       (temperatureScale, time.time()))
+        connection.commit()
+    except Error:
+        connection.rollback()
+        raise
+    return connection.execute("SELECT temperatureScale FROM compact_storage WHERE id = 1").fetchone()[0]
+
+# Copies the next chunkSize rows within the caller's transaction. Returns the number copied, 0 when it has caught up
+def copyChunk(cursor, temperatureScale, chunkSize):
+    lastCopiedDataID = cursor.execute("SELECT lastCopiedDataID FROM compact_storage WHERE id = 1").fetchone()[0]
+    upToDataID, nRows = cursor.execute("SELECT max(data_id), count(*) FROM (SELECT data_id FROM temperature_data WHERE data_id > ? ORDER BY data_id LIMIT ?)",
+                                       (lastCopiedDataID, chunkSize)).fetchone()
+    if nRows == 0:
+        return 0
+    for query in getCopyQueries(temperatureScale):
+        cursor.execute(query, (lastCopiedDataID, upToDataID))
+    cursor.execute("UPDATE compact_storage SET lastCopiedDataID = ? WHERE id = 1", (upToDataID,))
+    return nRows
+
+# Copies everything logged so far, each chunk its own transaction so the logger only ever waits for one chunk.
+# Progress is saved, so this can be stopped and restarted
+def copyReadings(connection, temperatureScale, chunkSize=100000):
+    nCopied = 0
+    cursor = connection.cursor()
+    while True:
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            nRows = copyChunk(cursor, temperatureScale, chunkSize)
+            connection.commit()
+        except Error:
+            connection.rollback()
+            raise
+        if nRows == 0:
+            return nCopied
+        nCopied += nRows
+        print(f"Copied {nCopied} readings")
+
+# Copies whatever the logger has added since, then swaps temperature_data for the view, all in one transaction
+def finishCompacting(connection, temperatureScale, chunkSize=100000):
+    cursor = connection.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        while copyChunk(cursor, temperatureScale, chunkSize) > 0:
+            pass
+        # Carry on from the highest data_id ever used, as AUTOINCREMENT would have
+        lastDataID = cursor.execute("""
+            SELECT max(ifnull((SELECT max(data_id) FROM temperature_data), 0), ifnull((SELECT seq FROM sqlite_sequence WHERE name = 'temperature_data'), 0))
+            """).fetchone()[0]
+        cursor.execute("UPDATE compact_storage SET lastDataID = max(lastDataID, ?), completedTimestamp = ? WHERE id = 1", (lastDataID, time.time()))
+        cursor.execute("DROP TABLE temperature_data")
+        cursor.execute("DELETE FROM sqlite_sequence WHERE name = 'temperature_data'")
+        for query in getViewQueries(temperatureScale):
+            cursor.execute(query)
+        connection.commit()
+    except Error:
+        connection.rollback()
+        raise
+
+# Readings that can't be stored exactly, i.e. aren't whole multiples of 1 / temperatureScale degrees
+def countInexactReadings(connection, temperatureScale):
+    return connection.execute("SELECT count(*) FROM temperature_data WHERE tempDegC * ? != round(tempDegC * ?)", (temperatureScale, temperatureScale)).fetchone()[0]
+
+def getHelpText():
+    helpText = "\r\n"
+    helpText += "CompactStorage.py converts the database pointed to in Radiator_temp_logger.cnf to compact storage of the readings.\r\n"
+    helpText += "The logger can keep running while it does. Back the database up first, there's no converting back\r\n"
+    helpText += "\r\n"
+    helpText += "Options:-\r\n"
+    helpText += "\r\n"
+    helpText += "   -s  :   --scale <n>             :   Store temperatures to the nearest 1/n degree (default 16, exact for DS18B20s)\r\n"
+    helpText += "       :   --chunkSize <n>         :   Number of readings to copy in each transaction (default 100000)\r\n"
+    helpText += "       :   --vacuum                :   Rebuild the database file afterwards so it actually shrinks. This needs as much\r\n"
+    helpText += "                                       free disk space again as the new database, and the logger waits until it's done\r\n"
+
+    return helpText
+
+if __name__ == "__main__":
+    import DBAccess
+    import CreateDBTables
+
+    temperatureScale = 16
+    chunkSize = 100000
+    isVacuuming = False
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hs:", ["scale=", "chunkSize=", "vacuum"])
+    except getopt.GetoptError:
+        print("CompactStorage.py options error occured")
+        sys.exit(2)
+    try:
+        for opt, arg in opts:
+            if opt == "-h":
+                print(getHelpText())
+                sys.exit()
+            elif opt in ("-s", "--scale"):
+                temperatureScale = int(arg)
+            elif opt == "--chunkSize":
+                chunkSize = int(arg)
+            elif opt == "--vacuum":
+                isVacuuming = True
+    except ValueError as e:
+        print(e)
+        print("Please supply whole numbers for the scale and chunk size")
+        sys.exit(2)
+
+    config = configparser.ConfigParser()
+    config.read("Radiator_temp_logger.cnf")
+    databasePath = config["DatabaseSettings"].get("databasePath")
+    busyTimeout_sec = config["DatabaseSettings"].getfloat("busyTimeout_sec", 60)
+
+    connection = DBAccess.create_connection(databasePath)
+    connection.execute(f"PRAGMA busy_timeout={int(busyTimeout_sec * 1000)}")
+    CreateDBTables.upgradeDatabase(connection)
+
+    if isCompact(connection):
+        print("The database already uses compact storage")
+    else:
+        temperatureScale = startCompacting(connection, temperatureScale)
+        nInexact = countInexactReadings(connection, temperatureScale)
+        if nInexact > 0:
+            print(f"{nInexact} readings aren't whole multiples of 1/{temperatureScale} degC and will be rounded")
+        startTime = time.perf_counter()
+        copyReadings(connection, temperatureScale, chunkSize)
+        finishCompacting(connection, temperatureScale, chunkSize)
+        print(f"Converted to compact storage in {time.perf_counter() - startTime:.1f} seconds")
+
+    if isVacuuming:
+        sizeBefore = os.path.getsize(databasePath)
+        connection.execute("VACUUM")
+        print(f"Database file went from {sizeBefore / 1e6:.1f} MB to {os.path.getsize(databasePath) / 1e6:.1f} MB")
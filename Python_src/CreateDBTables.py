@@ -1,9 +1,15 @@
 #! /usr/bin/env python3
 
 import configparser
+import time
 import DBAccess
+from sqlite3 import Error
 
 def createDBTables(connection):
+    # Only takes effect on a new database, before any tables are made. Lets DatabaseMaintenance.py give
+    # deleted space back to the file system a little at a time rather than with a full VACUUM
+    DBAccess.execute_query(connection, "PRAGMA auto_vacuum = INCREMENTAL")
+
     # Also add cal info for this sensor
     create_sensors_table = """
     CREATE TABLE IF NOT EXISTS sensors (
@@ -42,6 +48,271 @@ def createDBTables(connection):
     );
     """
     DBAccess.execute_query(connection, create_groupings_table)
+    
+    upgradeDatabase(connection)
+
+create_schema_version_table = """
+CREATE TABLE IF NOT EXISTS schema_version (
+  version INTEGER PRIMARY KEY,
+  description TEXT,
+  appliedTimestamp REAL
+);
+"""
+
+# Schema changes, applied in order and only once to each database. Each step is either an SQL
+# statement or a function taking a cursor. Always add new migrations to the end, never edit an old one
+migrations = [
+    (1, "Index temperature_data by syncTimestamp and by sensorID", [
+        "CREATE INDEX IF NOT EXISTS idx_temperature_data_syncTimestamp_sensorID ON temperature_data (syncTimestamp, sensorID, tempDegC)",
+        "CREATE INDEX IF NOT EXISTS idx_temperature_data_sensorID_syncTimestamp ON temperature_data (sensorID, syncTimestamp, tempDegC)",
+        "CREATE INDEX IF NOT EXISTS idx_sensors_grouping_id ON sensors (grouping_id)"
+    ]),
+    (2, "Add sync_cycles table with one row per syncTimestamp", [
+        """
+        CREATE TABLE IF NOT EXISTS sync_cycles (
+          cycle_id INTEGER PRIMARY KEY AUTOINCREMENT,
+          syncTimestamp INTEGER NOT NULL UNIQUE,
+          nReadings INTEGER,
+          lastDataID INTEGER,
+          committedTimestamp REAL
+        );
+        """,
+        """
+        INSERT OR IGNORE INTO sync_cycles (syncTimestamp, nReadings, lastDataID, committedTimestamp)
+          SELECT syncTimestamp, count(*), max(data_id), max(timestamp) FROM temperature_data
+          GROUP BY syncTimestamp ORDER BY syncTimestamp
+        """
+    ]),
+    (3, "Add temperature_rollups table for minute, hour and day aggregates", [
+        """
+        CREATE TABLE IF NOT EXISTS temperature_rollups (
+          resolution_sec INTEGER NOT NULL,
+          sensorID TEXT NOT NULL,
+          bucketTimestamp INTEGER NOT NULL,
+          minTempDegC REAL,
+          maxTempDegC REAL,
+          sumTempDegC REAL,
+          nReadings INTEGER,
+          lastTempDegC REAL,
+          lastSyncTimestamp INTEGER,
+          PRIMARY KEY (resolution_sec, sensorID, bucketTimestamp)
+        ) WITHOUT ROWID;
+        """,
+        # Readings up to backfillUpToDataID were logged before the rollups existed, see BackfillRollups.py
+        """
+        CREATE TABLE IF NOT EXISTS rollup_backfill_state (
+          lastBackfilledDataID INTEGER,
+          backfillUpToDataID INTEGER
+        );
+        """,
+        "INSERT INTO rollup_backfill_state (lastBackfilledDataID, backfillUpToDataID) SELECT 0, ifnull(max(data_id), 0) FROM temperature_data"
+    ]),
+    (4, "Track which sync_cycles are complete and index them by lastDataID", [
+        "ALTER TABLE sync_cycles ADD COLUMN isComplete INTEGER NOT NULL DEFAULT 1",
+        "CREATE INDEX IF NOT EXISTS idx_sync_cycles_lastDataID ON sync_cycles (lastDataID)"
+    ]),
+    (5, "Add archive_partitions table listing readings moved to the cold archive", [
+        """
+        CREATE TABLE IF NOT EXISTS archive_partitions (
+          partitionName TEXT PRIMARY KEY,
+          directory TEXT NOT NULL,
+          baseSyncTimestamp INTEGER,
+          firstSyncTimestamp INTEGER,
+          lastSyncTimestamp INTEGER,
+          firstDataID INTEGER,
+          lastDataID INTEGER,
+          nRows INTEGER,
+          temperatureScale INTEGER,
+          archivedTimestamp REAL
+        );
+        """
+    ]),
+    (6, "Add latest_readings table holding each sensor's most recent reading", [
+        """
+        CREATE TABLE IF NOT EXISTS latest_readings (
+          sensorID TEXT PRIMARY KEY,
+          syncTimestamp INTEGER,
+          timestamp REAL,
+          tempDegC REAL,
+          ipAddress TEXT
+        );
+        """,
+        """
+        INSERT OR REPLACE INTO latest_readings (sensorID, syncTimestamp, timestamp, tempDegC)
+          SELECT d.sensorID, d.syncTimestamp, d.timestamp, d.tempDegC FROM temperature_data d
+          JOIN (SELECT max(data_id) AS data_id FROM temperature_data GROUP BY sensorID) latest ON latest.data_id = d.data_id
+        """
+    ]),
+    (7, "Add device_status and missed_cycles tables for the cycle scheduler", [
+        """
+        CREATE TABLE IF NOT EXISTS device_status (
+          ipAddress TEXT PRIMARY KEY,
+          lastPollTimestamp INTEGER,
+          lastSuccessTimestamp INTEGER,
+          consecutiveFailures INTEGER NOT NULL DEFAULT 0,
+          nextPollTimestamp INTEGER,
+          lastError TEXT,
+          lastLatency_sec REAL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS missed_cycles (
+          firstSyncTimestamp INTEGER PRIMARY KEY,
+          lastSyncTimestamp INTEGER NOT NULL,
+          nMissed INTEGER NOT NULL,
+          recordedTimestamp REAL
+        );
+        """
+    ]),
+    (8, "Add metadata_version, bumped by triggers whenever sensors or groupings change", [
+        """
+        CREATE TABLE IF NOT EXISTS metadata_version (
+          id INTEGER PRIMARY KEY CHECK (id = 1),
+          version INTEGER NOT NULL
+        );
+        """,
+        "INSERT OR IGNORE INTO metadata_version (id, version) VALUES (1, 1)"
+    ] + [
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_metadata_version AFTER {event} ON {table}
+        BEGIN
+          UPDATE metadata_version SET version = version + 1 WHERE id = 1;
+        END
+        """
+        for table in ["sensors", "groupings"] for event in ["INSERT", "UPDATE", "DELETE"]
+    ]),
+    (9, "Add sensor_statistics, grouping_statistics and alerts tables", [
+        """
+        CREATE TABLE IF NOT EXISTS sensor_statistics (
+          sensorID TEXT PRIMARY KEY,
+          nReadings INTEGER,
+          lastSyncTimestamp INTEGER,
+          lastTempDegC REAL,
+          ewmaTempDegC REAL,
+          ewmVarTempDegC REAL,
+          rateDegCPerMin REAL,
+          unchangedSinceSyncTimestamp INTEGER,
+          unchangedTempDegC REAL,
+          ipAddress TEXT
+        ) WITHOUT ROWID;
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS grouping_statistics (
+          grouping_id INTEGER PRIMARY KEY,
+          nCycles INTEGER,
+          lastSyncTimestamp INTEGER,
+          deltaDegC REAL,
+          ewmaDeltaDegC REAL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS alerts (
+          alert_id INTEGER PRIMARY KEY AUTOINCREMENT,
+          alertType TEXT NOT NULL,
+          subject TEXT NOT NULL,
+          raisedSyncTimestamp INTEGER,
+          clearedSyncTimestamp INTEGER,
+          value REAL,
+          message TEXT,
+          raisedTimestamp REAL,
+          clearedTimestamp REAL
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_alerts_open ON alerts (alertType, subject) WHERE clearedSyncTimestamp IS NULL"
+    ]),
+    (10, "Add time-versioned calibrations and the calibrated_readings table", [
+        """
+        CREATE TABLE IF NOT EXISTS calibrations (
+          calibration_id INTEGER PRIMARY KEY AUTOINCREMENT,
+          sensorID TEXT NOT NULL,
+          validFromTimestamp INTEGER NOT NULL,
+          offsetDegC REAL NOT NULL DEFAULT 0,
+          gain REAL NOT NULL DEFAULT 1,
+          method TEXT,
+          referenceSensorID TEXT,
+          residualDegC REAL,
+          createdTimestamp REAL
+        );
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_calibrations_sensorID_validFromTimestamp ON calibrations (sensorID, validFromTimestamp)",
+        # Any corrections already typed into the sensors table apply from the start
+        """
+        INSERT OR IGNORE INTO calibrations (sensorID, validFromTimestamp, offsetDegC, gain, method, createdTimestamp)
+          SELECT sensorID, 0, calibrationCorrection, 1, 'calibrationCorrection', strftime('%s', 'now') FROM sensors
+          WHERE calibrationCorrection IS NOT NULL AND calibrationCorrection != 0
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS calibrated_readings (
+          data_id INTEGER PRIMARY KEY,
+          syncTimestamp INTEGER,
+          timestamp REAL,
+          sensorID TEXT NOT NULL,
+          tempDegC REAL,
+          calibration_id INTEGER
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_calibrated_readings_sensorID_syncTimestamp ON calibrated_readings (sensorID, syncTimestamp, tempDegC)",
+        "CREATE INDEX IF NOT EXISTS idx_calibrated_readings_syncTimestamp ON calibrated_readings (syncTimestamp)",
+        # Readings up to backfillUpToDataID were logged before calibrated_readings existed, see Calibrate.py
+        """
+        CREATE TABLE IF NOT EXISTS calibration_backfill_state (
+          lastBackfilledDataID INTEGER,
+          backfillUpToDataID INTEGER
+        );
+        """,
+        "INSERT INTO calibration_backfill_state (lastBackfilledDataID, backfillUpToDataID) SELECT 0, ifnull(max(data_id), 0) FROM temperature_data"
+    ]),
+    (11, "Index rollups by age and add maintenance_state for DatabaseMaintenance.py", [
+        "CREATE INDEX IF NOT EXISTS idx_temperature_rollups_resolution_sec_bucketTimestamp ON temperature_rollups (resolution_sec, bucketTimestamp)",
+        """
+        CREATE TABLE IF NOT EXISTS maintenance_state (
+          lastRunTimestamp REAL,
+          lastAnalyzeTimestamp REAL
+        );
+        """,
+        "INSERT INTO maintenance_state (lastRunTimestamp, lastAnalyzeTimestamp) VALUES (0, 0)"
+    ]),
+]
+
+def getSchemaVersion(connection):
+    connection.execute(create_schema_version_table)
+    version = connection.execute("SELECT max(version) FROM schema_version").fetchone()[0]
+    if version is None:
+        return 0
+    return version
+
+# Brings the database up to the latest schema version. This is safe to run while the logger is running,
+# each migration is its own transaction so the logger just waits (up to its busy timeout) while one is applied
+def upgradeDatabase(connection):
+    currentVersion = getSchemaVersion(connection)
+    
+    for version, description, steps in migrations:
+        if version <= currentVersion:
+            continue
+        
+        print(f"Applying migration {version} : {description}")
+        startTime = time.perf_counter()
+        cursor = connection.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            # Somebody else may have applied it while we were waiting for the lock
+            if cursor.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,)).fetchone() is not None:
+                connection.rollback()
+                continue
+            for step in steps:
+                if callable(step):
+                    step(cursor)
+                else:
+                    cursor.execute(step)
+            cursor.execute("INSERT INTO schema_version (version, description, appliedTimestamp) VALUES (?, ?, ?)", (version, description, time.time()))
+            connection.commit()
+        except Error as e:
+            connection.rollback()
+            print(f"The error '{e}' occurred applying migration {version}, database left at version {getSchemaVersion(connection)}")
+            raise
+        print(f"Migration {version} applied in {time.perf_counter() - startTime:.1f} seconds")
+    
+    return getSchemaVersion(connection)
 
 if __name__ == "__main__":
     config = configparser.ConfigParser()
@@ -51,3 +322,4 @@ if __name__ == "__main__":
     connection = DBAccess.create_connection(databasePath)
     
     createDBTables(connection)
+    print(f"Database is at schema version {getSchemaVersion(connection)}")
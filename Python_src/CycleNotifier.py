@@ -0,0 +1,198 @@
+#! /usr/bin/env python3
+
+import json
+import os
+import socket
+import threading
+import time
+import select
+
+# The logger publishes a "cycle committed" event over a Unix socket and any number of viewers can block waiting
+# for one. Events are JSON lines like {"cycle_id": 12, "syncTimestamp": 1608765463, "lastDataID": 15285}.
+# Where Unix sockets aren't available (e.g. Windows) or the logger isn't running, viewers fall back to checking
+# PRAGMA data_version, which only changes when another connection has committed something
+
+latest_cycle_query = "SELECT cycle_id, syncTimestamp, lastDataID FROM sync_cycles WHERE isComplete = 1 ORDER BY lastDataID DESC LIMIT 1"
+
+def getLatestCycle(connection):
+    row = connection.execute(latest_cycle_query).fetchone()
+    if row is None:
+        return None
+    return {"cycle_id": row[0], "syncTimestamp": row[1], "lastDataID": row[2]}
+
+def getCycleForSyncTimestamp(connection, syncTimestamp):
+    row = connection.execute("SELECT cycle_id, syncTimestamp, lastDataID FROM sync_cycles WHERE syncTimestamp = ?", (syncTimestamp,)).fetchone()
+    if row is None:
+        return None
+    return {"cycle_id": row[0], "syncTimestamp": row[1], "lastDataID": row[2]}
+
+def getDefaultSocketPath(databasePath):
+    return databasePath + ".sock"
+
+class CyclePublisher:
+    def __init__(self, socketPath):
+        self.socketPath = socketPath
+        self.clients = []
+        self.clientsLock = threading.Lock()
+        self.serverSocket = None
+
+        if not hasattr(socket, "AF_UNIX"):
+            print("Unix sockets aren't available, viewers will poll the database for new cycles instead")
+            return
+
+        # Clear up after a previous logger that didn't shut down cleanly
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)
+
+        try:
+            self.serverSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.serverSocket.bind(self.socketPath)
+            self.serverSocket.listen()
+        except OSError as e:
+            print(f"Couldn't open notification socket {self.socketPath} : {e}")
+            self.serverSocket = None
+            return
+
+        threading.Thread(target=self.acceptClients, name="CyclePublisher", daemon=True).start()
+
+    def acceptClients(self):
+        while True:
+            try:
+                clientSocket, address = self.serverSocket.accept()
+            except OSError:
+                return # Socket closed
+            clientSocket.settimeout(0.5) # A stuck viewer mustn't hold up the logger
+            with self.clientsLock:
+                self.clients.append(clientSocket)
+
+    def publish(self, cycle):
+        if self.serverSocket is None or cycle is None:
+            return
+
+        message = (json.dumps(cycle) + "\n").encode()
+        with self.clientsLock:
+            for clientSocket in list(self.clients):
+                try:
+                    clientSocket.sendall(message)
+                except OSError:
+                    # Viewer has gone away
+                    clientSocket.close()
+                    self.clients.remove(clientSocket)
+
+    def close(self):
+        if self.serverSocket is None:
+            return
+        self.serverSocket.close()
+        with self.clientsLock:
+            for clientSocket in self.clients:
+                clientSocket.close()
+            self.clients = []
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)
+
+class CycleSubscriber:
+    def __init__(self, connection, socketPath, fallbackPollTime_sec=2):
+        self.connection = connection
+        self.socketPath = socketPath
+        self.fallbackPollTime_sec = fallbackPollTime_sec
+        self.socket = None
+        self.receivedBytes = b""
+        self.dataVersion = self.getDataVersion()
+
+        latestCycle = getLatestCycle(connection)
+        self.lastDataID = 0 if latestCycle is None else latestCycle["lastDataID"]
+
+    def getDataVersion(self):
+        return self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def connect(self):
+        if self.socket is not None or not hasattr(socket, "AF_UNIX"):
+            return
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.socket.connect(self.socketPath)
+        except OSError:
+            # Logger not running or not publishing, try again next time
+            self.disconnect()
+            return
+        self.receivedBytes = b""
+        # Anything committed before we connected would otherwise be missed
+        self.dataVersion = None
+
+    def disconnect(self):
+        self.socket.close()
+        self.socket = None
+
+    def getNewCycleFromDatabase(self):
+        dataVersion = self.getDataVersion()
+        if dataVersion == self.dataVersion:
+            return None
+        self.dataVersion = dataVersion
+
+        latestCycle = getLatestCycle(self.connection)
+        if latestCycle is None or latestCycle["lastDataID"] <= self.lastDataID:
+            return None
+        return latestCycle
+
+    def getNewCycleFromSocket(self, timeout_sec):
+        readable, writable, exceptional = select.select([self.socket], [], [], timeout_sec)
+        if len(readable) == 0:
+            return None
+
+        try:
+            received = self.socket.recv(4096)
+        except OSError:
+            received = b""
+        if len(received) == 0:
+            # Logger has shut down
+            self.disconnect()
+            return None
+
+        self.receivedBytes += received
+        lines = self.receivedBytes.split(b"\n")
+        self.receivedBytes = lines[-1]
+
+        newestCycle = None
+        for line in lines[:-1]:
+            try:
+                cycle = json.loads(line)
+            except ValueError:
+                continue
+            if cycle["lastDataID"] > self.lastDataID and (newestCycle is None or cycle["lastDataID"] > newestCycle["lastDataID"]):
+                newestCycle = cycle
+        return newestCycle
+
+    # Blocks until a cycle newer than the last one returned has been committed and returns its event,
+    # or returns None if timeout_sec passes first
+    def waitForNextCycle(self, timeout_sec=None):
+        endTime = None if timeout_sec is None else time.monotonic() + timeout_sec
+
+        while True:
+            self.connect()
+
+            cycle = None
+            if self.socket is not None and self.dataVersion is None:
+                # Just (re)connected, catch up on anything we missed
+                cycle = self.getNewCycleFromDatabase()
+
+            if cycle is None:
+                waitTime_sec = self.fallbackPollTime_sec
+                if endTime is not None:
+                    waitTime_sec = max(0, min(waitTime_sec, endTime - time.monotonic()))
+
+                if self.socket is not None:
+                    cycle = self.getNewCycleFromSocket(waitTime_sec)
+                else:
+                    time.sleep(waitTime_sec)
+                    cycle = self.getNewCycleFromDatabase()
+
+            if cycle is not None:
+                self.lastDataID = cycle["lastDataID"]
+                return cycle
+
+            if endTime is not None and time.monotonic() >= endTime:
+                return None
+
+    def close(self):
+        if self.socket is not None:
+            self.disconnect()
@@ -0,0 +1,118 @@
+#! /usr/bin/env python3
+
+import math
+import time
+
+# Decides when the logger runs a cycle and which devices it polls.
+# Cycles start on whole multiples of interval_sec since 1970 (e.g. on the minute for 60), and that boundary is
+# used as the cycle's syncTimestamp, so the period doesn't stretch by however long polling takes. Waiting is done
+# against time.monotonic() so the wall clock being adjusted mid-wait doesn't cut the wait short or stretch it.
+# If a cycle overruns, or the computer was asleep, the boundaries that were missed are reported rather than
+# run late one after another.
+# Each device is polled every deviceIntervals_sec[ipAddress] seconds (interval_sec if not given). A device that
+# can't be reached is backed off, waiting twice as long after each failure up to maxBackoff_sec, so it
+# doesn't cost the healthy ones a timeout every cycle
+
+unreachableErrorTypes = ["timeout", "connection", "deadline", "busy"]
+
+class DeviceSchedule:
+    def __init__(self, ipAddress, interval_sec):
+        self.ipAddress = ipAddress
+        self.interval_sec = interval_sec
+        self.nextPollTimestamp = 0
+        self.consecutiveFailures = 0
+        self.lastPollTimestamp = None
+        self.lastSuccessTimestamp = None
+        self.lastError = None
+        self.lastLatency_sec = None
+
+    def getStatus(self):
+        return {
+            "ipAddress": self.ipAddress,
+            "lastPollTimestamp": self.lastPollTimestamp,
+            "lastSuccessTimestamp": self.lastSuccessTimestamp,
+            "consecutiveFailures": self.consecutiveFailures,
+            "nextPollTimestamp": self.nextPollTimestamp,
+            "lastError": self.lastError,
+            "lastLatency_sec": self.lastLatency_sec
+        }
+
+class CycleScheduler:
+    def __init__(self, interval_sec, ipAddresses, deviceIntervals_sec=None, maxBackoff_sec=900):
+        self.interval_sec = interval_sec
+        self.maxBackoff_sec = maxBackoff_sec
+        deviceIntervals_sec = deviceIntervals_sec or {}
+        self.devices = {ipAddress: DeviceSchedule(ipAddress, deviceIntervals_sec.get(ipAddress, interval_sec)) for ipAddress in ipAddresses}
+        self.syncTimestamp = None
+        self.nextSyncTimestamp = None
+
+    # Picks up backoff where a previous run of the logger left off, statuses are rows from the device_status table
+    def restoreDeviceStatus(self, statuses):
+        for status in statuses:
+            device = self.devices.get(status["ipAddress"])
+            if device is None:
+                continue
+            device.consecutiveFailures = status["consecutiveFailures"] or 0
+            device.nextPollTimestamp = status["nextPollTimestamp"] or 0
+            device.lastPollTimestamp = status["lastPollTimestamp"]
+            device.lastSuccessTimestamp = status["lastSuccessTimestamp"]
+
+    def getFirstBoundaryAfter(self, aTimestamp):
+        return math.ceil(aTimestamp / self.interval_sec) * self.interval_sec
+
+    # Sleeps until the next cycle is due. Returns its syncTimestamp and, if any boundaries were missed since the
+    # last cycle, (first missed syncTimestamp, last missed syncTimestamp, number missed), otherwise None.
+    # If stopEvent (a threading or multiprocessing Event) is given and gets set while waiting, returns (None, None)
+    def waitForNextCycle(self, stopEvent=None):
+        now = time.time()
+        if self.nextSyncTimestamp is None:
+            self.nextSyncTimestamp = self.getFirstBoundaryAfter(now)
+
+        missedCycles = None
+        if now >= self.nextSyncTimestamp + self.interval_sec:
+            # Running late by more than a whole cycle, skip to the latest boundary that has passed
+            latestBoundary = math.floor(now / self.interval_sec) * self.interval_sec
+            nMissed = round((latestBoundary - self.nextSyncTimestamp) / self.interval_sec)
+            missedCycles = (int(self.nextSyncTimestamp), int(latestBoundary - self.interval_sec), nMissed)
+            self.nextSyncTimestamp = latestBoundary
+
+        deadline = time.monotonic() + (self.nextSyncTimestamp - now)
+        while time.monotonic() < deadline:
+            if stopEvent is None:
+                time.sleep(max(0, deadline - time.monotonic()))
+            elif stopEvent.wait(max(0, deadline - time.monotonic())):
+                return None, None
+
+        self.syncTimestamp = int(self.nextSyncTimestamp)
+        self.nextSyncTimestamp += self.interval_sec
+        return self.syncTimestamp, missedCycles
+
+    def getDueDevices(self):
+        return [ipAddress for ipAddress, device in self.devices.items() if device.nextPollTimestamp <= self.syncTimestamp]
+
+    def getBackedOffDevices(self):
+        return [ipAddress for ipAddress, device in self.devices.items() if device.consecutiveFailures > 0 and device.nextPollTimestamp > self.syncTimestamp]
+
+    # Updates the schedule of each polled device and returns their statuses, for the device_status table
+    def recordPollResults(self, pollResults):
+        statuses = []
+        for pollResult in pollResults:
+            device = self.devices[pollResult.ipAddress]
+            device.lastPollTimestamp = self.syncTimestamp
+            device.lastError = pollResult.error
+            device.lastLatency_sec = pollResult.latency_sec
+
+            if pollResult.errorType in unreachableErrorTypes:
+                device.consecutiveFailures += 1
+                wait_sec = min(device.interval_sec * 2 ** device.consecutiveFailures, max(self.maxBackoff_sec, device.interval_sec))
+            else:
+                # It answered, even if what it said was no use
+                device.consecutiveFailures = 0
+                wait_sec = device.interval_sec
+                if pollResult.error is None:
+                    device.lastSuccessTimestamp = self.syncTimestamp
+
+            # Stay on the cycle boundaries
+            device.nextPollTimestamp = int(self.getFirstBoundaryAfter(self.syncTimestamp + wait_sec))
+            statuses.append(device.getStatus())
+        return statuses
@@ -1,13 +1,27 @@
 #! /usr/bin/env python3
 
+import os
 import sqlite3
 from sqlite3 import Error
+import time
+import math
+from collections import Counter
 import pandas as pd
+import ColdArchive
+import CompactStorage
+
+# Bucket sizes for the temperature_rollups table: minute, hour and day
+rollupResolutions_sec = [60, 3600, 86400]
+
+validJournalModes = ["DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"]
+validSynchronousSettings = ["OFF", "NORMAL", "FULL", "EXTRA"]
 
 def create_connection(path):
-    # Create file if it doesn't exist
-    createFile = open(path, 'a')
-    createFile.close()
+    # Create file if it doesn't exist. Only if it doesn't, closing a file SQLite has open elsewhere in this process
+    # (e.g. the logger's writer thread) drops that connection's locks, and another process can then delete the WAL
+    if not os.path.exists(path):
+        createFile = open(path, 'a')
+        createFile.close()
     
     connection = None
     try:
@@ -18,6 +32,27 @@ def create_connection(path):
 
     return connection
 
+def configureConnection(connection, journalMode="WAL", synchronous="NORMAL", busyTimeout_sec=60):
+    # WAL lets the viewers keep reading while the logger writes, and with synchronous=NORMAL
+    # a commit doesn't need an fsync so is much cheaper on an SD card
+    journalMode = journalMode.upper()
+    synchronous = synchronous.upper()
+    if journalMode not in validJournalModes:
+        raise ValueError(f"Unknown journal mode {journalMode}, should be one of {validJournalModes}")
+    if synchronous not in validSynchronousSettings:
+        raise ValueError(f"Unknown synchronous setting {synchronous}, should be one of {validSynchronousSettings}")
+    
+    try:
+        connection.execute(f"PRAGMA journal_mode={journalMode}")
+        connection.execute(f"PRAGMA synchronous={synchronous}")
+        # Wait rather than fail if another process (e.g. a schema upgrade) is holding the write lock
+        setBusyTimeout(connection, busyTimeout_sec)
+    except Error as e:
+        print(f"The error '{e}' occurred")
+
+def setBusyTimeout(connection, busyTimeout_sec):
+    connection.execute(f"PRAGMA busy_timeout={int(busyTimeout_sec * 1000)}")
+
 def execute_query(connection, query):
     cursor = connection.cursor()
     try:
@@ -36,6 +71,121 @@ def execute_select_query(connection, query):
     except Error as e:
         print(f"The error '{e}' occurred")
 
+insert_default_grouping_query = "INSERT OR IGNORE INTO groupings (grouping_id, groupingPrettyName, isGroupingActiveBool) VALUES (0, 'DefaultGroup', 0)"
+insert_sensor_query = "INSERT OR IGNORE INTO sensors (sensorID, sensorPrettyName, sensorShortName, isSensorActiveBool, grouping_id, flow1_return0, calibrationCorrection) VALUES (:sensorID, 'NULL', '0', 1, 0, -1, 0)" # New sensors go into grouping 0 -> ungrouped
+insert_temperature_data_query = "INSERT INTO temperature_data (syncTimestamp, timestamp, sensorID, tempDegC) VALUES (:syncTimestamp, :timestamp, :sensorID, :tempDegC)"
+upsert_sync_cycle_query = """
+INSERT INTO sync_cycles (syncTimestamp, nReadings, lastDataID, committedTimestamp, isComplete)
+  VALUES (?, ?, ?, ?, ?)
+  ON CONFLICT(syncTimestamp) DO UPDATE SET
+    nReadings = nReadings + excluded.nReadings,
+    lastDataID = excluded.lastDataID,
+    committedTimestamp = excluded.committedTimestamp,
+    isComplete = max(isComplete, excluded.isComplete)
+"""
+upsert_latest_reading_query = """
+INSERT INTO latest_readings (sensorID, syncTimestamp, timestamp, tempDegC, ipAddress)
+  VALUES (:sensorID, :syncTimestamp, :timestamp, :tempDegC, :ipAddress)
+  ON CONFLICT(sensorID) DO UPDATE SET
+    syncTimestamp = excluded.syncTimestamp,
+    timestamp = excluded.timestamp,
+    tempDegC = excluded.tempDegC,
+    ipAddress = excluded.ipAddress
+  WHERE excluded.timestamp >= latest_readings.timestamp
+"""
+
+# Calibrates the readings picked by a WHERE clause added to the end, each by its sensor's latest calibration from before it
+calibrate_readings_query = """
+INSERT OR REPLACE INTO calibrated_readings (data_id, syncTimestamp, timestamp, sensorID, tempDegC, calibration_id)
+  SELECT d.data_id, d.syncTimestamp, d.timestamp, d.sensorID, d.tempDegC * ifnull(c.gain, 1) + ifnull(c.offsetDegC, 0), c.calibration_id
+  FROM temperature_data d LEFT JOIN calibrations c ON c.calibration_id = (
+    SELECT calibration_id FROM calibrations WHERE sensorID = d.sensorID AND validFromTimestamp <= d.syncTimestamp
+    ORDER BY validFromTimestamp DESC LIMIT 1)
+  WHERE """
+insert_calibrated_readings_query = calibrate_readings_query + "d.data_id > ?"
+
+# Merges a partial aggregate into a bucket. SQLite evaluates every right hand side against the old row
+upsert_rollup_query = """
+INSERT INTO temperature_rollups (resolution_sec, sensorID, bucketTimestamp, minTempDegC, maxTempDegC, sumTempDegC, nReadings, lastTempDegC, lastSyncTimestamp)
+  VALUES (:resolution_sec, :sensorID, :bucketTimestamp, :minTempDegC, :maxTempDegC, :sumTempDegC, :nReadings, :lastTempDegC, :lastSyncTimestamp)
+  ON CONFLICT(resolution_sec, sensorID, bucketTimestamp) DO UPDATE SET
+    minTempDegC = min(minTempDegC, excluded.minTempDegC),
+    maxTempDegC = max(maxTempDegC, excluded.maxTempDegC),
+    sumTempDegC = sumTempDegC + excluded.sumTempDegC,
+    nReadings = nReadings + excluded.nReadings,
+    lastTempDegC = CASE WHEN excluded.lastSyncTimestamp >= lastSyncTimestamp THEN excluded.lastTempDegC ELSE lastTempDegC END,
+    lastSyncTimestamp = max(lastSyncTimestamp, excluded.lastSyncTimestamp)
+"""
+
+# Readings without a temperature are left out, a NULL would make the bucket's min, max and sum NULL for good
+def getRollupRowsForReadings(readings):
+    rollupRows = []
+    for reading in readings:
+        if reading["tempDegC"] is None:
+            continue
+        for resolution_sec in rollupResolutions_sec:
+            rollupRows.append({
+                "resolution_sec": resolution_sec,
+                "sensorID": reading["sensorID"],
+                "bucketTimestamp": reading["syncTimestamp"] - reading["syncTimestamp"] % resolution_sec,
+                "minTempDegC": reading["tempDegC"],
+                "maxTempDegC": reading["tempDegC"],
+                "sumTempDegC": reading["tempDegC"],
+                "nReadings": 1,
+                "lastTempDegC": reading["tempDegC"],
+                "lastSyncTimestamp": reading["syncTimestamp"]
+            })
+    return rollupRows
+
+# Writes a batch of readings (dicts with syncTimestamp, timestamp, sensorID, tempDegC and optionally ipAddress) in a single transaction
+# Unknown sensors are added to the default grouping. Raises sqlite3.Error after rolling back if anything fails
+# Set completesCycle to False if more readings for the same syncTimestamp are still to come, so viewers wait for them
+# If the caller already knows which sensors are new (see SensorRegistry), pass their IDs as newSensorIDs and only those are added
+def insertReadings(connection, readings, completesCycle=True, newSensorIDs=None):
+    startTime = time.perf_counter()
+    # Looked up before the transaction, a read would start it as a read transaction that can't wait for the write lock.
+    # If the database is converted in between, the plain insert still works through the view
+    temperatureScale = CompactStorage.getTemperatureScale(connection)
+    cursor = connection.cursor()
+    try:
+        cursor.execute("BEGIN")
+        if newSensorIDs is None:
+            cursor.execute(insert_default_grouping_query)
+            cursor.executemany(insert_sensor_query, readings)
+        elif len(newSensorIDs) > 0:
+            cursor.execute(insert_default_grouping_query)
+            cursor.executemany(insert_sensor_query, [{"sensorID": sensorID} for sensorID in newSensorIDs])
+        # With compact storage, straight into its table rather than one trigger per row through the view
+        if temperatureScale is None:
+            cursor.executemany(insert_temperature_data_query, readings)
+            lastDataID = cursor.execute("SELECT max(data_id) FROM temperature_data").fetchone()[0]
+        else:
+            lastDataID = CompactStorage.insertReadings(cursor, readings, temperatureScale)
+        # We hold the write lock, so this batch has the last len(readings) data_ids
+        if len(readings) > 0:
+            cursor.execute(insert_calibrated_readings_query, (lastDataID - len(readings),))
+        # Keep the cycles table up to date so timestamp lookups don't have to scan temperature_data
+        committedTimestamp = time.time()
+        readingsPerCycle = Counter(reading["syncTimestamp"] for reading in readings)
+        cursor.executemany(upsert_sync_cycle_query, [(syncTimestamp, nReadings, lastDataID, committedTimestamp, int(completesCycle)) for syncTimestamp, nReadings in readingsPerCycle.items()])
+        cursor.executemany(upsert_rollup_query, getRollupRowsForReadings(readings))
+        cursor.executemany(upsert_latest_reading_query, [{**reading, "ipAddress": reading.get("ipAddress")} for reading in readings])
+        commitStartTime = time.perf_counter()
+        connection.commit()
+    except Error:
+        connection.rollback()
+        raise
+    endTime = time.perf_counter()
+    
+    nRows = len(readings)
+    totalTime_sec = endTime - startTime
+    return {
+        "nRows": nRows,
+        "writeTime_sec": commitStartTime - startTime,
+        "commitTime_sec": endTime - commitStartTime,
+        "rowsPerSec": nRows / totalTime_sec if totalTime_sec > 0 else 0.0
+    }
+
 def getColumnIndex(connection, columnName, tableName):
 
     getTableColumns = f"PRAGMA table_info({tableName})"
@@ -51,48 +201,561 @@ def getColumnIndex(connection, columnName, tableName):
         print("Oops, that's not a legit column name")
         raise
         
-def getAllData_DF(connection):
-    temperature_data_query = "SELECT * FROM temperature_data"
-    temperature_data_DF = pd.read_sql_query(temperature_data_query, connection, index_col = "data_id")
+# Column name -> qualified column for the temperature_data/sensors/groupings join
+joinedDataColumns = {
+    "data_id": "d.data_id",
+    "syncTimestamp": "d.syncTimestamp",
+    "timestamp": "d.timestamp",
+    "sensorID": "d.sensorID",
+    "tempDegC": "d.tempDegC",
+    "sensorPrettyName": "s.sensorPrettyName",
+    "sensorShortName": "s.sensorShortName",
+    "isSensorActiveBool": "s.isSensorActiveBool",
+    "grouping_id": "s.grouping_id",
+    "flow1_return0": "s.flow1_return0",
+    "calibrationCorrection": "s.calibrationCorrection",
+    "groupingPrettyName": "g.groupingPrettyName",
+    "groupingShortName": "g.groupingShortName",
+    "isGroupingActiveBool": "g.isGroupingActiveBool"
+}
+
+# readingsTable can be calibrated_readings, which has the same columns
+def getJoinedDataQuery(conditions, limit=None, readingsTable="temperature_data"):
+    query = "SELECT " + ", ".join(f"{qualifiedName} AS {columnName}" for columnName, qualifiedName in joinedDataColumns.items())
+    query += f" FROM {readingsTable} d"
+    query += " JOIN sensors s ON s.sensorID = d.sensorID"
+    query += " JOIN groupings g ON g.grouping_id = s.grouping_id"
+    if len(conditions) > 0:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY d.data_id"
+    if limit is not None:
+        query += f" LIMIT {int(limit)}"
+    return query
+
+def getInCondition(qualifiedName, values, params):
+    values = list(values)
+    params += values
+    return f"{qualifiedName} IN ({', '.join('?' * len(values))})"
+
+# Archived rows don't have a join available, so the sensor and grouping info is merged in with pandas.
+# Filters on sensor and grouping columns are turned into a list of sensors first, so limit can be applied
+# while the archive is read rather than after decoding everything
+def getJoinedArchiveData_DF(connection, sensorIDs, groupingIDs, startTimestamp, endTimestamp, columnValues, afterDataID, limit, isCalibrated=False):
+    if not ColdArchive.hasArchive(connection):
+        return None
+    sensors_DF = pd.read_sql_query("SELECT * FROM sensors", connection)
+    groupings_DF = pd.read_sql_query("SELECT * FROM groupings", connection)
+    sensorInfo_DF = pd.merge(sensors_DF, groupings_DF, on="grouping_id")
+    
+    if sensorIDs is not None:
+        sensorInfo_DF = sensorInfo_DF.loc[sensorInfo_DF["sensorID"].isin(list(sensorIDs))]
+    if groupingIDs is not None:
+        sensorInfo_DF = sensorInfo_DF.loc[sensorInfo_DF["grouping_id"].isin(list(groupingIDs))]
+    readingValues = {}
+    for columnName, value in columnValues.items():
+        if columnName in sensorInfo_DF.columns:
+            sensorInfo_DF = sensorInfo_DF.loc[sensorInfo_DF[columnName] == value]
+        else:
+            readingValues[columnName] = value
+    
+    archiveLimit = limit if len(readingValues) == 0 else None
+    archive_DF = ColdArchive.readArchive_DF(connection, startTimestamp, endTimestamp, sensorInfo_DF["sensorID"].tolist(), afterDataID, archiveLimit)
+    if archive_DF is None:
+        return None
+    if isCalibrated:
+        # The archive only has the readings as logged
+        archive_DF = applyCalibrations_DF(archive_DF, getCalibrations_DF(connection, sensorIDs))
     
-    sensors_data_query = "SELECT * FROM sensors"
-    sensors_DF = pd.read_sql_query(sensors_data_query, connection)
+    archive_DF = pd.merge(archive_DF.reset_index(), sensorInfo_DF, on="sensorID")
+    for columnName, value in readingValues.items():
+        archive_DF = archive_DF.loc[archive_DF[columnName] == value]
+    if limit is not None:
+        archive_DF = archive_DF.head(limit)
     
-    groupings_data_query = "SELECT * FROM groupings"
-    groupings_DF = pd.read_sql_query(groupings_data_query, connection)
+    return archive_DF[list(joinedDataColumns)].set_index("data_id")
 
-    returnDataFrame = pd.merge(temperature_data_DF, sensors_DF, on="sensorID")
-    returnDataFrame = pd.merge(returnDataFrame, groupings_DF, on="grouping_id")
-    return returnDataFrame
+# Empty frames are left out, an empty one read by SQLite would turn every column into object dtype
+def concatReadings_DF(readings_DFs):
+    nonEmpty_DFs = [readings_DF for readings_DF in readings_DFs if len(readings_DF.index) > 0]
+    if len(nonEmpty_DFs) == 0:
+        return readings_DFs[-1]
+    if len(nonEmpty_DFs) == 1:
+        return nonEmpty_DFs[0]
+    return pd.concat(nonEmpty_DFs)
 
-def getFilteredDataForSpecificValue(connection, columnName, value):
-    allData = getAllData_DF(connection)
-    filteredData = allData.loc[allData[columnName] == value]
-    return filteredData
+# Readings logged before calibrated_readings existed are only in it once Calibrate.py --backfill has finished,
+# until then the ones it hasn't reached yet are calibrated as they're read
+def getJoinedCalibratedData_DF(connection, conditions, params, limit):
+    lastBackfilledDataID, backfillUpToDataID = connection.execute("SELECT lastBackfilledDataID, backfillUpToDataID FROM calibration_backfill_state").fetchone()
+    if lastBackfilledDataID >= backfillUpToDataID:
+        return pd.read_sql_query(getJoinedDataQuery(conditions, limit, "calibrated_readings"), connection, params=params, index_col = "data_id")
+    
+    backfillCondition = "d.data_id > ? AND d.data_id <= ?"
+    backfillParams = params + [lastBackfilledDataID, backfillUpToDataID]
+    calibrated_DF = pd.read_sql_query(getJoinedDataQuery(conditions + [f"NOT ({backfillCondition})"], limit, "calibrated_readings"), connection, params=backfillParams, index_col = "data_id")
+    raw_DF = pd.read_sql_query(getJoinedDataQuery(conditions + [backfillCondition], limit), connection, params=backfillParams, index_col = "data_id")
+    if len(raw_DF.index) > 0:
+        raw_DF = applyCalibrations_DF(raw_DF, getCalibrations_DF(connection, raw_DF["sensorID"].unique())).drop(columns="calibration_id")
+    
+    joined_DF = concatReadings_DF([calibrated_DF, raw_DF]).sort_index()
+    if limit is not None:
+        joined_DF = joined_DF.head(limit)
+    return joined_DF
 
-def getDataForSensor(connection, sensorID):
-    return getFilteredDataForSpecificValue(connection, "sensorID", sensorID)
+# Temperature data joined with its sensor and grouping info. The filtering is done by SQLite so only the
+# requested slice is read. Any of the filters can be left as None, timestamps are inclusive syncTimestamps.
+# columnValues is a dictionary of other column names and the value they must have.
+# afterDataID and limit allow reading in chunks: pass the last data_id of one chunk to get the next one.
+# Rows that have been moved to the archive (see ColdArchive.py) are included as if they were still in the database.
+# With isCalibrated, tempDegC is corrected by each sensor's calibration at the time, see Calibrate.py
+def getJoinedData_DF(connection, sensorIDs=None, groupingIDs=None, startTimestamp=None, endTimestamp=None, columnValues=None, afterDataID=None, limit=None, isCalibrated=False):
+    if columnValues is None:
+        columnValues = {}
+    
+    conditions = []
+    params = []
+    if afterDataID is not None:
+        conditions.append("d.data_id > ?")
+        params.append(afterDataID)
+    if sensorIDs is not None:
+        conditions.append(getInCondition("d.sensorID", sensorIDs, params))
+    if groupingIDs is not None:
+        conditions.append(getInCondition("s.grouping_id", groupingIDs, params))
+    if startTimestamp is not None:
+        conditions.append("d.syncTimestamp >= ?")
+        params.append(startTimestamp)
+    if endTimestamp is not None:
+        conditions.append("d.syncTimestamp <= ?")
+        params.append(endTimestamp)
+    for columnName, value in columnValues.items():
+        if columnName not in joinedDataColumns:
+            print("Oops, that's not a legit column name")
+            raise ValueError(columnName)
+        conditions.append(f"{joinedDataColumns[columnName]} = ?")
+        params.append(value)
     
-def getDataForGrouping(connection, grouping):
-    return getFilteredDataForSpecificValue(connection, "grouping_id", grouping)
+    if isCalibrated:
+        joined_DF = getJoinedCalibratedData_DF(connection, conditions, params, limit)
+    else:
+        joined_DF = pd.read_sql_query(getJoinedDataQuery(conditions, limit), connection, params=params, index_col = "data_id")
+    
+    archive_DF = getJoinedArchiveData_DF(connection, sensorIDs, groupingIDs, startTimestamp, endTimestamp, columnValues, afterDataID, limit, isCalibrated)
+    if archive_DF is not None:
+        joined_DF = concatReadings_DF([archive_DF, joined_DF]).sort_index()
+        if limit is not None:
+            joined_DF = joined_DF.head(limit)
+    
+    return joined_DF
+
+def getAllData_DF(connection):
+    return getJoinedData_DF(connection)
+
+def getFilteredDataForSpecificValue(connection, columnName, value, startTimestamp=None, endTimestamp=None):
+    return getJoinedData_DF(connection, startTimestamp=startTimestamp, endTimestamp=endTimestamp, columnValues={columnName: value})
+
+def getDataForSensor(connection, sensorID, startTimestamp=None, endTimestamp=None):
+    return getJoinedData_DF(connection, sensorIDs=[sensorID], startTimestamp=startTimestamp, endTimestamp=endTimestamp)
+    
+def getDataForGrouping(connection, grouping, startTimestamp=None, endTimestamp=None):
+    return getJoinedData_DF(connection, groupingIDs=[grouping], startTimestamp=startTimestamp, endTimestamp=endTimestamp)
     
 def getUniqueSyncTimestamps(connection):
-    get_syncTimestamps_query = "SELECT syncTimestamp FROM temperature_data"
+    get_syncTimestamps_query = "SELECT syncTimestamp FROM sync_cycles"
     syncTimestamps = pd.read_sql_query(get_syncTimestamps_query, connection)
     syncTimestampsList = syncTimestamps["syncTimestamp"].tolist()
     return set(syncTimestampsList)
+
+def getSyncTimestampCount(connection):
+    return connection.execute("SELECT count(*) FROM sync_cycles").fetchone()[0]
+
+# The following lookups all use the unique index on sync_cycles.syncTimestamp so don't slow down as the history grows
+
+# Most recent n syncTimestamps, newest first
+def getLatestSyncTimestamps(connection, n):
+    rows = connection.execute("SELECT syncTimestamp FROM sync_cycles ORDER BY syncTimestamp DESC LIMIT ?", (n,)).fetchall()
+    return [row[0] for row in rows]
+
+# n = 1 is the latest syncTimestamp, n = 2 the penultimate one etc. Returns None if there aren't n syncTimestamps
+def getNthLatestSyncTimestamp(connection, n):
+    row = connection.execute("SELECT syncTimestamp FROM sync_cycles ORDER BY syncTimestamp DESC LIMIT 1 OFFSET ?", (n - 1,)).fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+def getLatestSyncTimestamp(connection):
+    return getNthLatestSyncTimestamp(connection, 1)
+
+def getPenultimateSyncTimestamp(connection):
+    return getNthLatestSyncTimestamp(connection, 2)
+
+# Returns None if there are no syncTimestamps at all
+def getNearestSyncTimestamp(connection, aTimestamp):
+    before = connection.execute("SELECT max(syncTimestamp) FROM sync_cycles WHERE syncTimestamp <= ?", (aTimestamp,)).fetchone()[0]
+    after = connection.execute("SELECT min(syncTimestamp) FROM sync_cycles WHERE syncTimestamp >= ?", (aTimestamp,)).fetchone()[0]
+    if before is None:
+        return after
+    if after is None:
+        return before
+    if aTimestamp - before <= after - aTimestamp:
+        return before
+    return after
+
+# Complete cycles with readings newer than afterDataID, oldest first. nLatest limits it to the most recent cycles
+def getCompleteCycles_DF(connection, afterDataID=0, nLatest=None):
+    complete_cycles_query = "SELECT cycle_id, syncTimestamp, nReadings, lastDataID FROM sync_cycles WHERE lastDataID > ? AND isComplete = 1"
+    params = [afterDataID]
+    if nLatest is not None:
+        complete_cycles_query = f"SELECT * FROM ({complete_cycles_query} ORDER BY syncTimestamp DESC LIMIT ?)"
+        params.append(nLatest)
+    complete_cycles_query += " ORDER BY syncTimestamp"
+    return pd.read_sql_query(complete_cycles_query, connection, params=params)
+
+# temperature_data rows with data_id greater than afterDataID for the given syncTimestamps
+def getTemperatureDataForSyncTimestamps_DF(connection, syncTimestamps, afterDataID=0):
+    syncTimestamps = list(syncTimestamps)
+    if len(syncTimestamps) == 0:
+        return pd.read_sql_query("SELECT * FROM temperature_data WHERE 0", connection, index_col = "data_id")
     
+    # Read the range and then drop any incomplete cycles in it, there can be too many syncTimestamps to bind
+    temperature_data_query = "SELECT * FROM temperature_data WHERE data_id > ? AND syncTimestamp BETWEEN ? AND ?"
+    temperature_DF = pd.read_sql_query(temperature_data_query, connection, params=(afterDataID, min(syncTimestamps), max(syncTimestamps)), index_col = "data_id")
+    archive_DF = ColdArchive.readArchive_DF(connection, min(syncTimestamps), max(syncTimestamps), afterDataID=afterDataID)
+    if archive_DF is not None:
+        temperature_DF = concatReadings_DF([archive_DF, temperature_DF])
+    return temperature_DF.loc[temperature_DF["syncTimestamp"].isin(syncTimestamps)]
+
 def getTemperatureDataFrameForTimestamp(connection, aTimestamp):
-    uniqueTimestamps = getUniqueSyncTimestamps(connection)
+    nearestTimestamp = getNearestSyncTimestamp(connection, aTimestamp)
         
-    if aTimestamp not in uniqueTimestamps:
-        printString = f"Couldn't find exact timestamp {aTimestamp}"
-        aTimestamp = min(uniqueTimestamps, key=lambda x:abs(x-aTimestamp))
-        printString += f", returning closest one : {aTimestamp}"
-        print(printString)
+    if nearestTimestamp is not None and nearestTimestamp != aTimestamp:
+        print(f"Couldn't find exact timestamp {aTimestamp}, returning closest one : {nearestTimestamp}")
+        aTimestamp = nearestTimestamp
     
     # print("looking up data for timestamp " + str(aTimestamp)) # Debug print
-    temperature_data_query = f"SELECT * FROM temperature_data WHERE \"syncTimestamp\" == {aTimestamp}"
-    temperature_DF = pd.read_sql_query(temperature_data_query, connection, index_col = "data_id")
+    temperature_data_query = "SELECT * FROM temperature_data WHERE syncTimestamp = ?"
+    temperature_DF = pd.read_sql_query(temperature_data_query, connection, params=(aTimestamp,), index_col = "data_id")
+    archive_DF = ColdArchive.readArchive_DF(connection, aTimestamp, aTimestamp)
+    if archive_DF is not None:
+        temperature_DF = concatReadings_DF([archive_DF, temperature_DF])
 
     return temperature_DF
+
+# Each sensor's most recent reading, kept up to date by insertReadings, and how many seconds old it is
+def getLatestReadings_DF(connection):
+    latest_DF = pd.read_sql_query("SELECT * FROM latest_readings", connection)
+    latest_DF["age_sec"] = time.time() - latest_DF["timestamp"]
+    return latest_DF
+
+# Writes the latest readings, with their sensor and grouping names, to a JSON file for dashboards and the like.
+# The file is replaced in one go so readers never see half of it
+def writeLatestReadingsSnapshot(connection, snapshotPath):
+    snapshot_query = """
+    SELECT l.sensorID, l.syncTimestamp, l.timestamp, l.tempDegC, l.ipAddress, s.sensorPrettyName, s.sensorShortName, s.grouping_id, s.flow1_return0, g.groupingPrettyName
+    FROM latest_readings l LEFT JOIN sensors s ON s.sensorID = l.sensorID LEFT JOIN groupings g ON g.grouping_id = s.grouping_id
+    """
+    snapshot_DF = pd.read_sql_query(snapshot_query, connection)
+    snapshotTimestamp = time.time()
+    snapshot_DF["age_sec"] = snapshotTimestamp - snapshot_DF["timestamp"]
+    
+    tempPath = snapshotPath + ".tmp"
+    with open(tempPath, "w") as snapshotFile:
+        snapshotFile.write('{"snapshotTimestamp": ' + repr(snapshotTimestamp) + ', "readings": ')
+        snapshotFile.write(snapshot_DF.to_json(orient="records"))
+        snapshotFile.write("}")
+        snapshotFile.flush()
+        os.fsync(snapshotFile.fileno())
+    os.replace(tempPath, snapshotPath)
+
+upsert_device_status_query = """
+INSERT INTO device_status (ipAddress, lastPollTimestamp, lastSuccessTimestamp, consecutiveFailures, nextPollTimestamp, lastError, lastLatency_sec)
+  VALUES (:ipAddress, :lastPollTimestamp, :lastSuccessTimestamp, :consecutiveFailures, :nextPollTimestamp, :lastError, :lastLatency_sec)
+  ON CONFLICT(ipAddress) DO UPDATE SET
+    lastPollTimestamp = excluded.lastPollTimestamp,
+    lastSuccessTimestamp = excluded.lastSuccessTimestamp,
+    consecutiveFailures = excluded.consecutiveFailures,
+    nextPollTimestamp = excluded.nextPollTimestamp,
+    lastError = excluded.lastError,
+    lastLatency_sec = excluded.lastLatency_sec
+"""
+
+# statuses are dicts with the device_status columns, as returned by CycleScheduler.recordPollResults
+def upsertDeviceStatuses(connection, statuses):
+    with connection:
+        connection.executemany(upsert_device_status_query, statuses)
+
+def getDeviceStatuses(connection):
+    return pd.read_sql_query("SELECT * FROM device_status", connection).to_dict("records")
+
+def recordMissedCycles(connection, firstSyncTimestamp, lastSyncTimestamp, nMissed):
+    with connection:
+        connection.execute("INSERT OR REPLACE INTO missed_cycles (firstSyncTimestamp, lastSyncTimestamp, nMissed, recordedTimestamp) VALUES (?, ?, ?, ?)",
+                           (firstSyncTimestamp, lastSyncTimestamp, nMissed, time.time()))
+
+upsert_sensor_statistics_query = """
+INSERT OR REPLACE INTO sensor_statistics (sensorID, nReadings, lastSyncTimestamp, lastTempDegC, ewmaTempDegC, ewmVarTempDegC, rateDegCPerMin, unchangedSinceSyncTimestamp, unchangedTempDegC, ipAddress)
+  VALUES (:sensorID, :nReadings, :lastSyncTimestamp, :lastTempDegC, :ewmaTempDegC, :ewmVarTempDegC, :rateDegCPerMin, :unchangedSinceSyncTimestamp, :unchangedTempDegC, :ipAddress)
+"""
+upsert_grouping_statistics_query = """
+INSERT OR REPLACE INTO grouping_statistics (grouping_id, nCycles, lastSyncTimestamp, deltaDegC, ewmaDeltaDegC)
+  VALUES (:grouping_id, :nCycles, :lastSyncTimestamp, :deltaDegC, :ewmaDeltaDegC)
+"""
+insert_alert_query = """
+INSERT INTO alerts (alertType, subject, raisedSyncTimestamp, value, message, raisedTimestamp)
+  VALUES (:alertType, :subject, :raisedSyncTimestamp, :value, :message, :raisedTimestamp)
+"""
+
+def getSensorStatistics(connection):
+    return pd.read_sql_query("SELECT * FROM sensor_statistics", connection).to_dict("records")
+
+def getGroupingStatistics(connection):
+    return pd.read_sql_query("SELECT * FROM grouping_statistics", connection).to_dict("records")
+
+def getOpenAlerts(connection):
+    return pd.read_sql_query("SELECT * FROM alerts WHERE clearedSyncTimestamp IS NULL", connection).to_dict("records")
+
+# Statistics rows as dicts with the sensor_statistics and grouping_statistics columns, and the alerts that have been
+# raised or cleared, all in one transaction. Raised alerts get their alert_id filled in
+def saveStatistics(connection, sensorStatistics, groupingStatistics, raisedAlerts, clearedAlerts):
+    with connection:
+        connection.executemany(upsert_sensor_statistics_query, sensorStatistics)
+        connection.executemany(upsert_grouping_statistics_query, groupingStatistics)
+        for alert in raisedAlerts:
+            alert["raisedTimestamp"] = time.time()
+            alert["alert_id"] = connection.execute(insert_alert_query, alert).lastrowid
+        connection.executemany("UPDATE alerts SET clearedSyncTimestamp = ?, clearedTimestamp = ? WHERE alert_id = ?",
+                               [(alert["clearedSyncTimestamp"], time.time(), alert["alert_id"]) for alert in clearedAlerts])
+
+# Aggregates temperature_data rows (a data frame with syncTimestamp, sensorID and tempDegC) into rollup buckets.
+# Like getRollupRowsForReadings, readings without a temperature are left out
+def getRollupRowsForDataFrame(temperature_data_DF, resolution_sec):
+    buckets_DF = temperature_data_DF.dropna(subset=["tempDegC"]).sort_values("syncTimestamp")
+    buckets_DF["bucketTimestamp"] = buckets_DF["syncTimestamp"] - buckets_DF["syncTimestamp"] % resolution_sec
+    aggregated_DF = buckets_DF.groupby(["sensorID", "bucketTimestamp"]).agg(
+        minTempDegC=("tempDegC", "min"),
+        maxTempDegC=("tempDegC", "max"),
+        sumTempDegC=("tempDegC", "sum"),
+        nReadings=("tempDegC", "count"),
+        lastTempDegC=("tempDegC", "last"),
+        lastSyncTimestamp=("syncTimestamp", "max")
+    ).reset_index()
+    aggregated_DF["resolution_sec"] = resolution_sec
+    return aggregated_DF.to_dict("records")
+
+# Fills the rollup tables from the readings that were logged before the rollups existed. Newer readings are
+# rolled up as they're inserted. Each chunk is its own transaction and progress is saved, so this can be
+# stopped and restarted and it can run while the logger is running
+def backfillRollups(connection, chunkSize=100000):
+    cursor = connection.cursor()
+    while True:
+        lastBackfilledDataID, backfillUpToDataID = cursor.execute("SELECT lastBackfilledDataID, backfillUpToDataID FROM rollup_backfill_state").fetchone()
+        if lastBackfilledDataID >= backfillUpToDataID:
+            print("Rollup backfill complete")
+            return
+        
+        chunk_query = "SELECT data_id, syncTimestamp, sensorID, tempDegC FROM temperature_data WHERE data_id > ? AND data_id <= ? ORDER BY data_id LIMIT ?"
+        chunk_DF = pd.read_sql_query(chunk_query, connection, params=(lastBackfilledDataID, backfillUpToDataID, chunkSize))
+        newLastBackfilledDataID = backfillUpToDataID if len(chunk_DF.index) < chunkSize else int(chunk_DF["data_id"].max())
+        
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            for resolution_sec in rollupResolutions_sec:
+                cursor.executemany(upsert_rollup_query, getRollupRowsForDataFrame(chunk_DF, resolution_sec))
+            cursor.execute("UPDATE rollup_backfill_state SET lastBackfilledDataID = ?", (newLastBackfilledDataID,))
+            connection.commit()
+        except Error:
+            connection.rollback()
+            raise
+        print(f"Backfilled rollups up to data_id {newLastBackfilledDataID} of {backfillUpToDataID}")
+
+# Picks the finest resolution that fits within pointBudget points in total. 0 means the raw readings fit.
+# With minPointsPerSensor, picks the coarsest one that still gives each sensor at least that many points instead,
+# so a downsampler has the detail to choose from without reading more than it needs
+def chooseRollupResolution(connection, nSensors, startTimestamp, endTimestamp, pointBudget, minPointsPerSensor=None):
+    if startTimestamp is None or endTimestamp is None:
+        firstTimestamp, lastTimestamp = connection.execute("SELECT min(syncTimestamp), max(syncTimestamp) FROM sync_cycles").fetchone()
+        if firstTimestamp is None:
+            return 0
+        startTimestamp = firstTimestamp if startTimestamp is None else startTimestamp
+        endTimestamp = lastTimestamp if endTimestamp is None else endTimestamp
+    
+    nCycles = connection.execute("SELECT count(*) FROM sync_cycles WHERE syncTimestamp BETWEEN ? AND ?", (startTimestamp, endTimestamp)).fetchone()[0]
+    if minPointsPerSensor is not None:
+        for resolution_sec in sorted(rollupResolutions_sec, reverse=True):
+            nBuckets = math.floor(endTimestamp / resolution_sec) - math.floor(startTimestamp / resolution_sec) + 1
+            if min(nBuckets, nCycles) >= minPointsPerSensor:
+                return resolution_sec
+        return 0
+    
+    if nCycles * nSensors <= pointBudget:
+        return 0
+    
+    for resolution_sec in sorted(rollupResolutions_sec):
+        nBuckets = math.floor(endTimestamp / resolution_sec) - math.floor(startTimestamp / resolution_sec) + 1
+        if min(nBuckets, nCycles) * nSensors <= pointBudget:
+            return resolution_sec
+    return max(rollupResolutions_sec)
+
+# Like getJoinedData_DF but returns at most roughly pointBudget points, read from the finest rollup that fits.
+# tempDegC is the bucket mean and syncTimestamp the start of the bucket. Returns the data frame and the resolution used.
+# See chooseRollupResolution for minPointsPerSensor
+def getRollupData_DF(connection, sensorIDs=None, groupingIDs=None, startTimestamp=None, endTimestamp=None, pointBudget=5000, minPointsPerSensor=None):
+    params = []
+    sensorConditions = []
+    if sensorIDs is not None:
+        sensorConditions.append(getInCondition("s.sensorID", sensorIDs, params))
+    if groupingIDs is not None:
+        sensorConditions.append(getInCondition("s.grouping_id", groupingIDs, params))
+    sensor_count_query = "SELECT count(*) FROM sensors s"
+    if len(sensorConditions) > 0:
+        sensor_count_query += " WHERE " + " AND ".join(sensorConditions)
+    nSensors = connection.execute(sensor_count_query, params).fetchone()[0]
+    
+    resolution_sec = chooseRollupResolution(connection, max(nSensors, 1), startTimestamp, endTimestamp, pointBudget, minPointsPerSensor)
+    
+    if resolution_sec == 0:
+        data_DF = getJoinedData_DF(connection, sensorIDs, groupingIDs, startTimestamp, endTimestamp)
+        data_DF["minTempDegC"] = data_DF["tempDegC"]
+        data_DF["maxTempDegC"] = data_DF["tempDegC"]
+        data_DF["nReadings"] = 1
+        data_DF["lastTempDegC"] = data_DF["tempDegC"]
+        return data_DF, resolution_sec
+    
+    sensorParams = list(params)
+    conditions = ["r.resolution_sec = ?"] + sensorConditions
+    params = [resolution_sec] + params
+    if startTimestamp is not None:
+        conditions.append("r.bucketTimestamp >= ?")
+        params.append(startTimestamp - startTimestamp % resolution_sec)
+    if endTimestamp is not None:
+        conditions.append("r.bucketTimestamp <= ?")
+        params.append(endTimestamp)
+    
+    metadataColumns = [columnName for columnName, qualifiedName in joinedDataColumns.items() if qualifiedName.startswith(("s.", "g.")) and columnName != "sensorID"]
+    rollup_query = "SELECT r.bucketTimestamp AS syncTimestamp, r.sensorID AS sensorID, r.sumTempDegC / r.nReadings AS tempDegC,"
+    rollup_query += " r.minTempDegC AS minTempDegC, r.maxTempDegC AS maxTempDegC, r.nReadings AS nReadings, r.lastTempDegC AS lastTempDegC, "
+    rollup_query += ", ".join(f"{joinedDataColumns[columnName]} AS {columnName}" for columnName in metadataColumns)
+    rollup_query += " FROM temperature_rollups r"
+    rollup_query += " JOIN sensors s ON s.sensorID = r.sensorID"
+    rollup_query += " JOIN groupings g ON g.grouping_id = s.grouping_id"
+    rollup_query += " WHERE " + " AND ".join(conditions)
+    rollup_query += " ORDER BY r.sensorID, r.bucketTimestamp"
+    rollup_DF = pd.read_sql_query(rollup_query, connection, params=params)
+    
+    # Readings from before the rollups existed have none until BackfillRollups.py has done them, so roll those up here
+    lastBackfilledDataID, backfillUpToDataID = connection.execute("SELECT lastBackfilledDataID, backfillUpToDataID FROM rollup_backfill_state").fetchone()
+    if lastBackfilledDataID >= backfillUpToDataID:
+        return rollup_DF, resolution_sec
+    
+    rawConditions = sensorConditions + ["d.data_id > ?", "d.data_id <= ?"]
+    rawParams = sensorParams + [lastBackfilledDataID, backfillUpToDataID]
+    if startTimestamp is not None:
+        rawConditions.append("d.syncTimestamp >= ?")
+        rawParams.append(startTimestamp - startTimestamp % resolution_sec)
+    if endTimestamp is not None:
+        rawConditions.append("d.syncTimestamp < ?")
+        rawParams.append(endTimestamp - endTimestamp % resolution_sec + resolution_sec)
+    raw_DF = pd.read_sql_query(getJoinedDataQuery(rawConditions), connection, params=rawParams)
+    if len(raw_DF.index) == 0:
+        return rollup_DF, resolution_sec
+    
+    # Merge them into any buckets the rollups already have. They were logged before anything that was rolled up, so the last value comes from the rollups
+    rawRollups_DF = pd.DataFrame(getRollupRowsForDataFrame(raw_DF, resolution_sec)).rename(columns={"bucketTimestamp": "syncTimestamp"})
+    buckets_DF = concatReadings_DF([rawRollups_DF, rollup_DF.assign(sumTempDegC=rollup_DF["tempDegC"] * rollup_DF["nReadings"])])
+    buckets_DF = buckets_DF.groupby(["sensorID", "syncTimestamp"]).agg(
+        minTempDegC=("minTempDegC", "min"),
+        maxTempDegC=("maxTempDegC", "max"),
+        sumTempDegC=("sumTempDegC", "sum"),
+        nReadings=("nReadings", "sum"),
+        lastTempDegC=("lastTempDegC", "last")
+    ).reset_index()
+    buckets_DF = buckets_DF.loc[buckets_DF["nReadings"] > 0]
+    buckets_DF["tempDegC"] = buckets_DF["sumTempDegC"] / buckets_DF["nReadings"]
+    sensors_DF = concatReadings_DF([rollup_DF[["sensorID"] + metadataColumns], raw_DF[["sensorID"] + metadataColumns]]).drop_duplicates("sensorID")
+    joined_DF = pd.merge(buckets_DF, sensors_DF, on="sensorID")
+    return joined_DF[list(rollup_DF.columns)].sort_values(["sensorID", "syncTimestamp"]).reset_index(drop=True), resolution_sec
+
+def getCalibrations_DF(connection, sensorIDs=None):
+    params = []
+    calibrations_query = "SELECT * FROM calibrations"
+    if sensorIDs is not None:
+        calibrations_query += " WHERE " + getInCondition("sensorID", sensorIDs, params)
+    return pd.read_sql_query(calibrations_query + " ORDER BY sensorID, validFromTimestamp", connection, params=params)
+
+# Readings (a data frame with syncTimestamp, sensorID and tempDegC) corrected by the calibration each sensor had at the time,
+# as tempDegC * gain + offsetDegC. Adds calibration_id, None where a sensor had no calibration yet
+def applyCalibrations_DF(readings_DF, calibrations_DF):
+    calibrated_DF = readings_DF.copy()
+    calibrated_DF["calibration_id"] = None
+    if len(calibrated_DF.index) == 0 or len(calibrations_DF.index) == 0:
+        return calibrated_DF
+    
+    # merge_asof picks, for each reading, the sensor's latest calibration from before it
+    sorted_DF = calibrated_DF[["syncTimestamp", "sensorID"]].assign(rowNumber=range(len(calibrated_DF.index)), syncTimestamp=calibrated_DF["syncTimestamp"].astype("int64"))
+    sorted_DF = sorted_DF.sort_values("syncTimestamp")
+    versions_DF = calibrations_DF[["sensorID", "validFromTimestamp", "calibration_id", "gain", "offsetDegC"]].astype({"validFromTimestamp": "int64"}).sort_values("validFromTimestamp")
+    merged_DF = pd.merge_asof(sorted_DF, versions_DF, left_on="syncTimestamp", right_on="validFromTimestamp", by="sensorID", direction="backward")
+    merged_DF = merged_DF.sort_values("rowNumber")
+    
+    calibrated_DF["tempDegC"] = calibrated_DF["tempDegC"].to_numpy() * merged_DF["gain"].fillna(1).to_numpy() + merged_DF["offsetDegC"].fillna(0).to_numpy()
+    calibrated_DF["calibration_id"] = merged_DF["calibration_id"].astype(object).where(merged_DF["calibration_id"].notna(), None).to_numpy()
+    return calibrated_DF
+
+# Fills calibrated_readings for readings logged before it existed, newer readings are calibrated as they're inserted.
+# Each chunk is its own transaction and progress is saved, so this can be stopped and restarted while the logger runs
+def backfillCalibratedReadings(connection, chunkSize=100000):
+    cursor = connection.cursor()
+    while True:
+        lastBackfilledDataID, backfillUpToDataID = cursor.execute("SELECT lastBackfilledDataID, backfillUpToDataID FROM calibration_backfill_state").fetchone()
+        if lastBackfilledDataID >= backfillUpToDataID:
+            print("Calibrated readings backfill complete")
+            return
+        
+        newLastBackfilledDataID = min(lastBackfilledDataID + chunkSize, backfillUpToDataID)
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute(calibrate_readings_query + "d.data_id > ? AND d.data_id <= ?", (lastBackfilledDataID, newLastBackfilledDataID))
+            cursor.execute("UPDATE calibration_backfill_state SET lastBackfilledDataID = ?", (newLastBackfilledDataID,))
+            connection.commit()
+        except Error:
+            connection.rollback()
+            raise
+        print(f"Backfilled calibrated readings up to data_id {newLastBackfilledDataID} of {backfillUpToDataID}")
+
+# Recalculates the calibrated readings of sensorIDs from fromTimestamp on, e.g. after their calibrations have changed.
+# Returns the number of readings recalculated
+def recalibrateReadings(connection, sensorIDs, fromTimestamp=0):
+    cursor = connection.cursor()
+    nReadings = 0
+    for sensorID in sensorIDs:
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute(calibrate_readings_query + "d.sensorID = ? AND d.syncTimestamp >= ?", (sensorID, fromTimestamp))
+            nReadings += cursor.rowcount
+            connection.commit()
+        except Error:
+            connection.rollback()
+            raise
+    return nReadings
+
+# Adds calibrations (dicts with sensorID, validFromTimestamp, offsetDegC, gain and optionally method, referenceSensorID
+# and residualDegC). One for the same sensor and validFromTimestamp is replaced. The readings they apply to are recalculated
+def addCalibrations(connection, calibrations):
+    insert_calibration_query = """
+    INSERT OR REPLACE INTO calibrations (sensorID, validFromTimestamp, offsetDegC, gain, method, referenceSensorID, residualDegC, createdTimestamp)
+      VALUES (:sensorID, :validFromTimestamp, :offsetDegC, :gain, :method, :referenceSensorID, :residualDegC, :createdTimestamp)
+    """
+    rows = [{"method": "manual", "referenceSensorID": None, "residualDegC": None, **calibration, "createdTimestamp": time.time()} for calibration in calibrations]
+    with connection:
+        connection.executemany(insert_calibration_query, rows)
+    for row in rows:
+        recalibrateReadings(connection, [row["sensorID"]], row["validFromTimestamp"])
+
+# Removes a calibration, the readings it applied to go back to the one before it, if any
+def deleteCalibration(connection, calibrationID):
+    calibration = connection.execute("SELECT sensorID, validFromTimestamp FROM calibrations WHERE calibration_id = ?", (calibrationID,)).fetchone()
+    if calibration is None:
+        return False
+    with connection:
+        connection.execute("DELETE FROM calibrations WHERE calibration_id = ?", (calibrationID,))
+    recalibrateReadings(connection, [calibration[0]], calibration[1])
+    return True
@@ -0,0 +1,339 @@
+#! /usr/bin/env python3
+
+import sys
+import getopt
+import configparser
+import hashlib
+import html
+import json
+import threading
+import time
+import traceback
+from sqlite3 import Error
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import pandas as pd
+import DBAccess
+import RadiatorSummary
+import CycleNotifier
+
+# Serves the radiator summary, recent readings and device health over HTTP, as JSON for scripts and as a
+# simple web page. Everything is read from the database once per committed cycle (the logger says when, see
+# CycleNotifier.py) into an in-memory cache, and every request is answered from that cache, so however many
+# browsers are open the database sees one reader.
+#   /                   web page with the latest summary and device health
+#   /api/summary        latest radiator summary and any data quality issues
+#   /api/sensors        each sensor's latest reading with its names
+#   /api/devices        device_status rows, plus whether each device is backed off
+#   /api/series         readings from the last historyCycles cycles, {"cursor": n, "sensors": {sensorID: [[syncTimestamp, tempDegC], ...]}}
+#                       ?sensorID=<id> (repeatable) limits it to some sensors, ?since=<cursor> only returns readings
+#                       stored after the response that cursor came from
+#   /api/cycle          the latest complete cycle
+# Responses carry an ETag and Last-Modified, so polling clients get 304 Not Modified until a new cycle arrives
+
+# Settings
+config = configparser.ConfigParser()
+config.read("Radiator_temp_logger.cnf")
+
+def getHelpText():
+    helpText = "\r\n"
+    helpText += "Dashboard.py serves the latest radiator summaries and readings as a web page and JSON\r\n"
+    helpText += "\r\n"
+    helpText += "Options:-\r\n"
+    helpText += "\r\n"
+    helpText += "   -p  :   --port <port>           :   Port to listen on (default dashboardPort in the config, or 8080)\r\n"
+    helpText += "       :   --host <address>        :   Address to listen on (default 127.0.0.1, use 0.0.0.0 for the whole network)\r\n"
+
+    return helpText
+
+def getETag(body):
+    return '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+
+def toRecords(data_DF):
+    # Via to_json so NaN comes out as null
+    return json.loads(data_DF.to_json(orient="records"))
+
+# A rendered response, body as bytes
+class CachedResponse:
+    def __init__(self, body, contentType, lastModified):
+        self.body = body
+        self.contentType = contentType
+        self.lastModified = lastModified
+        self.etag = getETag(body)
+
+# Everything the server knows at one point in time. A new one replaces the old rather than being changed, so
+# request threads never need to wait for a refresh
+class DashboardState:
+    def __init__(self, cycle, readings_DF, responses, lastModified):
+        self.cycle = cycle
+        self.readings_DF = readings_DF
+        self.responses = responses
+        self.lastModified = lastModified
+        self.cursor = 0 if len(readings_DF.index) == 0 else int(readings_DF.index.max())
+        self.seriesResponses = {} # query -> CachedResponse, filled in as requests come in
+        self.seriesLock = threading.Lock()
+
+class DashboardCache:
+    def __init__(self, databasePath, notifySocketPath, historyCycles=1440, refreshTime_sec=60, pageRefresh_sec=60):
+        self.databasePath = databasePath
+        self.notifySocketPath = notifySocketPath
+        self.historyCycles = historyCycles
+        self.refreshTime_sec = refreshTime_sec
+        self.pageRefresh_sec = pageRefresh_sec
+        self.lock = threading.Lock()
+        self.state = None
+        self.isRunning = False
+        self.nRefreshes = 0
+
+    def getState(self):
+        with self.lock:
+            return self.state
+
+    # Reads the cycles committed since the last refresh, or the last historyCycles of them the first time
+    def readNewReadings_DF(self, connection, readings_DF):
+        if readings_DF is None:
+            cycles_DF = DBAccess.getCompleteCycles_DF(connection, nLatest=self.historyCycles)
+            afterDataID = 0
+        else:
+            afterDataID = 0 if len(readings_DF.index) == 0 else int(readings_DF.index.max())
+            cycles_DF = DBAccess.getCompleteCycles_DF(connection, afterDataID)
+
+        if len(cycles_DF.index) == 0:
+            return pd.DataFrame(columns=["syncTimestamp", "timestamp", "sensorID", "tempDegC"], index=pd.Index([], name="data_id")) if readings_DF is None else readings_DF
+
+        newReadings_DF = DBAccess.getTemperatureDataForSyncTimestamps_DF(connection, cycles_DF["syncTimestamp"], afterDataID)[["syncTimestamp", "timestamp", "sensorID", "tempDegC"]]
+        if readings_DF is not None and len(readings_DF.index) > 0:
+            newReadings_DF = pd.concat([readings_DF, newReadings_DF])
+
+        # Only keep the last historyCycles cycles
+        syncTimestamps = newReadings_DF["syncTimestamp"].drop_duplicates().nlargest(self.historyCycles)
+        newReadings_DF = newReadings_DF.loc[newReadings_DF["syncTimestamp"] >= syncTimestamps.min()]
+        return newReadings_DF.sort_index()
+
+    def refresh(self, connection):
+        previousState = self.getState()
+        readings_DF = self.readNewReadings_DF(connection, None if previousState is None else previousState.readings_DF)
+        cycle = CycleNotifier.getLatestCycle(connection)
+        lastModified = time.time()
+
+        groupings_DF = pd.read_sql_query(RadiatorSummary.active_groupings_query, connection)
+        sensors_DF = pd.read_sql_query(RadiatorSummary.active_sensors_query, connection)
+        if cycle is not None:
+            latest_DF = readings_DF.loc[readings_DF["syncTimestamp"] == cycle["syncTimestamp"]]
+        else:
+            latest_DF = readings_DF.iloc[0:0]
+        summary_DF, issues_DF = RadiatorSummary.getRadiatorSummaries_DF(groupings_DF, sensors_DF, latest_DF)
+
+        sensorReadings_DF = pd.read_sql_query("""
+            SELECT l.sensorID, l.syncTimestamp, l.timestamp, l.tempDegC, l.ipAddress, s.sensorPrettyName, s.sensorShortName, s.grouping_id, s.flow1_return0, g.groupingPrettyName
+            FROM latest_readings l LEFT JOIN sensors s ON s.sensorID = l.sensorID LEFT JOIN groupings g ON g.grouping_id = s.grouping_id
+            ORDER BY l.sensorID
+            """, connection)
+
+        devices_DF = pd.DataFrame(DBAccess.getDeviceStatuses(connection), columns=["ipAddress", "lastPollTimestamp", "lastSuccessTimestamp", "consecutiveFailures", "nextPollTimestamp", "lastError", "lastLatency_sec"])
+        devices_DF["isBackedOff"] = (devices_DF["consecutiveFailures"] > 0) & (devices_DF["nextPollTimestamp"].astype("float64") > lastModified)
+
+        summaryColumns = ["grouping_id", "groupingPrettyName", "syncTimestamp", "flowSensorName", "returnSensorName", "flowTemp", "returnTemp", "difference"]
+        bodies = {
+            "/": (self.getPage(cycle, summary_DF, issues_DF, devices_DF), "text/html; charset=utf-8"),
+            "/api/cycle": (json.dumps({"cycle": cycle}), "application/json"),
+            "/api/summary": (json.dumps({"cycle": cycle, "summary": toRecords(summary_DF[summaryColumns]), "issues": toRecords(issues_DF.astype({"syncTimestamp": "float64"}))}), "application/json"),
+            "/api/sensors": (json.dumps({"sensors": toRecords(sensorReadings_DF)}), "application/json"),
+            "/api/devices": (json.dumps({"devices": toRecords(devices_DF)}), "application/json")
+        }
+        responses = {}
+        for path, (body, contentType) in bodies.items():
+            body = body.encode()
+            # Content that hasn't changed keeps its old ETag and Last-Modified
+            if previousState is not None and path in previousState.responses and previousState.responses[path].body == body:
+                responses[path] = previousState.responses[path]
+            else:
+                responses[path] = CachedResponse(body, contentType, lastModified)
+
+        with self.lock:
+            self.state = DashboardState(cycle, readings_DF, responses, lastModified)
+        self.nRefreshes += 1
+
+    def getPage(self, cycle, summary_DF, issues_DF, devices_DF):
+        title = "Radiator temperatures"
+        if cycle is not None:
+            title += " at " + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(cycle["syncTimestamp"]))
+        page = "<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\">"
+        page += f"<meta http-equiv=\"refresh\" content=\"{int(self.pageRefresh_sec)}\">"
+        page += f"<title>{html.escape(title)}</title>"
+        page += "<style>body{font-family:sans-serif} table{border-collapse:collapse} td,th{padding:2px 8px;border-bottom:1px solid #ccc;text-align:left}</style>"
+        page += f"</head><body><h1>{html.escape(title)}</h1>"
+
+        table_DF = summary_DF[["groupingPrettyName", "flowSensorName", "flowTemp", "returnTemp", "difference"]]
+        table_DF.columns = ["Radiator", "Flow sensor", "Flow temp", "Return temp", "Difference"]
+        page += table_DF.to_html(index=False, float_format="{:.1f}".format, na_rep="--")
+        if len(issues_DF.index) > 0:
+            page += "<h2>Data quality issues</h2><ul>"
+            for index, row in issues_DF.iterrows():
+                page += f"<li>{html.escape(row['issue'])} for grouping {html.escape(str(row['groupingPrettyName']))}</li>"
+            page += "</ul>"
+
+        page += "<h2>Devices</h2>"
+        devicesTable_DF = devices_DF[["ipAddress", "consecutiveFailures", "isBackedOff", "lastLatency_sec", "lastError"]]
+        devicesTable_DF.columns = ["Device", "Failures in a row", "Backed off", "Latency (s)", "Last error"]
+        page += devicesTable_DF.to_html(index=False, float_format="{:.3f}".format, na_rep="")
+        page += "</body></html>\n"
+        return page
+
+    # Built from the cached readings, and kept for other clients asking the same thing of the same state
+    def getSeriesResponse(self, state, query):
+        with state.seriesLock:
+            response = state.seriesResponses.get(query)
+        if response is not None:
+            return response
+
+        parameters = parse_qs(query)
+        readings_DF = state.readings_DF
+        if "since" in parameters:
+            readings_DF = readings_DF.loc[readings_DF.index > int(parameters["since"][0])]
+        if "sensorID" in parameters:
+            readings_DF = readings_DF.loc[readings_DF["sensorID"].isin(parameters["sensorID"])]
+
+        readings_DF = readings_DF.dropna(subset=["tempDegC"]).sort_values(["sensorID", "syncTimestamp"])
+        sensors = {sensorID: list(zip(sensorReadings_DF["syncTimestamp"].astype("int64").tolist(), sensorReadings_DF["tempDegC"].tolist())) for sensorID, sensorReadings_DF in readings_DF.groupby("sensorID")}
+        oldestSyncTimestamp = None if len(state.readings_DF.index) == 0 else int(state.readings_DF["syncTimestamp"].min())
+        body = json.dumps({"cursor": state.cursor, "oldestSyncTimestamp": oldestSyncTimestamp, "sensors": sensors}).encode()
+        response = CachedResponse(body, "application/json", state.lastModified)
+
+        with state.seriesLock:
+            # Plenty for the usual handful of distinct queries, and stops odd ones piling up
+            if len(state.seriesResponses) < 100:
+                state.seriesResponses[query] = response
+        return response
+
+    def getResponse(self, path, query):
+        state = self.getState()
+        if state is None:
+            return None
+        if path == "/api/series":
+            return self.getSeriesResponse(state, query)
+        return state.responses.get(path)
+
+    # Refreshes after every committed cycle, and every refreshTime_sec anyway so device health stays current
+    # when no readings are coming in
+    def run(self):
+        connection = DBAccess.create_connection(self.databasePath)
+        cycleSubscriber = None
+        while self.isRunning:
+            # Whatever goes wrong, keep serving what we have and try again next time rather than let the thread die
+            try:
+                if cycleSubscriber is None:
+                    cycleSubscriber = CycleNotifier.CycleSubscriber(connection, self.notifySocketPath)
+                else:
+                    cycleSubscriber.waitForNextCycle(self.refreshTime_sec)
+                if self.isRunning:
+                    self.refresh(connection)
+            except (Error, pd.errors.DatabaseError) as e:
+                print(f"The error '{e}' occurred refreshing the dashboard")
+            except Exception:
+                print("Unexpected error refreshing the dashboard, trying again next time")
+                traceback.print_exc()
+            if cycleSubscriber is None and self.isRunning:
+                time.sleep(self.refreshTime_sec)
+        if cycleSubscriber is not None:
+            cycleSubscriber.close()
+        connection.close()
+
+    def start(self):
+        self.isRunning = True
+        threading.Thread(target=self.run, name="DashboardCache", daemon=True).start()
+
+    def stop(self):
+        self.isRunning = False
+
+class DashboardRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        try:
+            response = self.server.cache.getResponse(url.path, url.query)
+        except ValueError:
+            self.send_error(400, "since should be a cursor from an earlier response")
+            return
+        if response is None:
+            self.send_error(404 if self.server.cache.getState() is not None else 503)
+            return
+
+        if self.isNotModified(response):
+            self.send_response(304)
+            self.send_header("ETag", response.etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", response.contentType)
+        self.send_header("Content-Length", str(len(response.body)))
+        self.send_header("ETag", response.etag)
+        self.send_header("Last-Modified", formatdate(response.lastModified, usegmt=True))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(response.body)
+
+    def isNotModified(self, response):
+        ifNoneMatch = self.headers.get("If-None-Match")
+        if ifNoneMatch is not None:
+            return response.etag in [tag.strip() for tag in ifNoneMatch.split(",")] or ifNoneMatch.strip() == "*"
+        ifModifiedSince = self.headers.get("If-Modified-Since")
+        if ifModifiedSince is not None:
+            try:
+                return int(response.lastModified) <= parsedate_to_datetime(ifModifiedSince).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def log_message(self, format, *args):
+        pass
+
+class DashboardServer:
+    def __init__(self, cache, host="127.0.0.1", port=8080):
+        self.server = ThreadingHTTPServer((host, port), DashboardRequestHandler)
+        self.server.daemon_threads = True
+        self.server.cache = cache
+        threading.Thread(target=self.server.serve_forever, name="DashboardServer", daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+if __name__ == "__main__":
+    databasePath = config["DatabaseSettings"].get("databasePath")
+    notifySocketPath = config["DatabaseSettings"].get("notifySocketPath", CycleNotifier.getDefaultSocketPath(databasePath))
+    querySensorsTime_sec = config["DEFAULT"].getint("querySensorsTime_sec", 60)
+    dashboardSettings = config["DashboardSettings"] if config.has_section("DashboardSettings") else config["DEFAULT"]
+    dashboardHost = dashboardSettings.get("dashboardHost", "127.0.0.1")
+    dashboardPort = dashboardSettings.getint("dashboardPort", 8080)
+    historyCycles = dashboardSettings.getint("historyCycles", 1440)
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hp:", ["port=", "host="])
+    except getopt.GetoptError:
+        print("Dashboard.py options error occured")
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "-h":
+            print(getHelpText())
+            sys.exit()
+        elif opt in ("-p", "--port"):
+            try:
+                dashboardPort = int(arg)
+            except ValueError:
+                print("Please supply a valid port number")
+                sys.exit(2)
+        elif opt == "--host":
+            dashboardHost = arg
+
+    cache = DashboardCache(databasePath, notifySocketPath, historyCycles, refreshTime_sec=querySensorsTime_sec, pageRefresh_sec=querySensorsTime_sec)
+    cache.start()
+    server = DashboardServer(cache, dashboardHost, dashboardPort)
+    print(f"Dashboard at http://{dashboardHost}:{dashboardPort}/")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        cache.stop()
+        server.close()
@@ -0,0 +1,295 @@
+#! /usr/bin/env python3
+
+import configparser
+import getopt
+import json
+import math
+import os
+import shutil
+import sys
+import time
+from sqlite3 import Error, OperationalError
+import CompactStorage
+
+# Keeps the database from growing forever without holding up the logger. Each run does what it can within
+# timeBudget_sec and carries on from where it got to next time:
+#   Retention  readings older than keepReadings_days are deleted, leaving their rollups, and rollups older than
+#              keepRollups_days for their resolution, deleteBatchSize rows per transaction
+#   Vacuum     with auto_vacuum=INCREMENTAL, the space freed is given back to the file system vacuumPagesPerStep
+#              pages at a time, rather than with a VACUUM that locks the database for minutes
+#   ANALYZE    every analyzeEvery_hours, of the tables that keep growing, sampling at most analysisLimit rows of
+#              each index, so the query planner knows how big they have become
+# 0 days keeps that data forever, which is the default for all of them.
+# The logger runs it every maintenanceEvery_sec between cycles, or it can be run on its own with DatabaseMaintenance.py
+
+analysisLimit = 1000
+
+class DatabaseMaintenance:
+    # keepRollups_days is a dictionary of rollup resolution_sec -> days, resolutions not in it are kept forever
+    def __init__(self, keepReadings_days=0, keepRollups_days=None, deleteBatchSize=1000, timeBudget_sec=2,
+                 vacuumPagesPerStep=256, analyzeEvery_hours=24, maintenanceEvery_sec=3600):
+        self.keepReadings_days = keepReadings_days
+        self.keepRollups_days = {int(resolution_sec): days for resolution_sec, days in (keepRollups_days or {}).items()}
+        self.deleteBatchSize = deleteBatchSize
+        self.timeBudget_sec = timeBudget_sec
+        self.vacuumPagesPerStep = vacuumPagesPerStep
+        self.analyzeEvery_hours = analyzeEvery_hours
+        self.maintenanceEvery_sec = maintenanceEvery_sec
+        self.lastRunTimestamp = None
+
+    def isDue(self, connection):
+        if self.maintenanceEvery_sec <= 0:
+            return False
+        if self.lastRunTimestamp is None:
+            self.lastRunTimestamp = connection.execute("SELECT lastRunTimestamp FROM maintenance_state").fetchone()[0]
+        return time.time() - self.lastRunTimestamp >= self.maintenanceEvery_sec
+
+    # Returns what run() did, or None if it isn't time yet
+    def runIfDue(self, connection):
+        if not self.isDue(connection):
+            return None
+        return self.run(connection)
+
+    # What retention deletes, as (description, table, key columns, time column, cutoffTimestamp, condition, params).
+    # The condition is ANDed on to pick just the rows that kind of data applies to
+    def getRetentionTargets(self, connection, now):
+        targets = []
+        if self.keepReadings_days > 0:
+            cutoffTimestamp = int(now - self.keepReadings_days * 86400)
+            # Readings that haven't been rolled up yet are kept until BackfillRollups.py has done them
+            lastBackfilledDataID, backfillUpToDataID = connection.execute("SELECT lastBackfilledDataID, backfillUpToDataID FROM rollup_backfill_state").fetchone()
+            condition, params = "", []
+            if lastBackfilledDataID < backfillUpToDataID:
+                condition, params = " AND data_id <= ?", [lastBackfilledDataID]
+            targets.append(("readings", CompactStorage.getReadingsTableName(connection), "data_id", "syncTimestamp", cutoffTimestamp, condition, params))
+            targets.append(("calibrated readings", "calibrated_readings", "data_id", "syncTimestamp", cutoffTimestamp, condition, params))
+        for resolution_sec, days in sorted(self.keepRollups_days.items()):
+            if days > 0:
+                targets.append((f"{resolution_sec} second rollups", "temperature_rollups", "sensorID, bucketTimestamp", "bucketTimestamp",
+                                int(now - days * 86400), " AND resolution_sec = ?", [resolution_sec]))
+        return targets
+
+    # Deletes up to deleteBatchSize of the oldest rows before cutoffTimestamp in one short transaction
+    def deleteBatch(self, connection, table, keyColumns, timeColumn, cutoffTimestamp, condition, params):
+        oldest_query = f"SELECT {keyColumns} FROM {table} WHERE {timeColumn} < ?{condition} LIMIT ?"
+        delete_query = f"DELETE FROM {table} WHERE ({keyColumns}) IN ({oldest_query}){condition}"
+        cursor = connection.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute(delete_query, [cutoffTimestamp, *params, self.deleteBatchSize, *params])
+            nDeleted = cursor.rowcount
+            connection.commit()
+        except Error:
+            connection.rollback()
+            raise
+        return nDeleted
+
+    # Whole months of archived readings older than the cutoff, see ColdArchive.py
+    def deleteArchivePartition(self, connection, cutoffTimestamp):
+        partition = connection.execute("SELECT partitionName, directory, nRows FROM archive_partitions WHERE lastSyncTimestamp < ? ORDER BY lastSyncTimestamp LIMIT 1", (cutoffTimestamp,)).fetchone()
+        if partition is None:
+            return None
+        partitionName, directory, nRows = partition
+        with connection:
+            connection.execute("DELETE FROM archive_partitions WHERE partitionName = ?", (partitionName,))
+        # Once it's gone from the table nothing reads it, so a failure here just leaves the files behind
+        shutil.rmtree(directory, ignore_errors=True)
+        return nRows
+
+    # Never waits for the write lock for longer than the time left, so a locked database can't stretch a run
+    def limitBusyTimeout(self, connection, deadline):
+        connection.execute(f"PRAGMA busy_timeout = {max(math.ceil((deadline - time.monotonic()) * 1000), 0)}")
+
+    # Returns a dictionary of what was done, with isFinished False if the time ran out before everything was
+    def run(self, connection, timeBudget_sec=None):
+        startTime = time.monotonic()
+        deadline = startTime + (self.timeBudget_sec if timeBudget_sec is None else timeBudget_sec)
+        now = time.time()
+        summary = {"deleted": {}, "nPagesFreed": 0, "isAnalyzed": False, "isFinished": True}
+
+        busyTimeout_ms = connection.execute("PRAGMA busy_timeout").fetchone()[0]
+        try:
+            lastAnalyzeTimestamp = self.runSteps(connection, deadline, now, summary)
+            self.limitBusyTimeout(connection, deadline)
+            with connection:
+                connection.execute("UPDATE maintenance_state SET lastRunTimestamp = ?, lastAnalyzeTimestamp = ?", (now, lastAnalyzeTimestamp))
+        except OperationalError:
+            # Something else held the write lock for the rest of the time
+            if time.monotonic() < deadline:
+                raise
+            summary["isFinished"] = False
+        finally:
+            connection.execute(f"PRAGMA busy_timeout = {busyTimeout_ms}")
+        self.lastRunTimestamp = now
+        summary["runTime_sec"] = time.monotonic() - startTime
+        return summary
+
+    # Retention, vacuum and ANALYZE until the deadline, returns when the tables were last analyzed
+    def runSteps(self, connection, deadline, now, summary):
+        for description, table, keyColumns, timeColumn, cutoffTimestamp, condition, params in self.getRetentionTargets(connection, now):
+            nDeleted = 0
+            while True:
+                if time.monotonic() >= deadline:
+                    summary["isFinished"] = False
+                    break
+                batchStartTime = time.monotonic()
+                self.limitBusyTimeout(connection, deadline)
+                nBatchDeleted = self.deleteBatch(connection, table, keyColumns, timeColumn, cutoffTimestamp, condition, params)
+                nDeleted += nBatchDeleted
+                if nBatchDeleted < self.deleteBatchSize:
+                    break
+                # Give the logger as long to get the write lock as this batch held it for
+                time.sleep(time.monotonic() - batchStartTime)
+            if nDeleted > 0:
+                summary["deleted"][description] = nDeleted
+
+        if self.keepReadings_days > 0:
+            while True:
+                if time.monotonic() >= deadline:
+                    summary["isFinished"] = False
+                    break
+                self.limitBusyTimeout(connection, deadline)
+                nRows = self.deleteArchivePartition(connection, int(now - self.keepReadings_days * 86400))
+                if nRows is None:
+                    break
+                summary["deleted"]["archived readings"] = summary["deleted"].get("archived readings", 0) + nRows
+
+        # Without incremental auto_vacuum freed pages are just reused for new readings
+        if connection.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            nFreePages = connection.execute("PRAGMA freelist_count").fetchone()[0]
+            while nFreePages > 0:
+                if time.monotonic() >= deadline:
+                    summary["isFinished"] = False
+                    break
+                # Each page is freed as a row is stepped through, so all of them have to be fetched
+                self.limitBusyTimeout(connection, deadline)
+                connection.execute(f"PRAGMA incremental_vacuum({int(self.vacuumPagesPerStep)})").fetchall()
+                nStillFreePages = connection.execute("PRAGMA freelist_count").fetchone()[0]
+                summary["nPagesFreed"] += nFreePages - nStillFreePages
+                nFreePages = nStillFreePages
+
+        lastAnalyzeTimestamp = connection.execute("SELECT lastAnalyzeTimestamp FROM maintenance_state").fetchone()[0]
+        if self.analyzeEvery_hours > 0 and now - lastAnalyzeTimestamp >= self.analyzeEvery_hours * 3600:
+            if time.monotonic() >= deadline:
+                summary["isFinished"] = False
+            else:
+                # Stops ANALYZE, which then changes nothing, if it would go over the time left
+                self.limitBusyTimeout(connection, deadline)
+                connection.set_progress_handler(lambda: time.monotonic() >= deadline, 10000)
+                try:
+                    connection.execute(f"PRAGMA analysis_limit = {analysisLimit}")
+                    for table in getAnalyzedTables(connection):
+                        connection.execute(f"ANALYZE {table}")
+                    summary["isAnalyzed"] = True
+                    lastAnalyzeTimestamp = now
+                except OperationalError:
+                    if time.monotonic() < deadline:
+                        raise
+                    summary["isFinished"] = False
+                finally:
+                    connection.set_progress_handler(None, 0)
+        return lastAnalyzeTimestamp
+
+# Only the tables that keep growing. With statistics for the small sensors and groupings tables as well, the planner
+# starts joins from them and sorts the result, which made reading the readings a chunk at a time four times slower
+def getAnalyzedTables(connection):
+    return [CompactStorage.getReadingsTableName(connection), "calibrated_readings", "temperature_rollups", "sync_cycles"]
+
+def getSummaryText(summary):
+    done = [f"deleted {nDeleted} {description}" for description, nDeleted in summary["deleted"].items()]
+    if summary["nPagesFreed"] > 0:
+        done.append(f"gave back {summary['nPagesFreed']} pages")
+    if summary["isAnalyzed"]:
+        done.append("analyzed the tables")
+    summaryText = "Database maintenance " + (", ".join(done) if len(done) > 0 else "had nothing to do")
+    summaryText += f" in {summary['runTime_sec']:.2f} seconds"
+    if not summary["isFinished"]:
+        summaryText += ", out of time so the rest will be done next time"
+    return summaryText
+
+# Settings from the MaintenanceSettings section of the config, or its DEFAULT section for older config files
+def getDatabaseMaintenance(maintenanceSettings):
+    return DatabaseMaintenance(maintenanceSettings.getfloat("keepReadings_days", 0),
+                               json.loads(maintenanceSettings.get("keepRollups_days", "{}")),
+                               maintenanceSettings.getint("deleteBatchSize", 1000),
+                               maintenanceSettings.getfloat("timeBudget_sec", 2),
+                               maintenanceSettings.getint("vacuumPagesPerStep", 256),
+                               maintenanceSettings.getfloat("analyzeEvery_hours", 24),
+                               maintenanceSettings.getfloat("maintenanceEvery_sec", 3600))
+
+def getHelpText():
+    helpText = "\r\n"
+    helpText += "DatabaseMaintenance.py deletes data older than the retention settings in Radiator_temp_logger.cnf, gives the space\r\n"
+    helpText += "back to the file system and updates the query planner's statistics. It's safe to run while the logger is running\r\n"
+    helpText += "\r\n"
+    helpText += "Options:-\r\n"
+    helpText += "\r\n"
+    helpText += "   -b  :   --budget <sec>          :   Stop after this many seconds (default timeBudget_sec)\r\n"
+    helpText += "   -a  :   --all                   :   Keep going, a time budget at a time, until everything is done\r\n"
+    helpText += "       :   --analyze               :   Update the query planner's statistics even if it isn't time to\r\n"
+    helpText += "       :   --enableIncrementalVacuum   Switch an existing database to auto_vacuum=INCREMENTAL. This rebuilds the\r\n"
+    helpText += "                                       database file once, which needs as much free disk space again as the\r\n"
+    helpText += "                                       database, and the logger waits until it's done\r\n"
+
+    return helpText
+
+if __name__ == "__main__":
+    import DBAccess
+    import CreateDBTables
+
+    timeBudget_sec = None
+    isRunningToEnd = False
+    isAnalyzing = False
+    isEnablingIncrementalVacuum = False
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hb:a", ["budget=", "all", "analyze", "enableIncrementalVacuum"])
+    except getopt.GetoptError:
+        print("DatabaseMaintenance.py options error occured")
+        sys.exit(2)
+    try:
+        for opt, arg in opts:
+            if opt == "-h":
+                print(getHelpText())
+                sys.exit()
+            elif opt in ("-b", "--budget"):
+                timeBudget_sec = float(arg)
+            elif opt in ("-a", "--all"):
+                isRunningToEnd = True
+            elif opt == "--analyze":
+                isAnalyzing = True
+            elif opt == "--enableIncrementalVacuum":
+                isEnablingIncrementalVacuum = True
+    except ValueError as e:
+        print(e)
+        print("Please supply a number of seconds for the budget")
+        sys.exit(2)
+
+    config = configparser.ConfigParser()
+    config.read("Radiator_temp_logger.cnf")
+    databasePath = config["DatabaseSettings"].get("databasePath")
+    busyTimeout_sec = config["DatabaseSettings"].getfloat("busyTimeout_sec", 60)
+    maintenanceSettings = config["MaintenanceSettings"] if config.has_section("MaintenanceSettings") else config["DEFAULT"]
+
+    connection = DBAccess.create_connection(databasePath)
+    connection.execute(f"PRAGMA busy_timeout={int(busyTimeout_sec * 1000)}")
+    CreateDBTables.upgradeDatabase(connection)
+    databaseMaintenance = getDatabaseMaintenance(maintenanceSettings)
+
+    if isEnablingIncrementalVacuum:
+        sizeBefore = os.path.getsize(databasePath)
+        connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        connection.execute("VACUUM")
+        print(f"Database file went from {sizeBefore / 1e6:.1f} MB to {os.path.getsize(databasePath) / 1e6:.1f} MB")
+    elif connection.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        print("The database doesn't use incremental vacuum, so space freed is reused but the file won't shrink. See --enableIncrementalVacuum")
+
+    if isAnalyzing:
+        with connection:
+            connection.execute("UPDATE maintenance_state SET lastAnalyzeTimestamp = 0")
+
+    while True:
+        summary = databaseMaintenance.run(connection, timeBudget_sec)
+        print(getSummaryText(summary))
+        if summary["isFinished"] or not isRunningToEnd:
+            break
@@ -0,0 +1,109 @@
+#! /usr/bin/env python3
+
+import json
+import math
+import time
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+
+# response is the decoded JSON list from the NodeMCU, less any entries that aren't a sensor reading, or None if the
+# poll failed, in which case error says why and errorType is one of timeout, connection, http, request, malformed, deadline or busy.
+# latency_sec is the time taken by the HTTP request and parse_sec the time taken to decode the JSON
+PollResult = namedtuple("PollResult", ["ipAddress", "response", "error", "latency_sec", "timestamp", "parse_sec", "errorType"], defaults=[0.0, None])
+
+logger = logging.getLogger("DevicePoller")
+
+# Each entry should be {"SensorID": "28...", "TempDegC": 21.5}, with TempDegC null for a failed read
+def isValidEntry(entry):
+    if not isinstance(entry, dict) or "TempDegC" not in entry:
+        return False
+    sensorID = entry.get("SensorID")
+    tempDegC = entry["TempDegC"]
+    if not isinstance(sensorID, str) or sensorID == "":
+        return False
+    return tempDegC is None or (isinstance(tempDegC, (int, float)) and not isinstance(tempDegC, bool) and math.isfinite(tempDegC))
+
+def getErrorType(e):
+    if isinstance(e, requests.exceptions.Timeout):
+        return "timeout"
+    if isinstance(e, requests.exceptions.ConnectionError):
+        return "connection"
+    if isinstance(e, requests.exceptions.HTTPError):
+        return "http"
+    return "request"
+
+class DevicePoller:
+    # Polls all NodeMCUs at once using a bounded thread pool so that a cycle takes about as long as the slowest device
+    def __init__(self, deviceTimeout_sec=5, cycleDeadline_sec=30, maxWorkers=16):
+        self.deviceTimeout_sec = deviceTimeout_sec
+        self.cycleDeadline_sec = cycleDeadline_sec
+        self.executor = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix="DevicePoller")
+        self.sessions = {} # One keep-alive session per device, only ever used by one thread at a time
+        self.inFlight = {} # Polls that overran the cycle deadline and haven't finished yet
+
+    def getSession(self, ipAddress):
+        session = self.sessions.get(ipAddress)
+        if session is None:
+            session = requests.Session()
+            session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0))
+            self.sessions[ipAddress] = session
+        return session
+
+    def pollDevice(self, ipAddress):
+        startTime = time.monotonic()
+        try:
+            r = self.getSession(ipAddress).get("http://" + ipAddress, timeout=self.deviceTimeout_sec)
+            r.raise_for_status()
+            body = r.text
+        except RequestException as e:
+            return PollResult(ipAddress, None, f"Failed to read IP address {ipAddress} : {e}", time.monotonic() - startTime, time.time(), errorType=getErrorType(e))
+
+        latency_sec = time.monotonic() - startTime
+        try:
+            response = json.loads(body)
+        except ValueError as e:
+            return PollResult(ipAddress, None, f"Malformed response from IP address {ipAddress} : {e}", latency_sec, time.time(), time.monotonic() - startTime - latency_sec, "malformed")
+
+        # Valid JSON can still be the wrong shape, e.g. an error object from a half updated device
+        if not isinstance(response, list):
+            return PollResult(ipAddress, None, f"Malformed response from IP address {ipAddress} : expected a list of sensors, got {type(response).__name__}", latency_sec, time.time(), time.monotonic() - startTime - latency_sec, "malformed")
+        validResponse = [entry for entry in response if isValidEntry(entry)]
+        if len(validResponse) < len(response):
+            if len(validResponse) == 0:
+                return PollResult(ipAddress, None, f"Malformed response from IP address {ipAddress} : none of its {len(response)} entries is a sensor reading", latency_sec, time.time(), time.monotonic() - startTime - latency_sec, "malformed")
+            logger.warning("Dropped %d of %d entries from IP address %s that aren't a sensor reading", len(response) - len(validResponse), len(response), ipAddress)
+
+        return PollResult(ipAddress, validResponse, None, latency_sec, time.time(), time.monotonic() - startTime - latency_sec)
+
+    def pollDevices(self, ipAddresses):
+        # Returns one PollResult per IP address, in the same order as ipAddresses
+        results = {}
+        futures = {}
+        for ipAddress in ipAddresses:
+            previousPoll = self.inFlight.get(ipAddress)
+            if previousPoll is not None and not previousPoll.done():
+                # Don't stack up requests to a device that still hasn't answered the last one
+                results[ipAddress] = PollResult(ipAddress, None, f"Previous poll of IP address {ipAddress} still in progress", 0.0, time.time(), errorType="busy")
+                continue
+            futures[ipAddress] = self.executor.submit(self.pollDevice, ipAddress)
+
+        wait(futures.values(), timeout=self.cycleDeadline_sec)
+
+        for ipAddress, future in futures.items():
+            if future.done():
+                self.inFlight.pop(ipAddress, None)
+                results[ipAddress] = future.result()
+            else:
+                self.inFlight[ipAddress] = future
+                results[ipAddress] = PollResult(ipAddress, None, f"IP address {ipAddress} missed the cycle deadline of {self.cycleDeadline_sec} seconds", self.cycleDeadline_sec, time.time(), errorType="deadline")
+
+        return [results[ipAddress] for ipAddress in ipAddresses]
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        for session in self.sessions.values():
+            session.close()
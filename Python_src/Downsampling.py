@@ -0,0 +1,71 @@
+#! /usr/bin/env python3
+
+import numpy as np
+import pandas as pd
+
+# Cuts a series down to a given number of points while keeping its shape, so years of readings can be drawn
+# without handing millions of points to matplotlib. Both methods return the indices of the points to keep,
+# in order, and always keep the first and last point.
+#   lttb    Largest Triangle Three Buckets: one point per bucket, picked to keep the line looking the same
+#   minmax  the lowest and highest point in each bucket, so no spike or dip is lost
+
+downsamplingMethods = ["lttb", "minmax", "none"]
+
+def getBucketEdges(nValues, nBuckets):
+    return np.linspace(1, nValues - 1, nBuckets + 1).astype(np.int64)
+
+def lttbIndices(x, y, nPoints):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    nValues = len(x)
+    if nPoints >= nValues or nPoints < 3:
+        return np.arange(nValues)
+
+    # First and last points are kept, the rest are split evenly into nPoints - 2 buckets
+    edges = getBucketEdges(nValues, nPoints - 2)
+    indices = np.empty(nPoints, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = nValues - 1
+
+    # Each bucket is compared against the average of the one after it, and the last bucket against the last point
+    bucketSizes = np.diff(edges)
+    averageXs = np.append(np.add.reduceat(x[:-1], edges[:-1]) / bucketSizes, x[-1])[1:]
+    averageYs = np.append(np.add.reduceat(y[:-1], edges[:-1]) / bucketSizes, y[-1])[1:]
+
+    previousIndex = 0
+    for bucket in range(nPoints - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        # Twice the area of the triangle made with the previous kept point and the next bucket's average
+        previousX, previousY = x[previousIndex], y[previousIndex]
+        areas = np.abs((previousX - averageXs[bucket]) * (y[start:end] - previousY) - (previousX - x[start:end]) * (averageYs[bucket] - previousY))
+        previousIndex = start + int(areas.argmax())
+        indices[bucket + 1] = previousIndex
+
+    return indices
+
+def minMaxIndices(x, y, nPoints):
+    x = np.asarray(x, dtype=np.float64)
+    nValues = len(x)
+    if nPoints >= nValues or nPoints < 4:
+        return np.arange(nValues)
+
+    # Equal slices of time, like the pixel columns of the plot, two points from each
+    nBuckets = nPoints // 2
+    span = x[-1] - x[0]
+    buckets = np.zeros(nValues, dtype=np.int64) if span == 0 else np.minimum(((x - x[0]) / span * nBuckets).astype(np.int64), nBuckets - 1)
+    grouped = pd.Series(np.asarray(y, dtype=np.float64)).groupby(buckets)
+    indices = np.concatenate([[0], grouped.idxmin().to_numpy(), grouped.idxmax().to_numpy(), [nValues - 1]])
+    return np.unique(indices)
+
+# Downsamples each series in data_DF (one per seriesColumn value, e.g. sensorID) to at most about pointBudget points
+def downsample_DF(data_DF, xColumn, yColumn, seriesColumn, pointBudget, method="lttb"):
+    if method not in downsamplingMethods:
+        raise ValueError(f"Unknown downsampling method {method}, should be one of {downsamplingMethods}")
+    if method == "none" or len(data_DF.index) == 0:
+        return data_DF
+
+    indexFunction = lttbIndices if method == "lttb" else minMaxIndices
+    series_DFs = []
+    for seriesName, series_DF in data_DF.sort_values([seriesColumn, xColumn]).groupby(seriesColumn, sort=False):
+        series_DFs.append(series_DF.iloc[indexFunction(series_DF[xColumn].to_numpy(), series_DF[yColumn].to_numpy(), pointBudget)])
+    return pd.concat(series_DFs)
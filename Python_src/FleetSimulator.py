@@ -0,0 +1,276 @@
+#! /usr/bin/env python3
+
+import sys
+import getopt
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Stands in for any number of NodeMCUs running WS_TemperatureReading, all from one process, so the logger can be
+# load and fault tested without hardware. Each simulated device listens on its own port (or its own 127.x.x.x
+# address) and answers GET / with the same JSON as the real thing, e.g. [{"SensorID":"28...","TempDegC":21.5}]
+#
+# How each device misbehaves is set with these settings, either for the whole fleet or per device:
+#   latency_sec, latencyJitter_sec  time taken to answer, uniformly spread by +/- the jitter
+#   timeoutFraction, hangTime_sec   fraction of requests that hang for hangTime_sec before answering
+#   refuseFraction, offlineTime_sec fraction of requests where the device drops the connection and then goes offline,
+#                                   refusing connections for offlineTime_sec
+#   malformedFraction               fraction of requests answered with a body that isn't valid JSON
+#   notFoundFraction                fraction of requests answered with 404 "No Sensors found", as a device with no sensors does
+#   churnFraction                   fraction of requests where a sensor disappears or a new one appears
+
+defaultDeviceSettings = {
+    "latency_sec": 0.05,
+    "latencyJitter_sec": 0.02,
+    "timeoutFraction": 0.0,
+    "hangTime_sec": 30.0,
+    "refuseFraction": 0.0,
+    "offlineTime_sec": 10.0,
+    "malformedFraction": 0.0,
+    "notFoundFraction": 0.0,
+    "churnFraction": 0.0
+}
+
+faultStats = {"timeoutFraction": "nTimeouts", "refuseFraction": "nRefused", "malformedFraction": "nMalformed", "notFoundFraction": "nNotFound"}
+
+malformedBodies = [
+    b'[{"SensorID":"28ff000000000000","TempDegC":2',
+    b"<html><body>Internal error</body></html>",
+    b"",
+    b"\xff\xfe\x00garbage"
+]
+
+def getHelpText():
+    helpText = "\r\n"
+    helpText += "FleetSimulator.py simulates many NodeMCU temperature sensing devices on this computer\r\n"
+    helpText += "\r\n"
+    helpText += "Options:-\r\n"
+    helpText += "\r\n"
+    helpText += "   -n  :   --devices <n>           :   Number of devices (default 10)\r\n"
+    helpText += "   -s  :   --sensors <n>           :   Sensors per device (default 2)\r\n"
+    helpText += "       :   --basePort <port>       :   Port of the first device, the rest follow on (default 18000)\r\n"
+    helpText += "       :   --loopback              :   Give each device its own 127.x.x.x address on basePort instead (Linux only)\r\n"
+    helpText += "       :   --profile <file>        :   JSON file of settings, {\"default\": {...}, \"devices\": {\"0\": {...}}}\r\n"
+    helpText += "       :   --latency <sec>         :   Time each device takes to answer\r\n"
+    helpText += "       :   --timeouts <fraction>   :   Fraction of requests that hang\r\n"
+    helpText += "       :   --refusals <fraction>   :   Fraction of requests after which the device goes offline for a while\r\n"
+    helpText += "       :   --malformed <fraction>  :   Fraction of requests answered with invalid JSON\r\n"
+    helpText += "       :   --churn <fraction>      :   Fraction of requests where a sensor comes or goes\r\n"
+    helpText += "       :   --seed <n>              :   Random seed (default 0)\r\n"
+
+    return helpText
+
+class DeviceRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.device.handleRequest(self)
+
+    def log_message(self, format, *args):
+        pass # Hundreds of devices would drown the console
+
+class SimulatedDevice:
+    def __init__(self, deviceIndex, host, port, nSensors, settings, seed):
+        self.deviceIndex = deviceIndex
+        self.host = host
+        self.port = port
+        self.settings = settings
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.server = None
+        self.isRunning = False
+        self.nSensorsCreated = 0
+        self.temperatures = {}
+        for sensorNumber in range(nSensors):
+            self.addSensor()
+        self.stats = {"nRequests": 0, "nTimeouts": 0, "nRefused": 0, "nMalformed": 0, "nNotFound": 0, "nChurned": 0}
+
+    def getIPAddress(self):
+        return f"{self.host}:{self.port}"
+
+    def addSensor(self):
+        sensorID = f"28{self.deviceIndex:06x}{self.nSensorsCreated:08x}"
+        self.nSensorsCreated += 1
+        self.temperatures[sensorID] = self.random.uniform(18, 60)
+
+    def startServer(self):
+        self.server = ThreadingHTTPServer((self.host, self.port), DeviceRequestHandler)
+        self.server.daemon_threads = True
+        self.server.device = self
+        threading.Thread(target=self.server.serve_forever, name=f"Device{self.deviceIndex}", daemon=True).start()
+
+    def stopServer(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def start(self):
+        self.isRunning = True
+        self.startServer()
+
+    def stop(self):
+        self.isRunning = False
+        self.stopServer()
+
+    # Stops listening, so connections are refused, and comes back after offlineTime_sec
+    def goOffline(self):
+        self.stopServer()
+        time.sleep(self.settings["offlineTime_sec"])
+        if self.isRunning:
+            self.startServer()
+
+    def chooseFault(self):
+        roll = self.random.random()
+        for fault in ["timeoutFraction", "refuseFraction", "malformedFraction", "notFoundFraction"]:
+            if roll < self.settings[fault]:
+                return fault
+            roll -= self.settings[fault]
+        return None
+
+    def getResponseBody(self):
+        if self.random.random() < self.settings["churnFraction"]:
+            self.stats["nChurned"] += 1
+            if len(self.temperatures) > 1 and self.random.random() < 0.5:
+                del self.temperatures[self.random.choice(list(self.temperatures))]
+            else:
+                self.addSensor()
+
+        # Wander about in DS18B20 sized steps
+        for sensorID in self.temperatures:
+            self.temperatures[sensorID] = min(max(self.temperatures[sensorID] + self.random.gauss(0, 0.2), 10), 80)
+        response = [{"SensorID": sensorID, "TempDegC": round(temperature * 16) / 16} for sensorID, temperature in self.temperatures.items()]
+        return json.dumps(response).encode()
+
+    def handleRequest(self, handler):
+        with self.lock:
+            self.stats["nRequests"] += 1
+            fault = self.chooseFault()
+            if fault is not None:
+                self.stats[faultStats[fault]] += 1
+            latency_sec = max(0, self.settings["latency_sec"] + self.random.uniform(-1, 1) * self.settings["latencyJitter_sec"])
+            if fault is None or fault == "timeoutFraction":
+                body = self.getResponseBody()
+            elif fault == "malformedFraction":
+                body = self.random.choice(malformedBodies)
+
+        if fault == "timeoutFraction":
+            latency_sec = self.settings["hangTime_sec"]
+        time.sleep(latency_sec)
+
+        if fault == "refuseFraction":
+            handler.close_connection = True
+            threading.Thread(target=self.goOffline, daemon=True).start()
+            return
+        if fault == "notFoundFraction":
+            body = b"No Sensors found"
+            handler.send_response(404)
+            handler.send_header("Content-Type", "text/plain")
+        else:
+            handler.send_response(200)
+            handler.send_header("Content-Type", "text/json")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        try:
+            handler.wfile.write(body)
+        except OSError:
+            pass # Poller gave up waiting
+
+class FleetSimulator:
+    # deviceSettings maps a device index to the settings that differ from settings for that device
+    def __init__(self, nDevices, sensorsPerDevice=2, host="127.0.0.1", basePort=18000, useLoopbackAddresses=False, settings=None, deviceSettings=None, seed=0):
+        settings = {**defaultDeviceSettings, **(settings or {})}
+        deviceSettings = deviceSettings or {}
+        self.devices = []
+        for deviceIndex in range(nDevices):
+            if useLoopbackAddresses:
+                deviceHost = f"127.{(deviceIndex + 1) // 65536 % 256}.{(deviceIndex + 1) // 256 % 256}.{(deviceIndex + 1) % 256}"
+                devicePort = basePort
+            else:
+                deviceHost = host
+                devicePort = basePort + deviceIndex
+            self.devices.append(SimulatedDevice(deviceIndex, deviceHost, devicePort, sensorsPerDevice,
+                                                {**settings, **deviceSettings.get(deviceIndex, {})}, seed * 1000003 + deviceIndex))
+
+    def start(self):
+        for device in self.devices:
+            device.start()
+
+    def stop(self):
+        for device in self.devices:
+            device.stop()
+
+    def getIPAddresses(self):
+        return [device.getIPAddress() for device in self.devices]
+
+    def getStats(self):
+        totals = {}
+        for device in self.devices:
+            for key, value in device.stats.items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+def readProfile(profilePath):
+    with open(profilePath) as profileFile:
+        profile = json.load(profileFile)
+    deviceSettings = {int(deviceIndex): settings for deviceIndex, settings in profile.get("devices", {}).items()}
+    return profile.get("default", {}), deviceSettings
+
+if __name__ == "__main__":
+    nDevices = 10
+    sensorsPerDevice = 2
+    basePort = 18000
+    useLoopbackAddresses = False
+    settings = {}
+    deviceSettings = {}
+    seed = 0
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:s:", ["devices=", "sensors=", "basePort=", "loopback", "profile=", "latency=", "timeouts=", "refusals=", "malformed=", "churn=", "seed="])
+    except getopt.GetoptError:
+        print("FleetSimulator.py options error occured")
+        sys.exit(2)
+    try:
+        for opt, arg in opts:
+            if opt == "-h":
+                print(getHelpText())
+                sys.exit()
+            elif opt in ("-n", "--devices"):
+                nDevices = int(arg)
+            elif opt in ("-s", "--sensors"):
+                sensorsPerDevice = int(arg)
+            elif opt == "--basePort":
+                basePort = int(arg)
+            elif opt == "--loopback":
+                useLoopbackAddresses = True
+            elif opt == "--profile":
+                profileSettings, deviceSettings = readProfile(arg)
+                settings = {**profileSettings, **settings}
+            elif opt == "--latency":
+                settings["latency_sec"] = float(arg)
+            elif opt == "--timeouts":
+                settings["timeoutFraction"] = float(arg)
+            elif opt == "--refusals":
+                settings["refuseFraction"] = float(arg)
+            elif opt == "--malformed":
+                settings["malformedFraction"] = float(arg)
+            elif opt == "--churn":
+                settings["churnFraction"] = float(arg)
+            elif opt == "--seed":
+                seed = int(arg)
+    except ValueError as e:
+        print(e)
+        print("Please supply numbers for counts, times and fractions")
+        sys.exit(2)
+
+    fleet = FleetSimulator(nDevices, sensorsPerDevice, basePort=basePort, useLoopbackAddresses=useLoopbackAddresses, settings=settings, deviceSettings=deviceSettings, seed=seed)
+    fleet.start()
+    print("Simulating " + str(nDevices) + " devices, for Radiator_temp_logger.cnf use")
+    print("ipAddresses = " + json.dumps(fleet.getIPAddresses()))
+
+    try:
+        while True:
+            time.sleep(10)
+            print(fleet.getStats())
+    except KeyboardInterrupt:
+        fleet.stop()
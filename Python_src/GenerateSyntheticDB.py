@@ -0,0 +1,217 @@
+#! /usr/bin/env python3
+
+import sys
+import os
+import getopt
+import time
+import numpy as np
+import pandas as pd
+import DBAccess
+import CreateDBTables
+
+# Builds a database of made up but realistic looking data, for trying the tools out at scale.
+# Each grouping is a radiator on its own NodeMCU. The boiler runs twice a day and the flow temperature of each
+# radiator follows it with a lag, scaled by how far its valve is open. Return temperatures follow the flow.
+# Readings are rounded to the 1/16 degree steps of a DS18B20. Devices drop out for a while now and then, single
+# readings go missing, some are reported twice and the odd one is the -127 a DS18B20 gives when it can't be read
+
+def getHelpText():
+    helpText = "\r\n"
+    helpText += "GenerateSyntheticDB.py creates a new database filled with synthetic data\r\n"
+    helpText += "\r\n"
+    helpText += "Options:-\r\n"
+    helpText += "\r\n"
+    helpText += "   -o  :   --output <file>         :   Database to create, must not already exist\r\n"
+    helpText += "   -g  :   --groupings <n>         :   Number of radiators (default 10)\r\n"
+    helpText += "   -s  :   --sensors <n>           :   Sensors per radiator, a flow, a return and the rest room sensors (default 2)\r\n"
+    helpText += "   -c  :   --cycles <n>            :   Number of logging cycles (default 10000)\r\n"
+    helpText += "       :   --cycleTime <sec>       :   Seconds between cycles (default 60)\r\n"
+    helpText += "       :   --start <time>          :   Unix timestamp of the first cycle (default, so the last cycle is now)\r\n"
+    helpText += "       :   --gaps <fraction>       :   Fraction of readings lost to device outages and dropouts (default 0.02)\r\n"
+    helpText += "       :   --duplicates <fraction> :   Fraction of readings reported twice (default 0.001)\r\n"
+    helpText += "       :   --errors <fraction>     :   Fraction of readings that are -127 (default 0.0005)\r\n"
+    helpText += "       :   --seed <n>              :   Random seed, the same seed gives the same database (default 0)\r\n"
+
+    return helpText
+
+sensorErrorTemp = -127.0
+roomTemp = 18.0
+boilerFlowTemp = 65.0
+boilerTimeConstant_sec = 900
+heatingPeriods_hours = [(6, 9), (17, 22)]
+outageLength_cycles = 30
+cyclesPerInsert = 500
+
+def getSensorID(rng):
+    return "28" + "".join(rng.choice(list("0123456789abcdef"), 14))
+
+def getSensors_DF(rng, nGroupings, sensorsPerGrouping):
+    sensors = []
+    for groupingID in range(1, nGroupings + 1):
+        for sensorNumber in range(sensorsPerGrouping):
+            if sensorNumber == 0:
+                role, flow1_return0 = "flow", 1
+            elif sensorNumber == 1:
+                role, flow1_return0 = "return", 0
+            else:
+                role, flow1_return0 = f"room{sensorNumber - 1}", -1
+            sensors.append({
+                "sensorID": getSensorID(rng),
+                "sensorPrettyName": f"Radiator{groupingID:03d}_{role}",
+                "sensorShortName": f"{groupingID:03d}{role[0].upper()}",
+                "isSensorActiveBool": 1,
+                "grouping_id": groupingID,
+                "flow1_return0": flow1_return0,
+                "calibrationCorrection": 0.0
+            })
+    return pd.DataFrame(sensors)
+
+# Boiler flow temperature at each syncTimestamp, heating towards boilerFlowTemp when on and cooling to room temperature when off
+def getBoilerTemps(syncTimestamps, cycleTime_sec):
+    hourOfDay = (syncTimestamps % 86400) / 3600.0
+    isHeating = np.zeros(len(syncTimestamps), dtype=bool)
+    for startHour, endHour in heatingPeriods_hours:
+        isHeating |= (hourOfDay >= startHour) & (hourOfDay < endHour)
+    targetTemps = np.where(isHeating, boilerFlowTemp, roomTemp)
+    alpha = 1 - np.exp(-cycleTime_sec / boilerTimeConstant_sec)
+    return pd.Series(targetTemps).ewm(alpha=alpha, adjust=False).mean().to_numpy()
+
+# True for each cycle a device is offline, outages start at random and last about outageLength_cycles
+def getOutages(rng, nCycles, outageFraction):
+    outageStarts = rng.random(nCycles) < outageFraction / outageLength_cycles
+    return np.convolve(outageStarts, np.ones(outageLength_cycles, dtype=int))[:nCycles] > 0
+
+# One row per reading, in the order the logger would have written them
+def getReadings_DF(rng, sensors_DF, syncTimestamps, cycleTime_sec, gapFraction, duplicateFraction, errorFraction):
+    nCycles = len(syncTimestamps)
+    boilerTemps = getBoilerTemps(syncTimestamps, cycleTime_sec)
+    readings = []
+
+    for groupingID, groupingSensors_DF in sensors_DF.groupby("grouping_id"):
+        valveOpening = rng.uniform(0.6, 1.0)
+        returnFraction = rng.uniform(0.5, 0.85)
+        flowTemps = roomTemp + valveOpening * (boilerTemps - roomTemp)
+        returnTemps = roomTemp + returnFraction * (flowTemps - roomTemp)
+        roomTemps = roomTemp + 0.1 * (flowTemps - roomTemp)
+
+        # Half the gaps are whole device outages, the other half single readings going missing
+        isDeviceOnline = ~getOutages(rng, nCycles, gapFraction / 2)
+        readDelays_sec = rng.uniform(0.05, 2.0, nCycles)
+
+        for index, sensor in groupingSensors_DF.iterrows():
+            temps = {1: flowTemps, 0: returnTemps}.get(sensor["flow1_return0"], roomTemps)
+            temps = np.round((temps + rng.normal(0, 0.1, nCycles)) * 16) / 16
+            temps[rng.random(nCycles) < errorFraction] = sensorErrorTemp
+            isRead = isDeviceOnline & (rng.random(nCycles) >= gapFraction / 2)
+            readings.append(pd.DataFrame({
+                "syncTimestamp": syncTimestamps[isRead],
+                "timestamp": syncTimestamps[isRead] + readDelays_sec[isRead],
+                "sensorID": sensor["sensorID"],
+                "tempDegC": temps[isRead]
+            }))
+
+    readings_DF = pd.concat(readings, ignore_index=True)
+    duplicates_DF = readings_DF.loc[rng.random(len(readings_DF.index)) < duplicateFraction].copy()
+    duplicates_DF["timestamp"] += 0.5
+    readings_DF = pd.concat([readings_DF, duplicates_DF], ignore_index=True)
+    return readings_DF.sort_values(["syncTimestamp", "timestamp"], kind="stable")
+
+def insertGroupingsAndSensors(connection, nGroupings, sensors_DF):
+    groupings = [(0, "DefaultGroup", "Def", 0)]
+    groupings += [(groupingID, f"Radiator {groupingID:03d}", f"R{groupingID:03d}", 1) for groupingID in range(1, nGroupings + 1)]
+    with connection:
+        connection.executemany("INSERT INTO groupings (grouping_id, groupingPrettyName, groupingShortName, isGroupingActiveBool) VALUES (?, ?, ?, ?)", groupings)
+        connection.executemany("""
+            INSERT INTO sensors (sensorID, sensorPrettyName, sensorShortName, isSensorActiveBool, grouping_id, flow1_return0, calibrationCorrection)
+            VALUES (:sensorID, :sensorPrettyName, :sensorShortName, :isSensorActiveBool, :grouping_id, :flow1_return0, :calibrationCorrection)
+            """, sensors_DF.to_dict("records"))
+
+def generateDatabase(databasePath, nGroupings=10, sensorsPerGrouping=2, nCycles=10000, cycleTime_sec=60, startTimestamp=None,
+                     gapFraction=0.02, duplicateFraction=0.001, errorFraction=0.0005, seed=0):
+    if os.path.exists(databasePath):
+        raise FileExistsError(f"{databasePath} already exists")
+
+    rng = np.random.default_rng(seed)
+    if startTimestamp is None:
+        startTimestamp = int(time.time() - nCycles * cycleTime_sec)
+    syncTimestamps = startTimestamp + np.arange(nCycles, dtype=np.int64) * int(cycleTime_sec)
+
+    connection = DBAccess.create_connection(databasePath)
+    DBAccess.configureConnection(connection, synchronous="OFF")
+    CreateDBTables.createDBTables(connection)
+
+    sensors_DF = getSensors_DF(rng, nGroupings, sensorsPerGrouping)
+    insertGroupingsAndSensors(connection, nGroupings, sensors_DF)
+    readings_DF = getReadings_DF(rng, sensors_DF, syncTimestamps, cycleTime_sec, gapFraction, duplicateFraction, errorFraction)
+
+    # A few hundred cycles at a time, so the sync_cycles and rollup tables are built just as the logger would
+    nRows = 0
+    startTime = time.perf_counter()
+    for firstCycle in range(0, nCycles, cyclesPerInsert):
+        isInChunk = (readings_DF["syncTimestamp"] >= syncTimestamps[firstCycle]) & (readings_DF["syncTimestamp"] < syncTimestamps[firstCycle] + cyclesPerInsert * int(cycleTime_sec))
+        readings = readings_DF.loc[isInChunk].to_dict("records")
+        if len(readings) > 0:
+            nRows += DBAccess.insertReadings(connection, readings)["nRows"]
+        print(f"\rWritten {nRows} of {len(readings_DF.index)} readings", end="")
+    print()
+    print(f"Generated {nRows} readings from {len(sensors_DF.index)} sensors over {nCycles} cycles in {time.perf_counter() - startTime:.1f} seconds")
+
+    connection.close()
+    return nRows
+
+if __name__ == "__main__":
+    outputPath = None
+    nGroupings = 10
+    sensorsPerGrouping = 2
+    nCycles = 10000
+    cycleTime_sec = 60
+    startTimestamp = None
+    gapFraction = 0.02
+    duplicateFraction = 0.001
+    errorFraction = 0.0005
+    seed = 0
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "ho:g:s:c:", ["output=", "groupings=", "sensors=", "cycles=", "cycleTime=", "start=", "gaps=", "duplicates=", "errors=", "seed="])
+    except getopt.GetoptError:
+        print("GenerateSyntheticDB.py options error occured")
+        sys.exit(2)
+    try:
+        for opt, arg in opts:
+            if opt == "-h":
+                print(getHelpText())
+                sys.exit()
+            elif opt in ("-o", "--output"):
+                outputPath = arg
+            elif opt in ("-g", "--groupings"):
+                nGroupings = int(arg)
+            elif opt in ("-s", "--sensors"):
+                sensorsPerGrouping = int(arg)
+            elif opt in ("-c", "--cycles"):
+                nCycles = int(arg)
+            elif opt == "--cycleTime":
+                cycleTime_sec = int(arg)
+            elif opt == "--start":
+                startTimestamp = int(arg)
+            elif opt == "--gaps":
+                gapFraction = float(arg)
+            elif opt == "--duplicates":
+                duplicateFraction = float(arg)
+            elif opt == "--errors":
+                errorFraction = float(arg)
+            elif opt == "--seed":
+                seed = int(arg)
+    except ValueError as e:
+        print(e)
+        print("Please supply numbers for counts, times and fractions")
+        sys.exit(2)
+
+    if outputPath is None:
+        print("Please give a database to create with -o")
+        sys.exit(2)
+
+    try:
+        generateDatabase(outputPath, nGroupings, sensorsPerGrouping, nCycles, cycleTime_sec, startTimestamp, gapFraction, duplicateFraction, errorFraction, seed)
+    except FileExistsError as e:
+        print(e)
+        sys.exit(2)
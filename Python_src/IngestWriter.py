@@ -0,0 +1,250 @@
+#! /usr/bin/env python3
+
+import json
+import logging
+import os
+import queue
+import threading
+from sqlite3 import OperationalError
+import DBAccess
+
+# Stores readings from a background thread so polling never waits on the database.
+# Each cycle's readings are put on a bounded queue and the writer thread commits whatever has built up as one
+# transaction. If the database can't be written to (e.g. a viewer is holding a lock for longer than the busy
+# timeout) or the queue is full, the readings are appended to a spool file, one JSON line per batch:
+#   {"readings": [{"syncTimestamp": 1608765463, "timestamp": 1608765463.5, "sensorID": "28...", "tempDegC": 21.5}, ...]}
+# The spool is replayed, oldest first, before anything newer is written. Readings whose (syncTimestamp, sensorID)
+# is already in the database are dropped, so a replay that was interrupted after committing is harmless.
+# Only an OperationalError (locked, busy, disk full) is worth retrying. A batch that fails any other way, e.g. a
+# reading with no sensorID, never will be written, so it's moved to the .rejected file next to the spool, in the
+# same format, rather than holding up everything behind it
+
+logger = logging.getLogger("IngestWriter")
+
+spoolReplayChunkSize = 50000
+
+class IngestWriter:
+    # onCommitted(connection, readings, stats) is called from the writer thread after each commit, with the writer's
+    # connection and what DBAccess.insertReadings returned. onFailed(error, readings) when readings had to be spooled.
+    # With a sensorRegistry, which is then only used from the writer thread, only new sensors are written to the sensors table
+    def __init__(self, databasePath, spoolPath, journalMode="WAL", synchronous="NORMAL", busyTimeout_sec=60,
+                 maxQueuedCycles=1000, maxBatchCycles=50, retryDelay_sec=5, onCommitted=None, onFailed=None, sensorRegistry=None):
+        self.databasePath = databasePath
+        self.spoolPath = spoolPath
+        self.journalMode = journalMode
+        self.synchronous = synchronous
+        self.busyTimeout_sec = busyTimeout_sec
+        self.maxBatchCycles = maxBatchCycles
+        self.retryDelay_sec = retryDelay_sec
+        self.onCommitted = onCommitted
+        self.onFailed = onFailed
+        self.sensorRegistry = sensorRegistry
+        self.queue = queue.Queue(maxsize=maxQueuedCycles)
+        self.spoolLock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name="IngestWriter", daemon=True)
+        self.thread.start()
+
+    # Never blocks. Returns False if the queue was full and the readings went straight to the spool
+    def submit(self, readings):
+        try:
+            self.queue.put_nowait(readings)
+        except queue.Full:
+            self.appendToSpool(readings)
+            return False
+        return True
+
+    def getQueuedCycles(self):
+        return self.queue.qsize()
+
+    def getSpoolSize(self):
+        try:
+            return os.path.getsize(self.spoolPath)
+        except OSError:
+            return 0
+
+    def appendToSpool(self, readings):
+        try:
+            with self.spoolLock:
+                with open(self.spoolPath, "a") as spoolFile:
+                    spoolFile.write(json.dumps({"readings": readings}) + "\n")
+                    spoolFile.flush()
+                    os.fsync(spoolFile.fileno())
+        except OSError as e:
+            # Nowhere left to put them
+            self.reportFailure(e, readings)
+
+    def reportFailure(self, error, readings):
+        if self.onFailed is not None:
+            self.onFailed(error, readings)
+
+    def getRejectedPath(self):
+        return self.spoolPath + ".rejected"
+
+    def reject(self, connection, error, readings):
+        # A failure that isn't from SQLite can leave insertReadings' transaction open
+        connection.rollback()
+        logger.error("%d readings can't be stored and were moved to %s : %r", len(readings), self.getRejectedPath(), error)
+        try:
+            with open(self.getRejectedPath(), "a") as rejectedFile:
+                rejectedFile.write(json.dumps({"error": repr(error), "readings": readings}) + "\n")
+                rejectedFile.flush()
+                os.fsync(rejectedFile.fileno())
+        except (OSError, TypeError, ValueError) as e:
+            logger.error("Couldn't write to %s, the readings are lost : %s", self.getRejectedPath(), e)
+
+    # Returns the spooled batches, each as its readings and the spool offset just after it, and how many bytes
+    # of the spool they came from. A line that was only half written when the logger stopped is skipped
+    def readSpool(self):
+        with self.spoolLock:
+            try:
+                with open(self.spoolPath, "rb") as spoolFile:
+                    spoolBytes = spoolFile.read()
+            except FileNotFoundError:
+                return [], 0
+
+        nBytes = spoolBytes.rfind(b"\n") + 1
+        batches = []
+        endOffset = 0
+        for line in spoolBytes[:nBytes].splitlines(keepends=True):
+            endOffset += len(line)
+            try:
+                batches.append((list(json.loads(line)["readings"]), endOffset))
+            except (ValueError, KeyError, TypeError):
+                continue
+        return batches, nBytes
+
+    # Removes what has been replayed, keeping anything spooled since
+    def removeFromSpool(self, nBytes):
+        with self.spoolLock:
+            with open(self.spoolPath, "rb") as spoolFile:
+                spoolFile.seek(nBytes)
+                remainingBytes = spoolFile.read()
+            if len(remainingBytes) == 0:
+                os.remove(self.spoolPath)
+                return
+            tempPath = self.spoolPath + ".tmp"
+            with open(tempPath, "wb") as tempFile:
+                tempFile.write(remainingBytes)
+                tempFile.flush()
+                os.fsync(tempFile.fileno())
+            os.replace(tempPath, self.spoolPath)
+
+    def removeDuplicates(self, connection, readings):
+        if len(readings) == 0:
+            return readings
+        syncTimestamps = [reading["syncTimestamp"] for reading in readings]
+        stored_query = "SELECT syncTimestamp, sensorID FROM temperature_data WHERE syncTimestamp BETWEEN ? AND ?"
+        seen = set(connection.execute(stored_query, (min(syncTimestamps), max(syncTimestamps))).fetchall())
+
+        uniqueReadings = []
+        for reading in readings:
+            key = (reading["syncTimestamp"], reading["sensorID"])
+            if key not in seen:
+                seen.add(key)
+                uniqueReadings.append(reading)
+        return uniqueReadings
+
+    def write(self, connection, readings):
+        if self.sensorRegistry is None:
+            stats = DBAccess.insertReadings(connection, readings)
+        else:
+            stats = self.sensorRegistry.insertReadings(connection, readings)
+        if self.onCommitted is not None:
+            # The readings are stored by now, so a failure here mustn't send them round again
+            try:
+                self.onCommitted(connection, readings, stats)
+            except Exception:
+                logger.exception("Error after storing %d readings", len(readings))
+
+    # Writes the batches (lists of readings) in one transaction. If that fails for any reason but an OperationalError,
+    # which is raised to be retried, each batch is written on its own and the ones that still fail are rejected
+    def writeBatches(self, connection, batches, isReplay=False):
+        try:
+            readings = [reading for batch in batches for reading in batch]
+            if isReplay:
+                readings = self.removeDuplicates(connection, readings)
+            if len(readings) > 0:
+                self.write(connection, readings)
+        except OperationalError:
+            raise
+        except Exception as e:
+            connection.rollback()
+            if len(batches) == 1:
+                self.reject(connection, e, batches[0])
+                return
+            for batch in batches:
+                self.writeBatches(connection, [batch], isReplay)
+
+    # Raises OperationalError if the database still can't be written to, leaving what hasn't been written in the spool
+    def replaySpool(self, connection):
+        batches, nBytes = self.readSpool()
+        if nBytes == 0:
+            return
+
+        replayedBytes = 0
+        try:
+            chunk = []
+            nChunkReadings = 0
+            for batchIndex, (readings, endOffset) in enumerate(batches):
+                chunk.append(readings)
+                nChunkReadings += len(readings)
+                if nChunkReadings >= spoolReplayChunkSize or batchIndex == len(batches) - 1:
+                    self.writeBatches(connection, chunk, isReplay=True)
+                    replayedBytes = endOffset
+                    chunk = []
+                    nChunkReadings = 0
+        except OperationalError:
+            if replayedBytes > 0:
+                self.removeFromSpool(replayedBytes)
+            raise
+
+        self.removeFromSpool(nBytes)
+
+    def flush(self, connection, batches):
+        # Spooled readings go first, and if they can't be written neither can these
+        readings = [reading for batch in batches for reading in batch]
+        try:
+            if self.getSpoolSize() > 0:
+                self.replaySpool(connection)
+            if len(readings) > 0:
+                self.writeBatches(connection, batches)
+        except OperationalError as e:
+            if len(readings) > 0:
+                self.appendToSpool(readings)
+                self.reportFailure(e, readings)
+        except Exception as e:
+            # Shouldn't happen, but the thread mustn't die with it. Spooled, they'll be retried or rejected later
+            logger.exception("Unexpected error storing readings")
+            if len(readings) > 0:
+                self.appendToSpool(readings)
+                self.reportFailure(e, readings)
+
+    def run(self):
+        connection = DBAccess.create_connection(self.databasePath)
+        DBAccess.configureConnection(connection, self.journalMode, self.synchronous, self.busyTimeout_sec)
+        self.flush(connection, [])
+
+        isStopping = False
+        while not isStopping:
+            # Wake up now and then, even if there's nothing new, to retry the spool
+            try:
+                batches = [self.queue.get(timeout=self.retryDelay_sec)]
+            except queue.Empty:
+                batches = []
+
+            # Everything that has built up goes in the same transaction
+            while len(batches) < self.maxBatchCycles:
+                try:
+                    batches.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            isStopping = None in batches
+            self.flush(connection, [batch for batch in batches if batch is not None and len(batch) > 0])
+
+        connection.close()
+
+    # Writes anything still queued, or spools it if it can't be written, then stops the writer thread
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,206 @@
+#! /usr/bin/env python3
+
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Per-cycle measurements from ReadDataIntoDB. They can be scraped in the Prometheus text format from
+# http://<metricsHost>:<metricsPort>/metrics and/or appended to a metrics file as one JSON line per cycle, e.g.
+#   {"syncTimestamp": 1608765463, "cycleDuration_sec": 0.41, "scheduleDrift_sec": 0.002, "nRows": 40, ...
+#    "devices": {"192.168.1.20": {"latency_sec": 0.12, "parse_sec": 0.0001, "errorType": null}, ...}}
+# The file is rolled over to <file>.1 when it reaches metricsFileMaxBytes
+
+metricPrefix = "radiator_logger_"
+
+# name : (type, help)
+metricDescriptions = {
+    "cycles_total": ("counter", "Logging cycles run"),
+    "cycle_duration_seconds": ("summary", "Time from the start of polling to the cycle being committed, or queued for writing"),
+    "last_cycle_duration_seconds": ("gauge", "Duration of the most recent cycle"),
+    "schedule_drift_seconds": ("gauge", "How late the most recent cycle started compared with its schedule"),
+    "last_cycle_timestamp_seconds": ("gauge", "syncTimestamp of the most recent cycle"),
+    "missed_cycles_total": ("counter", "Cycles skipped because the logger was running too late"),
+    "devices_backed_off": ("gauge", "Devices not being polled for a while because they couldn't be reached"),
+    "rows_written_total": ("counter", "Readings written to the database"),
+    "new_sensors_total": ("counter", "Sensors seen for the first time and added to the sensors table"),
+    "alerts_raised_total": ("counter", "Alerts raised by each rule"),
+    "alerts_open": ("gauge", "Alerts raised and not yet cleared"),
+    "store_errors_total": ("counter", "Failed attempts to write readings to the database"),
+    "spooled_readings_total": ("counter", "Readings written to the spool because they couldn't be written to the database"),
+    "write_queue_cycles": ("gauge", "Cycles waiting to be written to the database"),
+    "spool_bytes": ("gauge", "Size of the spool of readings waiting to be written to the database"),
+    "db_write_seconds": ("summary", "Time spent executing the inserts for a cycle"),
+    "db_commit_seconds": ("summary", "Time spent committing a cycle"),
+    "parse_seconds": ("summary", "Time spent decoding device responses, per cycle"),
+    "device_requests_total": ("counter", "Polls of each device"),
+    "device_errors_total": ("counter", "Failed polls of each device by error type"),
+    "device_latency_seconds": ("summary", "HTTP request time for each device"),
+    "device_last_latency_seconds": ("gauge", "HTTP request time of the most recent poll of each device")
+}
+
+def formatLabels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in sorted(labels.items())) + "}"
+
+class LoggerMetrics:
+    def __init__(self, metricsFilePath="", metricsFileMaxBytes=10000000):
+        self.metricsFilePath = metricsFilePath
+        self.metricsFileMaxBytes = metricsFileMaxBytes
+        self.lock = threading.Lock()
+        self.values = {} # (name, labels as a sorted tuple) -> value. Summaries keep name_sum and name_count
+        self.cycle = None
+
+    def add(self, name, value, labels={}):
+        key = (name, tuple(sorted(labels.items())))
+        self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, labels={}):
+        self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, labels={}):
+        self.add(name + "_sum", value, labels)
+        self.add(name + "_count", 1, labels)
+
+    # scheduledTime is the time.time() the cycle should have started at, if there's a schedule
+    def startCycle(self, syncTimestamp, scheduledTime=None):
+        startTime = time.time()
+        self.cycle = {
+            "syncTimestamp": syncTimestamp,
+            "startTimestamp": startTime,
+            "scheduleDrift_sec": None if scheduledTime is None else startTime - scheduledTime,
+            "startTime": time.perf_counter(),
+            "parse_sec": 0.0,
+            "devices": {}
+        }
+
+    def recordSchedule(self, nMissedCycles, nBackedOffDevices):
+        with self.lock:
+            self.add("missed_cycles_total", nMissedCycles)
+            self.set("devices_backed_off", nBackedOffDevices)
+
+    def recordPoll(self, pollResult):
+        self.cycle["parse_sec"] += pollResult.parse_sec
+        self.cycle["devices"][pollResult.ipAddress] = {
+            "latency_sec": pollResult.latency_sec,
+            "parse_sec": pollResult.parse_sec,
+            "errorType": pollResult.errorType,
+            "nReadings": 0 if pollResult.response is None else len(pollResult.response)
+        }
+
+    def recordWrite(self, stats):
+        with self.lock:
+            self.add("rows_written_total", stats["nRows"])
+            self.observe("db_write_seconds", stats["writeTime_sec"])
+            self.observe("db_commit_seconds", stats["commitTime_sec"])
+
+    def recordNewSensors(self, nNewSensors):
+        with self.lock:
+            self.add("new_sensors_total", nNewSensors)
+
+    def recordAlerts(self, raisedAlerts, nOpenAlerts):
+        with self.lock:
+            for alert in raisedAlerts:
+                self.add("alerts_raised_total", 1, {"alertType": alert["alertType"]})
+            self.set("alerts_open", nOpenAlerts)
+
+    def recordWriteFailure(self, nSpooledReadings):
+        with self.lock:
+            self.add("store_errors_total", 1)
+            self.add("spooled_readings_total", nSpooledReadings)
+
+    def recordWriteBacklog(self, queuedCycles, spoolBytes):
+        with self.lock:
+            self.set("write_queue_cycles", queuedCycles)
+            self.set("spool_bytes", spoolBytes)
+
+    # stats is what DBAccess.insertReadings returned for the cycle's nReadings readings, or None if there were
+    # none, they couldn't be stored or, with isQueued, they've been handed to the IngestWriter
+    def endCycle(self, nReadings, stats, isQueued=False):
+        cycle = self.cycle
+        cycle["cycleDuration_sec"] = time.perf_counter() - cycle.pop("startTime")
+        cycle["nRows"] = stats["nRows"] if stats is not None else nReadings if isQueued else 0
+        cycle["writeTime_sec"] = None if stats is None else stats["writeTime_sec"]
+        cycle["commitTime_sec"] = None if stats is None else stats["commitTime_sec"]
+        cycle["isStored"] = stats is not None or nReadings == 0
+        cycle["isQueued"] = isQueued
+
+        with self.lock:
+            self.add("cycles_total", 1)
+            self.observe("cycle_duration_seconds", cycle["cycleDuration_sec"])
+            self.set("last_cycle_duration_seconds", cycle["cycleDuration_sec"])
+            self.set("last_cycle_timestamp_seconds", cycle["syncTimestamp"])
+            if cycle["scheduleDrift_sec"] is not None:
+                self.set("schedule_drift_seconds", cycle["scheduleDrift_sec"])
+            self.observe("parse_seconds", cycle["parse_sec"])
+            if not cycle["isStored"] and not isQueued:
+                self.add("store_errors_total", 1)
+
+            for ipAddress, device in cycle["devices"].items():
+                labels = {"device": ipAddress}
+                self.add("device_requests_total", 1, labels)
+                if device["errorType"] is not None:
+                    self.add("device_errors_total", 1, {**labels, "type": device["errorType"]})
+                if device["errorType"] not in ["deadline", "busy"]:
+                    self.observe("device_latency_seconds", device["latency_sec"], labels)
+                    self.set("device_last_latency_seconds", device["latency_sec"], labels)
+
+        if stats is not None:
+            self.recordWrite(stats)
+        if self.metricsFilePath != "":
+            self.writeCycle(cycle)
+        return cycle
+
+    def writeCycle(self, cycle):
+        try:
+            if os.path.exists(self.metricsFilePath) and os.path.getsize(self.metricsFilePath) >= self.metricsFileMaxBytes:
+                os.replace(self.metricsFilePath, self.metricsFilePath + ".1")
+            with open(self.metricsFilePath, "a") as metricsFile:
+                metricsFile.write(json.dumps(cycle) + "\n")
+        except OSError as e:
+            print(f"Couldn't write metrics to {self.metricsFilePath} : {e}")
+
+    # Prometheus text exposition format
+    def getMetricsText(self):
+        with self.lock:
+            values = dict(self.values)
+
+        lines = []
+        for name, (metricType, helpText) in metricDescriptions.items():
+            suffixes = ["_sum", "_count"] if metricType == "summary" else [""]
+            samples = [(name + suffix, labels, value) for suffix in suffixes for (valueName, labels), value in values.items() if valueName == name + suffix]
+            if len(samples) == 0:
+                continue
+            lines.append(f"# HELP {metricPrefix}{name} {helpText}")
+            lines.append(f"# TYPE {metricPrefix}{name} {metricType}")
+            for sampleName, labels, value in sorted(samples):
+                lines.append(f"{metricPrefix}{sampleName}{formatLabels(dict(labels))} {value}")
+        return "\n".join(lines) + "\n"
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ["/metrics", "/"]:
+            self.send_error(404)
+            return
+        body = self.server.metrics.getMetricsText().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MetricsServer:
+    def __init__(self, metrics, host="127.0.0.1", port=9105):
+        self.server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        self.server.daemon_threads = True
+        self.server.metrics = metrics
+        threading.Thread(target=self.server.serve_forever, name="MetricsServer", daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
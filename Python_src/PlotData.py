@@ -1,42 +1,121 @@
 #! /usr/bin/env python3
 
+import sys
+import getopt
+import time
 import DBAccess
+import CreateDBTables
+import Downsampling
 import configparser
 import pandas as pd
 import matplotlib.pyplot as plt
-from datetime import datetime
+from datetime import datetime, timezone
 
 # Load settings
 config = configparser.ConfigParser()
 config.read("Radiator_temp_logger.cnf")
 
+def getHelpText():
+    helpText = "\r\n"
+    helpText += "PlotData.py plots the flow and return temperatures of each active grouping\r\n"
+    helpText += "\r\n"
+    helpText += "Options:-\r\n"
+    helpText += "\r\n"
+    helpText += "   -s  :   --start <timestamp>     :   Only plot from this syncTimestamp\r\n"
+    helpText += "   -e  :   --end <timestamp>       :   Only plot up to this syncTimestamp\r\n"
+    helpText += "   -d  :   --days <n>              :   Only plot the last n days\r\n"
+    helpText += "   -p  :   --points <n>            :   Most points to draw for each sensor (default 2000)\r\n"
+    helpText += "   -m  :   --method <method>       :   How to cut the points down, lttb (default), minmax or none to draw every reading\r\n"
+
+    return helpText
+
 def addDateColumn(sensorData):
-    sensorData["formatted_timestamp_col"] = sensorData["syncTimestamp"].map(lambda ts: datetime.fromtimestamp(ts))
+    # datetime.fromtimestamp on every row is slow, the local UTC offset only needs working out once per quarter hour
+    quarterHours = sensorData["syncTimestamp"] // 900 * 900
+    offsets_sec = {quarterHour: datetime.fromtimestamp(quarterHour, timezone.utc).astimezone().utcoffset().total_seconds() for quarterHour in quarterHours.unique()}
+    sensorData["formatted_timestamp_col"] = pd.to_datetime(sensorData["syncTimestamp"] + quarterHours.map(offsets_sec), unit="s")
+
+# All active groupings' readings in one go, cut down to at most about pointBudget points per sensor
+def getPlotData_DF(connection, groupingIDs, startTimestamp=None, endTimestamp=None, pointBudget=2000, method="lttb"):
+    if method == "none":
+        data_DF = DBAccess.getJoinedData_DF(connection, groupingIDs=groupingIDs, startTimestamp=startTimestamp, endTimestamp=endTimestamp)
+    else:
+        # The coarsest rollup that still has at least pointBudget buckets per sensor, the downsampling picks from those
+        data_DF, resolution_sec = DBAccess.getRollupData_DF(connection, groupingIDs=groupingIDs, startTimestamp=startTimestamp, endTimestamp=endTimestamp,
+                                                            minPointsPerSensor=pointBudget)
+        if resolution_sec > 0 and method == "minmax":
+            # Keep each bucket's extremes rather than its mean
+            data_DF = pd.concat([data_DF.assign(tempDegC=data_DF["minTempDegC"]), data_DF.assign(tempDegC=data_DF["maxTempDegC"])])
+
+    data_DF = data_DF.dropna(subset=["tempDegC"])
+    data_DF = Downsampling.downsample_DF(data_DF, "syncTimestamp", "tempDegC", "sensorID", pointBudget, method)
+    addDateColumn(data_DF)
+    return data_DF
 
 if __name__ == "__main__":
+    startTimestamp = None
+    endTimestamp = None
+    pointBudget = 2000
+    method = "lttb"
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hs:e:d:p:m:", ["start=", "end=", "days=", "points=", "method="])
+    except getopt.GetoptError:
+        print("PlotData.py options error occured")
+        sys.exit(2)
+    try:
+        for opt, arg in opts:
+            if opt == "-h":
+                print(getHelpText())
+                sys.exit()
+            elif opt in ("-s", "--start"):
+                startTimestamp = int(arg)
+            elif opt in ("-e", "--end"):
+                endTimestamp = int(arg)
+            elif opt in ("-d", "--days"):
+                startTimestamp = int(time.time() - float(arg) * 86400)
+            elif opt in ("-p", "--points"):
+                pointBudget = int(arg)
+            elif opt in ("-m", "--method"):
+                method = arg.lower()
+    except ValueError as e:
+        print(e)
+        print("Please supply whole numbers for timestamps and points")
+        sys.exit(2)
+    if method not in Downsampling.downsamplingMethods:
+        print(f"Unknown method {method}, should be one of {Downsampling.downsamplingMethods}")
+        sys.exit(2)
+
     databasePath = config["DatabaseSettings"].get("databasePath")
     dbConnection = DBAccess.create_connection(databasePath)
+    # Older databases need the sync_cycles and rollup tables the plots are read from
+    CreateDBTables.upgradeDatabase(dbConnection)
 
     groupings_data_query = "SELECT * FROM groupings"
     groupings_DF = pd.read_sql_query(groupings_data_query, dbConnection)
-    
+
     active_groupings_DF = groupings_DF.loc[groupings_DF["isGroupingActiveBool"] != 0]
-    
-    fig, axs = plt.subplots(len(active_groupings_DF.index))
-    
+    if len(active_groupings_DF.index) == 0:
+        print("There are no active groupings to plot")
+        sys.exit()
+
+    plotData_DF = getPlotData_DF(dbConnection, active_groupings_DF["grouping_id"].tolist(), startTimestamp, endTimestamp, pointBudget, method)
+
+    fig, axs = plt.subplots(len(active_groupings_DF.index), squeeze=False)
+
     plotIndex = 0
     for index, row in active_groupings_DF.iterrows():
-        print("index = " + str(index))
-        groupingsData = DBAccess.getDataForGrouping(dbConnection, row["grouping_id"])
-        addDateColumn(groupingsData)
-        groupingsFlowData = groupingsData.loc[groupingsData["flow1_return0"] == 1]
-        groupingsReturnData = groupingsData.loc[groupingsData["flow1_return0"] == 0]
-        axs[plotIndex].plot(groupingsFlowData["formatted_timestamp_col"], groupingsFlowData["tempDegC"], label="Flow", color="red")
-        axs[plotIndex].plot(groupingsReturnData["formatted_timestamp_col"], groupingsReturnData["tempDegC"], label="Return", color="blue")
-        axs[plotIndex].set_title(groupingsReturnData.iloc[0]["groupingPrettyName"], fontsize="10")
-        axs[plotIndex].set(ylabel='Temp C')
+        groupingsData = plotData_DF.loc[plotData_DF["grouping_id"] == row["grouping_id"]]
+        ax = axs[plotIndex][0]
+        # One line per sensor, in case a pipe has more than one
+        for label, flow1_return0, color in [("Flow", 1, "red"), ("Return", 0, "blue")]:
+            pipeData = groupingsData.loc[groupingsData["flow1_return0"] == flow1_return0]
+            for sensorNumber, (sensorID, sensorData) in enumerate(pipeData.groupby("sensorID")):
+                ax.plot(sensorData["formatted_timestamp_col"], sensorData["tempDegC"], label=label if sensorNumber == 0 else None, color=color)
+        ax.set_title(row["groupingPrettyName"], fontsize="10")
+        ax.set(ylabel='Temp C')
         plotIndex += 1
-    
-    axs[0].legend()
+
+    axs[0][0].legend()
     plt.tight_layout()
     plt.show()
@@ -2,9 +2,10 @@
 
 import configparser
 import DBAccess
+import CreateDBTables
+import CycleNotifier
+import numpy as np
 import pandas as pd
-import time
-from datetime import datetime
 import sys
 
 # Settings
@@ -12,7 +13,7 @@ config = configparser.ConfigParser()
 config.read("Radiator_temp_logger.cnf")
 
 databasePath = config["DatabaseSettings"].get("databasePath")
-dbConnection = DBAccess.create_connection(databasePath)
+notifySocketPath = config["DatabaseSettings"].get("notifySocketPath", CycleNotifier.getDefaultSocketPath(databasePath))
 
 nRowsToPrint = config["PrintSettings"].getint("nRowsToPrint")
 printHeaderEveryNRows = config["PrintSettings"].getint("printHeaderEveryNRows")
@@ -48,81 +49,78 @@ def printHeader(sensors_data_DF):
     
     return list(sensors_data_DF["sensorID"]) # Pass this back so it can be used when printing rows
 
-def printRow(temperature_data_rows, sensorHeadersOrder):
-    timestamp = temperature_data_rows.iloc[0, temperature_data_rows.columns.get_loc("syncTimestamp")]
-    printString = datetime.utcfromtimestamp(timestamp).strftime("%d/%m/%Y %H:%M:%S") # 19 chars long
-
-    printString += " : "
+# Builds the table in one go: one row per syncTimestamp and one column per sensor in sensorHeadersOrder
+# Returns the formatted lines, oldest first, and the syncTimestamps that had more than one value for a sensor
+def getTableLines(temperature_data_DF, sensorHeadersOrder):
+    readingsPerCell = temperature_data_DF.groupby(["syncTimestamp", "sensorID"]).size()
+    duplicatedTimestamps = readingsPerCell.loc[readingsPerCell > 1].index.get_level_values("syncTimestamp").unique()
     
-    for sensorID in sensorHeadersOrder:
-        sensorDatToPrint_df = temperature_data_rows.loc[temperature_data_rows['sensorID'] == sensorID]
-        
-        nSensorDatToPrint = len(sensorDatToPrint_df.index)
-        
-        if nSensorDatToPrint == 0:
-            printString += " -- "
-        elif nSensorDatToPrint == 1:
-            datToPrint = sensorDatToPrint_df.iloc[0]
-            printString += "{:2.1f}".format(datToPrint["tempDegC"]) # Fix length to 4 characters
-        else:
-            raise ValueError
-
-        printString += "  "
+    table_DF = temperature_data_DF.pivot_table(index="syncTimestamp", columns="sensorID", values="tempDegC", aggfunc="first")
+    table_DF = table_DF.reindex(columns=sensorHeadersOrder)
+    table_DF = table_DF.loc[~table_DF.index.isin(duplicatedTimestamps)].sort_index()
     
-    print(printString)
-
-# What happens when nRowsToPrint > nRows???
-def printLastNRows(nRowsToPrint, temperature_DF_w_sensors, sensorHeadersOrder, sensors_data_DF, rowCounter):
-    uniqueSyncTimestamps = set(temperature_DF_w_sensors["syncTimestamp"])
-    sortedUniqueSyncTimestamps = sorted(uniqueSyncTimestamps)
+    dateStrings = pd.to_datetime(table_DF.index, unit="s").strftime("%d/%m/%Y %H:%M:%S") # 19 chars long
     
-    if(nRowsToPrint < 0):
-        lastNTimestamps = sortedUniqueSyncTimestamps
-    else:
-        lastNTimestamps = sortedUniqueSyncTimestamps[-nRowsToPrint:]
+    values = table_DF.to_numpy(dtype=float)
+    cells = np.char.mod("%2.1f", values) # Fix length to 4 characters
+    cells = np.where(np.isnan(values), " -- ", cells)
     
-    for timestamp in lastNTimestamps:
+    lines = [dateString + " : " + "".join(cell + "  " for cell in rowCells) for dateString, rowCells in zip(dateStrings, cells.tolist())]
+    return lines, list(duplicatedTimestamps)
+
+def printTableLines(lines, sensors_data_DF, rowCounter):
+    # Print in blocks between headers rather than line by line
+    while len(lines) > 0:
         if rowCounter >= printHeaderEveryNRows:
             rowCounter = 0
             printHeader(sensors_data_DF)
-        rows = temperature_DF_w_sensors.loc[temperature_DF_w_sensors["syncTimestamp"] == timestamp]
-        try:
-            printRow(rows, sensorHeadersOrder)
-            rowCounter += 1
-        except ValueError:
-            print("Error, multiple values for a specific sensorID and syncTimestamp")
-    
-    lastTimestamp = 0
-    if len(sortedUniqueSyncTimestamps) > 0:
-        lastTimestamp = sortedUniqueSyncTimestamps[-1]
-    
-    return lastTimestamp, rowCounter # latest data point printed
+        nLinesInBlock = printHeaderEveryNRows - rowCounter
+        print("\n".join(lines[:nLinesInBlock]))
+        rowCounter += len(lines[:nLinesInBlock])
+        lines = lines[nLinesInBlock:]
+    return rowCounter
 
-def loadInitialDataAndPrint(rowCounter):
+def printRows(temperature_data_DF, sensorHeadersOrder, sensors_data_DF, rowCounter):
+    lines, duplicatedTimestamps = getTableLines(temperature_data_DF, sensorHeadersOrder)
+    for timestamp in duplicatedTimestamps:
+        print(f"Error, multiple values for a specific sensorID and syncTimestamp {timestamp}")
+    return printTableLines(lines, sensors_data_DF, rowCounter)
+
+def loadInitialDataAndPrint(connection, rowCounter):
     # Get sensor info
-    sensors_data_DF = pd.read_sql_query(sensors_data_query, dbConnection)
+    sensors_data_DF = pd.read_sql_query(sensors_data_query, connection)
+    sensorHeadersOrder = printHeader(sensors_data_DF)
     
-    # Get temperature data
-    temperature_data_query = "SELECT * FROM temperature_data"
-    temperature_data_DF = pd.read_sql_query(temperature_data_query, dbConnection, index_col = "data_id")
+    # Only complete cycles are shown, the rest will be picked up in follow mode once they're committed
+    if nRowsToPrint < 0:
+        cycles_DF = DBAccess.getCompleteCycles_DF(connection)
+    else:
+        cycles_DF = DBAccess.getCompleteCycles_DF(connection, nLatest=nRowsToPrint)
     
-    # Merge sensor info into temperature data
-    temperature_DF_w_sensors = pd.merge(temperature_data_DF, sensors_data_DF, on="sensorID")
-
-    sensorHeadersOrder = printHeader(sensors_data_DF)     
-    lastTimestamp, rowCounter = printLastNRows(nRowsToPrint, temperature_DF_w_sensors, sensorHeadersOrder, sensors_data_DF, rowCounter)
+    temperature_data_DF = DBAccess.getTemperatureDataForSyncTimestamps_DF(connection, cycles_DF["syncTimestamp"])
+    rowCounter = printRows(temperature_data_DF, sensorHeadersOrder, sensors_data_DF, rowCounter)
+    
+    lastDataID = 0
+    if len(cycles_DF.index) > 0:
+        lastDataID = int(cycles_DF["lastDataID"].max())
     
-    return sensors_data_DF, sensorHeadersOrder, lastTimestamp, rowCounter
+    return sensors_data_DF, sensorHeadersOrder, lastDataID, rowCounter # lastDataID is the high-water mark of data printed
 
 if __name__ == "__main__":
+    dbConnection = DBAccess.create_connection(databasePath)
+    # Older databases need the tables these queries use
+    CreateDBTables.upgradeDatabase(dbConnection)
+    
     print()
     rowCounter = 0;
-    sensors_data_DF, sensorHeadersOrder, lastTimestamp, rowCounter = loadInitialDataAndPrint(rowCounter)
+    cycleSubscriber = CycleNotifier.CycleSubscriber(dbConnection, notifySocketPath)
+    sensors_data_DF, sensorHeadersOrder, lastDataID, rowCounter = loadInitialDataAndPrint(dbConnection, rowCounter)
     
     while True:
-        # Todo - Check if DB sensor set up has changed when in loop, reprint headers if so
-        time.sleep(1)
+        # Nothing to do until the logger has committed another cycle
+        cycleSubscriber.waitForNextCycle()
         
+        # Check if DB sensor set up has changed, reprint headers if so
         sensors_data_DF_NEW = pd.read_sql_query(sensors_data_query, dbConnection)
 
         if (not sensors_data_DF_NEW["isSensorActiveBool"].equals(sensors_data_DF.sort_index()["isSensorActiveBool"])
@@ -132,20 +130,10 @@ if __name__ == "__main__":
             sensors_data_DF = sensors_data_DF_NEW
             sensorHeadersOrder = printHeader(sensors_data_DF)
         
-        # Get temperature data
-        temperature_data_query = f"SELECT * FROM temperature_data WHERE \"syncTimestamp\" > {lastTimestamp}"
-        temperature_data_DF = pd.read_sql_query(temperature_data_query, dbConnection, index_col = "data_id")
+        # Only cycles that have been completely committed since the last print, so no need to wait for the logger to finish
+        cycles_DF = DBAccess.getCompleteCycles_DF(dbConnection, lastDataID)
         
-        if(len(temperature_data_DF.index)) > 0:
-            time.sleep(10) # Sleep to ensure database has been fully updated
-            
-            timestampCol = temperature_data_DF["syncTimestamp"]
-            maxTimestamp = timestampCol.max()
-            
-            temperature_data_query = f"SELECT * FROM temperature_data WHERE \"syncTimestamp\" BETWEEN {lastTimestamp+1} AND {maxTimestamp}"
-            temperature_data_DF = pd.read_sql_query(temperature_data_query, dbConnection, index_col = "data_id")
-            
-            # Merge sensor info into temperature data
-            temperature_DF_w_sensors = pd.merge(temperature_data_DF, sensors_data_DF, on='sensorID')
-            
-            lastTimestamp, rowCounter = printLastNRows(-1, temperature_DF_w_sensors, sensorHeadersOrder, sensors_data_DF, rowCounter)
+        if len(cycles_DF.index) > 0:
+            temperature_data_DF = DBAccess.getTemperatureDataForSyncTimestamps_DF(dbConnection, cycles_DF["syncTimestamp"], lastDataID)
+            rowCounter = printRows(temperature_data_DF, sensorHeadersOrder, sensors_data_DF, rowCounter)
+            lastDataID = int(cycles_DF["lastDataID"].max())
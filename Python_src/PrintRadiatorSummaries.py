@@ -4,9 +4,11 @@ import sys
 import getopt
 import configparser
 import DBAccess
+import CreateDBTables
+import RadiatorSummary
+import CycleNotifier
 import pandas as pd
 from datetime import datetime
-import time
 
 # Settings
 config = configparser.ConfigParser()
@@ -26,6 +28,7 @@ def getHelpText():
     helpText += "   -f  :   --follow                :   Follow: Keep refreshing the tables as new values come in\r\n"
     helpText += "       :   --timestamp <time>      :   Supply a timestamp <time> to give summary for\r\n"
     helpText += "   -i  :   --index <n>             :   Show summary for specific index <n> values since most recent\r\n"
+    helpText += "   -l  :   --live                  :   Show each sensor's most recent reading, even if it's from an earlier cycle\r\n"
     
     return helpText
 
@@ -37,6 +40,10 @@ def printCantFollowSpecificTimestampAndExit():
     print("Can't run both in follow mode and print specific timestamp or index.")
     sys.exit(2)
 
+def printCantUseLiveReadingsForSpecificTimestampAndExit():
+    print("Can't print live readings for a specific timestamp or index.")
+    sys.exit(2)
+
 def printCantPrintTimestampAndIndexAndExit():
     print("Can't print both timestamp and index.")
     sys.exit(2)
@@ -46,11 +53,12 @@ sortByReturnTemperature = False
 sortByDifference = False
 inverseSort = False
 inFollowMode = False
+useLiveReadings = False
 dataTimestamp = 0
 dataIndex = 0
 
 try:
-    opts, args = getopt.getopt(sys.argv[1:],"htdfri:",["flowSort","reverseSort","returnSort","diffSort","timestamp=","index="])
+    opts, args = getopt.getopt(sys.argv[1:],"htdfrli:",["flowSort","reverseSort","returnSort","diffSort","live","timestamp=","index="])
 except getopt.GetoptError:
     print("PrintRadiatorSummaries.py options error occured")
     sys.exit(2)
@@ -75,8 +83,12 @@ for opt, arg in opts:
     elif opt in (["-f", "--follow"]):
         if dataTimestamp != 0 or dataIndex != 0:  printCantFollowSpecificTimestampAndExit()
         inFollowMode = True
+    elif opt in (["-l", "--live"]):
+        if dataTimestamp != 0 or dataIndex != 0:  printCantUseLiveReadingsForSpecificTimestampAndExit()
+        useLiveReadings = True
     elif opt in (["--timestamp"]):
         if inFollowMode: printCantFollowSpecificTimestampAndExit()
+        if useLiveReadings: printCantUseLiveReadingsForSpecificTimestampAndExit()
         if dataIndex != 0: printCantPrintTimestampAndIndexAndExit()
         try:
             dataTimestamp = int(arg)
@@ -86,6 +98,7 @@ for opt, arg in opts:
             sys.exit(2)
     elif opt in ("-i", "--index"): # BUG for some reason --index <n> works but -i <n> doesn't. Causes ValueError
         if inFollowMode: printCantFollowSpecificTimestampAndExit()
+        if useLiveReadings: printCantUseLiveReadingsForSpecificTimestampAndExit()
         if dataTimestamp != 0: printCantPrintTimestampAndIndexAndExit()
         try:
             dataIndex = int(arg)
@@ -96,53 +109,16 @@ for opt, arg in opts:
 
 # Done handling arguments, on with the code
 
-def fillFlowOrReturnData(active_rads_DF, associatedSensors_DF, temperatures_DF, flow1_return0, sensorColName, tempColName, groupingPrettyName, index):
-        associatedSensors_DF = associatedSensors_DF.loc[associatedSensors_DF["flow1_return0"] == flow1_return0]
-                
-        if len(associatedSensors_DF.index) == 0:
-            print("Error, sensor not found for grouping " + groupingPrettyName)
-        elif len(associatedSensors_DF.index) > 1:
-            print("Error, too many sensors found for grouping " + groupingPrettyName)
-        else:
-            active_rads_DF.at[index,sensorColName] = associatedSensors_DF.iloc[0]["sensorPrettyName"]
-            
-            temperature_Rows = temperatures_DF.loc[temperatures_DF["sensorID"] == associatedSensors_DF.iloc[0]["sensorID"]]
-            if len(temperature_Rows.index) == 0:
-                print("Error, temperature not found for grouping " + groupingPrettyName)
-            elif len(associatedSensors_DF.index) > 1:
-                print("Error, too many temperatures found for grouping " + groupingPrettyName)
-            else:
-                active_rads_DF.at[index,tempColName] = temperature_Rows.iloc[0]["tempDegC"]
-                active_rads_DF.at[index,"timestamp"] = temperature_Rows.iloc[0]["syncTimestamp"]
+def printDataQualityIssues(issues_DF):
+    for index, row in issues_DF.iterrows():
+        printString = "Error, " + row["issue"] + " for grouping " + row["groupingPrettyName"]
+        if not pd.isna(row["syncTimestamp"]):
+            printString += f" at timestamp {int(row['syncTimestamp'])}"
+        print(printString)
 
 def getRadiatorSummary_DF(connection, temperatures_DF):
-    # sensors_data_query = "SELECT * FROM sensors"
-    active_rads_data_query = "SELECT * FROM groupings WHERE \"isGroupingActiveBool\" != 0"
-    active_rads_w_temps_DF = pd.read_sql_query(active_rads_data_query, connection)
-    
-    sensors_data_query = "SELECT * FROM sensors WHERE \"isSensorActiveBool\" != 0"
-    sensors_DF = pd.read_sql_query(sensors_data_query, connection)
-    
-    # Add extra columns and fill in
-    emptyColumn = [None for i in range(len(active_rads_w_temps_DF.index))]
-    
-    active_rads_w_temps_DF["flowSensorName"] = emptyColumn
-    active_rads_w_temps_DF["returnSensorName"] = emptyColumn
-    active_rads_w_temps_DF["flowTemp"] = emptyColumn
-    active_rads_w_temps_DF["returnTemp"] = emptyColumn
-    active_rads_w_temps_DF["timestamp"] = emptyColumn
-
-    # Should probably merge data frames and then go from there
-    # Some object orientation would probs make things a lot neater
-
-    for index, row in active_rads_w_temps_DF.iterrows():
-        grouping = row["grouping_id"]
-        
-        associatedSensors_DF = sensors_DF.loc[sensors_DF["grouping_id"] == grouping]
-        
-        fillFlowOrReturnData(active_rads_w_temps_DF, associatedSensors_DF, temperatures_DF, 1, "flowSensorName", "flowTemp", row["groupingPrettyName"], index)
-        fillFlowOrReturnData(active_rads_w_temps_DF, associatedSensors_DF, temperatures_DF, 0, "returnSensorName", "returnTemp", row["groupingPrettyName"], index)
-
+    active_rads_w_temps_DF, issues_DF = RadiatorSummary.loadRadiatorSummaries_DF(connection, temperatures_DF)
+    printDataQualityIssues(issues_DF)
     return active_rads_w_temps_DF
 
 def printHeader():
@@ -151,7 +127,7 @@ def printHeader():
     print("--------------------------------------------------------------------------------------------------")
 
 def getValueOrBlank(value):
-    if value == None:
+    if value is None or pd.isna(value):
         return " --  "
     else:
         try:
@@ -161,45 +137,31 @@ def getValueOrBlank(value):
         except ValueError:
             return " --  "
 
+def getNameOrBlank(name):
+    if name is None or pd.isna(name):
+        return "--"
+    return name
+
 def printRow(row):
     line1 = '{:50.50}'.format(row["groupingPrettyName"])
     line1 += "     |             |             |             |"
     print(line1)
     
     line2 = "   Flow sensor   -> "
-    line2 += '{:30.30}'.format(row["flowSensorName"])
+    line2 += '{:30.30}'.format(getNameOrBlank(row["flowSensorName"]))
     line2 += "     |    " + getValueOrBlank(row["flowTemp"]) + "    |    " + getValueOrBlank(row["returnTemp"]) + "    |    " + getValueOrBlank(row["difference"]) + "    |"
     print(line2)
 
     line3 = "   Return sensor -> "
-    line3 += '{:30.30}'.format(row["returnSensorName"])
+    line3 += '{:30.30}'.format(getNameOrBlank(row["returnSensorName"]))
     line3 += "     |             |             |             |"
     print(line3)
     
     print("--------------------------------------------------------------------------------------------------")
 
-def calculateDifferences(active_rads_w_temps_DF):
-    active_rads_w_temps_and_diff_DF = active_rads_w_temps_DF.copy(deep=True)
-    
-    emptyColumn = [None for i in range(len(active_rads_w_temps_and_diff_DF.index))]
-    active_rads_w_temps_and_diff_DF["difference"] = emptyColumn
-
-    for index, row in active_rads_w_temps_DF.iterrows():
-        flowTemp = row["flowTemp"]
-        returnTemp = row["returnTemp"]
-        if(flowTemp == None):
-            print("Error, flow temp is missing for " + row["groupingPrettyName"])
-        elif(returnTemp == None):
-            print("Error, return temp is missing for " + row["groupingPrettyName"])
-        else:
-            active_rads_w_temps_and_diff_DF.at[index, "difference"] = flowTemp - returnTemp
-        
-    return active_rads_w_temps_and_diff_DF
-
 def printRadiatorSummary(connection, temperatures_DF):
-    active_rads_w_temps_DF = getRadiatorSummary_DF(connection, temperatures_DF)
-    
-    active_rads_w_temps_and_diff_DF = calculateDifferences(active_rads_w_temps_DF)
+    # The difference is already calculated as part of the summary
+    active_rads_w_temps_and_diff_DF = getRadiatorSummary_DF(connection, temperatures_DF)
     
     print()
     
@@ -230,47 +192,71 @@ def printRadiatorSummary(connection, temperatures_DF):
         printRow(row)
 
 def getLatestTimestamp(connection):
-    sortedUniqueSyncTimestamps = sorted(DBAccess.getUniqueSyncTimestamps(connection))
+    latestSyncTimestamps = DBAccess.getLatestSyncTimestamps(connection, 2)
     
-    if len(sortedUniqueSyncTimestamps) == 0:
+    if len(latestSyncTimestamps) == 0:
         print("Error, no timestamps present. Have you logged any data yet?")
         sys.exit(2)
-    elif len(sortedUniqueSyncTimestamps) == 1:
-        print("Only one timestamp found, printing " + str(sortedUniqueSyncTimestamps[-1]))
-        return sortedUniqueSyncTimestamps[-1]
+    elif len(latestSyncTimestamps) == 1:
+        print("Only one timestamp found, printing " + str(latestSyncTimestamps[0]))
+        return latestSyncTimestamps[0]
     else:
-        # print("Returning penultimate timestamp " + str(sortedUniqueSyncTimestamps[-2])) # Debug print
+        # print("Returning penultimate timestamp " + str(latestSyncTimestamps[1])) # Debug print
         # Note, we should usually return the punultimate timestamp incase the last one is being edited
-        return sortedUniqueSyncTimestamps[-2]
+        return latestSyncTimestamps[1]
+
+def getLiveTemperatures_DF(connection):
+    # Straight from the latest_readings table, no need to look through the history
+    latest_DF = DBAccess.getLatestReadings_DF(connection)
+    
+    if len(latest_DF.index) == 0:
+        print("Error, no readings present. Have you logged any data yet?")
+        sys.exit(2)
+    
+    oldestReadings_DF = latest_DF.loc[latest_DF["syncTimestamp"] < latest_DF["syncTimestamp"].max()]
+    for index, row in oldestReadings_DF.iterrows():
+        print(f"Note, latest reading for sensor {row['sensorID']} is {row['age_sec']:.0f} seconds old")
+    
+    # Show them all as one summary
+    latest_DF["syncTimestamp"] = latest_DF["syncTimestamp"].max()
+    return latest_DF
 
 def printLatestRadiatorSummary(connection):
-    temperatures_DF = DBAccess.getTemperatureDataFrameForTimestamp(connection, getLatestTimestamp(connection))
+    if useLiveReadings:
+        temperatures_DF = getLiveTemperatures_DF(connection)
+    else:
+        temperatures_DF = DBAccess.getTemperatureDataFrameForTimestamp(connection, getLatestTimestamp(connection))
     printRadiatorSummary(connection, temperatures_DF)
 
 def printDataIndex(connection, dataIndex):
-    sortedUniqueSyncTimestamps = sorted(DBAccess.getUniqueSyncTimestamps(connection))
+    timestamp = DBAccess.getNthLatestSyncTimestamp(connection, dataIndex)
     
-    if dataIndex > len(sortedUniqueSyncTimestamps):
-        print(f"dataIndex {dataIndex} greater than length of timestamps {len(sortedUniqueSyncTimestamps)}")
+    if timestamp is None:
+        print(f"dataIndex {dataIndex} greater than length of timestamps {DBAccess.getSyncTimestampCount(connection)}")
         sys.exit(2)
     
-    timestamp = sortedUniqueSyncTimestamps[-dataIndex]
     printRadiatorSummary(connection, DBAccess.getTemperatureDataFrameForTimestamp(connection, timestamp))
     
 def enterFollowModeLoop(connection):
     timestamp = getLatestTimestamp(connection)
     
+    # Sleeps until the logger says a new cycle has been committed
+    cycleSubscriber = CycleNotifier.CycleSubscriber(connection, notifySocketPath)
+    
     while(True):
-        if not timestamp == getLatestTimestamp(connection):
+        cycleSubscriber.waitForNextCycle()
+        if useLiveReadings or not timestamp == getLatestTimestamp(connection):
             for i in range(62): print()
             timestamp = getLatestTimestamp(connection)
             printLatestRadiatorSummary(connection)
-        time.sleep(2)
 
 if __name__ == "__main__":
     
     databasePath = config["DatabaseSettings"].get("databasePath")
+    notifySocketPath = config["DatabaseSettings"].get("notifySocketPath", CycleNotifier.getDefaultSocketPath(databasePath))
     dbConnection = DBAccess.create_connection(databasePath)
+    # Older databases need the tables these queries use
+    CreateDBTables.upgradeDatabase(dbConnection)
     
     for i in range(62): print()
     
@@ -279,7 +265,7 @@ if __name__ == "__main__":
         sys.exit(0)
         
     if(dataTimestamp != 0):
-        printRadiatorSummary(DBAccess.getTemperatureDataFrameForTimestamp(dbConnection, dataTimestamp))
+        printRadiatorSummary(dbConnection, DBAccess.getTemperatureDataFrameForTimestamp(dbConnection, dataTimestamp))
         sys.exit(0)
     
     printLatestRadiatorSummary(dbConnection)
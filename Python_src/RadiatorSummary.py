@@ -0,0 +1,80 @@
+#! /usr/bin/env python3
+
+import numpy as np
+import pandas as pd
+
+# Builds radiator (grouping) summaries: flow and return sensor names, temperatures and their difference.
+# Everything is done with joins and a pivot so it works the same for one timestamp or thousands of them
+
+active_groupings_query = "SELECT * FROM groupings WHERE isGroupingActiveBool != 0"
+active_sensors_query = "SELECT * FROM sensors WHERE isSensorActiveBool != 0"
+
+flowAndReturn = {1: "flow", 0: "return"}
+
+def getDataQualityIssues_DF(issues):
+    return pd.DataFrame(issues, columns=["grouping_id", "groupingPrettyName", "syncTimestamp", "flow1_return0", "issue"])
+
+# Returns the grouping/role pairs that have exactly one sensor, and data quality issues for the rest
+def getFlowAndReturnSensors(groupings_DF, sensors_DF):
+    roles_DF = pd.merge(groupings_DF[["grouping_id", "groupingPrettyName"]], pd.DataFrame({"flow1_return0": list(flowAndReturn)}), how="cross")
+
+    sensorCounts = sensors_DF.groupby(["grouping_id", "flow1_return0"]).size().rename("nSensors").reset_index()
+    roles_DF = pd.merge(roles_DF, sensorCounts, on=["grouping_id", "flow1_return0"], how="left")
+    roles_DF["nSensors"] = roles_DF["nSensors"].fillna(0).astype(int)
+
+    badRoles_DF = roles_DF.loc[roles_DF["nSensors"] != 1].copy()
+    # np.where rather than .map, which gives int64 on an empty frame and can't be added to the str column
+    badRoles_DF["issue"] = badRoles_DF["flow1_return0"].map(flowAndReturn) + np.where(badRoles_DF["nSensors"] == 0, " sensor not found", " sensor found more than once")
+    badRoles_DF["syncTimestamp"] = None
+
+    goodRoles_DF = roles_DF.loc[roles_DF["nSensors"] == 1, ["grouping_id", "flow1_return0"]]
+    roleSensors_DF = pd.merge(goodRoles_DF, sensors_DF[["grouping_id", "flow1_return0", "sensorID", "sensorPrettyName"]], on=["grouping_id", "flow1_return0"])
+
+    return roleSensors_DF, badRoles_DF[getDataQualityIssues_DF([]).columns]
+
+# groupings_DF and sensors_DF are rows from the groupings and sensors tables, usually just the active ones.
+# temperatures_DF holds temperature_data rows for any number of syncTimestamps.
+# Returns a summary data frame with one row per grouping per syncTimestamp and a data frame of data quality issues
+def getRadiatorSummaries_DF(groupings_DF, sensors_DF, temperatures_DF):
+    roleSensors_DF, sensorIssues_DF = getFlowAndReturnSensors(groupings_DF, sensors_DF)
+
+    temperatures_DF = temperatures_DF[["syncTimestamp", "sensorID", "tempDegC"]]
+    duplicated = temperatures_DF.duplicated(["syncTimestamp", "sensorID"], keep="first")
+    readings_DF = pd.merge(temperatures_DF.loc[~duplicated], roleSensors_DF, on="sensorID")
+    duplicateReadings_DF = pd.merge(temperatures_DF.loc[duplicated].drop_duplicates(["syncTimestamp", "sensorID"]), roleSensors_DF, on="sensorID")
+
+    # One row per grouping per syncTimestamp, with the flow and return values side by side
+    temperaturesPivot_DF = readings_DF.pivot(index=["syncTimestamp", "grouping_id"], columns="flow1_return0", values="tempDegC")
+    temperaturesPivot_DF = temperaturesPivot_DF.reindex(columns=[1, 0]).rename(columns={1: "flowTemp", 0: "returnTemp"}).reset_index()
+    temperaturesPivot_DF.columns.name = None
+
+    namesPivot_DF = roleSensors_DF.pivot(index="grouping_id", columns="flow1_return0", values="sensorPrettyName")
+    namesPivot_DF = namesPivot_DF.reindex(columns=[1, 0]).rename(columns={1: "flowSensorName", 0: "returnSensorName"}).reset_index()
+    namesPivot_DF.columns.name = None
+
+    syncTimestamps_DF = pd.DataFrame({"syncTimestamp": temperatures_DF["syncTimestamp"].drop_duplicates().sort_values()})
+    summary_DF = pd.merge(groupings_DF, syncTimestamps_DF, how="cross")
+    summary_DF = pd.merge(summary_DF, namesPivot_DF, on="grouping_id", how="left")
+    summary_DF = pd.merge(summary_DF, temperaturesPivot_DF, on=["syncTimestamp", "grouping_id"], how="left")
+    summary_DF["difference"] = summary_DF["flowTemp"] - summary_DF["returnTemp"]
+    summary_DF["timestamp"] = summary_DF["syncTimestamp"]
+
+    # Sensors that are set up properly but didn't report
+    expectedReadings_DF = pd.merge(roleSensors_DF, syncTimestamps_DF, how="cross")
+    missingReadings_DF = pd.merge(expectedReadings_DF, readings_DF[["syncTimestamp", "sensorID"]], on=["syncTimestamp", "sensorID"], how="left", indicator=True)
+    missingReadings_DF = missingReadings_DF.loc[missingReadings_DF["_merge"] == "left_only"]
+
+    readingIssues_DF = pd.concat([
+        missingReadings_DF.assign(issue=missingReadings_DF["flow1_return0"].map(flowAndReturn) + " temperature not found"),
+        duplicateReadings_DF.assign(issue=duplicateReadings_DF["flow1_return0"].map(flowAndReturn) + " temperature found more than once")
+    ])
+    readingIssues_DF = pd.merge(readingIssues_DF, groupings_DF[["grouping_id", "groupingPrettyName"]], on="grouping_id")
+
+    issues_DF = pd.concat([sensorIssues_DF, readingIssues_DF[sensorIssues_DF.columns]], ignore_index=True)
+
+    return summary_DF, issues_DF
+
+def loadRadiatorSummaries_DF(connection, temperatures_DF):
+    groupings_DF = pd.read_sql_query(active_groupings_query, connection)
+    sensors_DF = pd.read_sql_query(active_sensors_query, connection)
+    return getRadiatorSummaries_DF(groupings_DF, sensors_DF, temperatures_DF)
@@ -1,14 +1,21 @@
 #! /usr/bin/env python3
 
 
-import requests
 import json
 from datetime import datetime
 import configparser
-import time
+import logging
 import DBAccess
-from requests.exceptions import ConnectionError
-from requests.exceptions import ReadTimeout
+import CreateDBTables
+from sqlite3 import Error
+from DevicePoller import DevicePoller
+from CycleScheduler import CycleScheduler
+from IngestWriter import IngestWriter
+from SensorRegistry import SensorRegistry
+from SensorStatistics import SensorStatistics
+import CycleNotifier
+import LoggerMetrics
+import DatabaseMaintenance
 # import pdb
 
 # Settings
@@ -18,28 +25,62 @@ config.read("Radiator_temp_logger.cnf")
 databasePath = config["DatabaseSettings"].get("databasePath")
 ipAddresses = json.loads(config["DeviceSettings"].get("ipAddresses"))
 querySensorsTime_sec = config["DEFAULT"].getfloat("querySensorsTime_sec")
+journalMode = config["DatabaseSettings"].get("journalMode", "WAL")
+synchronous = config["DatabaseSettings"].get("synchronous", "NORMAL")
+busyTimeout_sec = config["DatabaseSettings"].getfloat("busyTimeout_sec", 60)
+# The polling loop's own writes (device status, statistics) are given up on rather than hold up the next cycle
+pollingBusyTimeout_sec = config["DatabaseSettings"].getfloat("pollingBusyTimeout_sec", 1)
+deviceTimeout_sec = config["DeviceSettings"].getfloat("deviceTimeout_sec", 5)
+cycleDeadline_sec = config["DeviceSettings"].getfloat("cycleDeadline_sec", 30)
+maxPollWorkers = config["DeviceSettings"].getint("maxPollWorkers", 16)
+deviceIntervals_sec = json.loads(config["DeviceSettings"].get("deviceIntervals_sec", "{}"))
+maxBackoff_sec = config["DeviceSettings"].getfloat("maxBackoff_sec", 900)
+latestSnapshotPath = config["DatabaseSettings"].get("latestSnapshotPath", "")
+notifySocketPath = config["DatabaseSettings"].get("notifySocketPath", CycleNotifier.getDefaultSocketPath(databasePath))
+spoolPath = config["DatabaseSettings"].get("spoolPath", "") or databasePath + ".spool"
+maxQueuedCycles = config["DatabaseSettings"].getint("maxQueuedCycles", 1000)
+
+# Older config files won't have this section
+metricsSettings = config["MetricsSettings"] if config.has_section("MetricsSettings") else config["DEFAULT"]
+metricsPort = metricsSettings.getint("metricsPort", 0)
+metricsHost = metricsSettings.get("metricsHost", "127.0.0.1")
+metricsFilePath = metricsSettings.get("metricsFilePath", "")
+metricsFileMaxBytes = metricsSettings.getint("metricsFileMaxBytes", 10000000)
+useLogging = metricsSettings.getboolean("useLogging", False)
+logLevel = metricsSettings.get("logLevel", "INFO")
+
+alertSettings = config["AlertSettings"] if config.has_section("AlertSettings") else config["DEFAULT"]
+ewmaAlpha = alertSettings.getfloat("ewmaAlpha", 0.1)
+stuckAfter_sec = alertSettings.getfloat("stuckAfter_sec", 21600)
+stuckToleranceDegC = alertSettings.getfloat("stuckToleranceDegC", 0.1)
+missingAfter_sec = alertSettings.getfloat("missingAfter_sec", 600)
+offlineAfterFailures = alertSettings.getint("offlineAfterFailures", 3)
+minDeltaDegC = alertSettings.get("minDeltaDegC", "-2")
+maxDeltaDegC = alertSettings.get("maxDeltaDegC", "30")
+# Left empty to turn that limit off
+minDeltaDegC = float(minDeltaDegC) if minDeltaDegC != "" else None
+maxDeltaDegC = float(maxDeltaDegC) if maxDeltaDegC != "" else None
+alertHookCommand = alertSettings.get("alertHookCommand", "")
+
+maintenanceSettings = config["MaintenanceSettings"] if config.has_section("MaintenanceSettings") else config["DEFAULT"]
+
+logger = logging.getLogger("ReadDataIntoDB")
+
+# Prints as before, or with useLogging, goes to the log at the given level
+def report(message, level=logging.INFO):
+    if useLogging:
+        logger.log(level, message)
+    else:
+        print(message)
 
-def addUngrouptedGroupingIfNotPresent(connection):
-    query = f"INSERT OR IGNORE INTO groupings (grouping_id, groupingPrettyName, isGroupingActiveBool) values (0, 'DefaultGroup', 0)" # Note, we're putting this into grouping 0 -> ungrouped
-    print("Query to call = " + query)
-    DBAccess.execute_query(connection, query)
-    
-def addSensorIfNotPresent(connection, sensorID):
-    query = f"INSERT OR IGNORE INTO sensors (sensorID, sensorPrettyName, sensorShortName, isSensorActiveBool, grouping_id, flow1_return0, calibrationCorrection) values ('{sensorID}', 'NULL', '0', 1, 0, -1, 0)" # Note, we're putting this into grouping 0 -> ungrouped
-    print("Query to call = " + query)
-    DBAccess.execute_query(connection, query)
-
-def addDataPoint(connection, syncTimestamp, timestamp, sensorID, tempDegC):
-    query = f"INSERT INTO temperature_data (syncTimestamp, timestamp, sensorID, tempDegC) values ({syncTimestamp}, {timestamp}, '{sensorID}', {tempDegC})"
-    print("Query to call = " + query)
-    DBAccess.execute_query(connection, query)
-    
-# Note used yet but may be handy in case where we don't have sync timestamp 
-# def addDataPoint(connection, timestamp, sensorID, tempDegC):
-#    syncTimestamp = int(timestamp)
-#    addDataPoint(connection, syncTimestamp, timestamp, sensorID, tempDegC)
-    
 def printData(response):
+    if useLogging:
+        # Nothing is formatted unless debug logging is on
+        if logger.isEnabledFor(logging.DEBUG):
+            for entry in response:
+                logger.debug("sensorID %s TempDegC %s", entry["SensorID"], entry["TempDegC"])
+        return
+    
     print("")
     for entry in response:
         print("sensorID is ")
@@ -48,55 +89,212 @@ def printData(response):
         print(entry["TempDegC"])
         print("")
 
-def processResponse(response, connection, syncTimestamp):
+def getReadingsFromResponse(response, syncTimestamp, timestamp, ipAddress=None):
+    # DevicePoller has already dropped anything that isn't a sensor reading
+    readings = []
+    for aSensorResponse in response:
+        readings.append({
+            "syncTimestamp": syncTimestamp,
+            "timestamp": timestamp,
+            "sensorID": aSensorResponse["SensorID"],
+            "tempDegC": aSensorResponse["TempDegC"],
+            "ipAddress": ipAddress
+        })
+    return readings
+
+# Returns the write statistics from DBAccess.insertReadings, or None if the readings couldn't be stored
+def storeReadings(connection, readings):
+    # New sensors are added to the default grouping as part of the same transaction
+    try:
+        stats = DBAccess.insertReadings(connection, readings)
+    except Error as e:
+        report(f"The error '{e}' occurred, {len(readings)} readings were not stored", logging.ERROR)
+        return None
+    report(f"Stored {stats['nRows']} readings at {stats['rowsPerSec']:.0f} rows/s, commit took {stats['commitTime_sec'] * 1000:.1f} ms", logging.DEBUG)
+    return stats
+
+def processResponse(response, connection, syncTimestamp, timestamp=None):
     printData(response)
     
-    now = datetime.now()
-    timestamp = datetime.timestamp(now)
+    if timestamp is None:
+        now = datetime.now()
+        timestamp = datetime.timestamp(now)
     
-    # Todo :- Error checking to see if everything as expected with result
-    for aSensorResponse in response:
-        sensorID = aSensorResponse["SensorID"]
-        tempDegC = aSensorResponse["TempDegC"]
-        # Flag some message to say we're adding new sensor 
-        # OR if sensor isn't present, flag error thus 
-        # relying on all sensors being configured in database separately before this function
-        addUngrouptedGroupingIfNotPresent(connection)
-        addSensorIfNotPresent(connection, sensorID)
-        addDataPoint(connection, syncTimestamp, timestamp, sensorID, tempDegC)
-
-# Remember to add sensors if they're not there
-def gatherTempsAndUpdate(connection):
-    now = datetime.now()
-    syncTimestamp = int(datetime.timestamp(now))
+    storeReadings(connection, getReadingsFromResponse(response, syncTimestamp, timestamp))
+
+# With a scheduler, the cycle's syncTimestamp and the devices to poll come from it, otherwise it's now and all of them.
+# With an ingestWriter, the readings are handed to it to store in the background, otherwise they're stored here
+# With sensorStatistics, the cycle's readings also update the running statistics and alerts
+def gatherTempsAndUpdate(connection, devicePoller, cyclePublisher=None, metrics=None, scheduler=None, ingestWriter=None, sensorStatistics=None):
+    if scheduler is None:
+        now = datetime.now()
+        syncTimestamp = int(datetime.timestamp(now))
+        dueIPAddresses = ipAddresses
+    else:
+        syncTimestamp = scheduler.syncTimestamp
+        dueIPAddresses = scheduler.getDueDevices()
+    if metrics is not None:
+        metrics.startCycle(syncTimestamp, None if scheduler is None else syncTimestamp)
     
-    # Think about doing these in threads for synchronicity
-    # This would help if one IP address is offline.
-    # Make sure threads die properly if a node is offline, possibly be careful not to start new thread if we're awaiting one to finish
-    for ipAddress in ipAddresses:
-        print()
-        print("Processing IP Address: " + ipAddress)
-        try:
-            r = requests.get("http://" + ipAddress, timeout=5)
-        except ConnectionError as e:
-            print("Failed to connect to IP address : " + ipAddress)
-            print (e)
-            continue
-        except ReadTimeout as e:
-            print("Read timeout IP address : " + ipAddress)
-            print (e)
+    # All devices are polled at once so an offline node only costs one timeout per cycle
+    pollResults = devicePoller.pollDevices(dueIPAddresses)
+    
+    # The whole cycle is written in one transaction
+    readings = []
+    for pollResult in pollResults:
+        if metrics is not None:
+            metrics.recordPoll(pollResult)
+        report("", logging.DEBUG)
+        report("Processing IP Address: " + pollResult.ipAddress, logging.DEBUG)
+        if pollResult.error is not None:
+            report(pollResult.error, logging.WARNING)
             continue
-        response = json.loads(r.text)
         
-        processResponse(response, connection, syncTimestamp)
-
-# Create connection
-connection = DBAccess.create_connection(databasePath)
-
-while(True):
-    print()
-    print("Gathering data from sensors and adding to database")
-    gatherTempsAndUpdate(connection)
-    print()
-    print("Sleeping for " + str(querySensorsTime_sec) + " seconds")
-    time.sleep(querySensorsTime_sec)
+        printData(pollResult.response)
+        readings += getReadingsFromResponse(pollResult.response, syncTimestamp, pollResult.timestamp, pollResult.ipAddress)
+    
+    stats = None
+    if ingestWriter is not None:
+        if len(readings) > 0 and not ingestWriter.submit(readings):
+            report(f"Write queue full, {len(readings)} readings spooled to {spoolPath}", logging.WARNING)
+    elif len(readings) > 0:
+        stats = storeReadings(connection, readings)
+    
+    statuses = []
+    if scheduler is not None:
+        statuses = scheduler.recordPollResults(pollResults)
+        recordDeviceStatuses(connection, statuses)
+    
+    if sensorStatistics is not None:
+        updateStatistics(connection, sensorStatistics, syncTimestamp, readings, statuses, metrics)
+    
+    if metrics is not None:
+        cycle = metrics.endCycle(len(readings), stats, ingestWriter is not None)
+        if ingestWriter is not None:
+            metrics.recordWriteBacklog(ingestWriter.getQueuedCycles(), ingestWriter.getSpoolSize())
+        if useLogging:
+            nDevicesRead = sum(1 for pollResult in pollResults if pollResult.error is None)
+            logger.info("Cycle %d : %d readings from %d of %d devices in %.2f seconds", syncTimestamp, cycle["nRows"], nDevicesRead, len(pollResults), cycle["cycleDuration_sec"])
+    
+    if stats is not None:
+        afterReadingsStored(connection, readings, cyclePublisher)
+
+def afterReadingsStored(connection, readings, cyclePublisher=None):
+    if latestSnapshotPath != "":
+        writeLatestSnapshot(connection)
+    
+    if cyclePublisher is not None:
+        # Let any viewers know there's a new cycle to show
+        cyclePublisher.publish(CycleNotifier.getCycleForSyncTimestamp(connection, max(reading["syncTimestamp"] for reading in readings)))
+
+# Called from the IngestWriter's thread, with its connection
+def onReadingsCommitted(connection, readings, stats, metrics, cyclePublisher):
+    report(f"Stored {stats['nRows']} readings at {stats['rowsPerSec']:.0f} rows/s, commit took {stats['commitTime_sec'] * 1000:.1f} ms", logging.DEBUG)
+    metrics.recordWrite(stats)
+    afterReadingsStored(connection, readings, cyclePublisher)
+
+def onReadingsSpooled(error, readings, metrics):
+    report(f"The error '{error}' occurred, {len(readings)} readings were spooled to {spoolPath} to be stored later", logging.ERROR)
+    metrics.recordWriteFailure(len(readings))
+
+def onNewSensors(newSensors, metrics):
+    for newSensor in newSensors:
+        report(f"New sensor {newSensor['sensorID']} found on {newSensor['ipAddress']} reading {newSensor['tempDegC']} degC, added to the default grouping", logging.WARNING)
+    metrics.recordNewSensors(len(newSensors))
+
+def recordDeviceStatuses(connection, statuses):
+    try:
+        DBAccess.upsertDeviceStatuses(connection, statuses)
+    except Error as e:
+        report(f"The error '{e}' occurred, device status not recorded this cycle", logging.WARNING)
+
+def updateStatistics(connection, sensorStatistics, syncTimestamp, readings, statuses, metrics=None):
+    try:
+        raised, cleared = sensorStatistics.update(connection, syncTimestamp, readings, statuses)
+    except Error as e:
+        report(f"The error '{e}' occurred updating sensor statistics", logging.ERROR)
+        return
+    for alert in raised:
+        report(f"Alert : {alert['message']}", logging.WARNING)
+    for alert in cleared:
+        report(f"Cleared {alert['alertType']} alert for {alert['subject']}")
+    if metrics is not None:
+        metrics.recordAlerts(raised, len(sensorStatistics.getOpenAlerts()))
+
+def getSensorStatistics():
+    return SensorStatistics(ewmaAlpha, stuckAfter_sec, stuckToleranceDegC, missingAfter_sec, offlineAfterFailures, minDeltaDegC, maxDeltaDegC, alertHookCommand)
+
+# Maintenance gets a connection of its own, and never waits for the write lock for longer than its time budget
+def getMaintenanceConnection():
+    maintenanceConnection = DBAccess.create_connection(databasePath)
+    DBAccess.configureConnection(maintenanceConnection, journalMode, synchronous, pollingBusyTimeout_sec)
+    return maintenanceConnection
+
+# Between cycles, so each run only has to fit in the time before the next one
+def runMaintenance(connection, databaseMaintenance):
+    try:
+        summary = databaseMaintenance.runIfDue(connection)
+    except (Error, OSError) as e:
+        report(f"The error '{e}' occurred during database maintenance", logging.ERROR)
+        return
+    if summary is not None:
+        report(DatabaseMaintenance.getSummaryText(summary))
+
+def recordMissedCycles(connection, missedCycles):
+    firstSyncTimestamp, lastSyncTimestamp, nMissed = missedCycles
+    report(f"Running late, missed {nMissed} cycles from {firstSyncTimestamp} to {lastSyncTimestamp}", logging.WARNING)
+    try:
+        DBAccess.recordMissedCycles(connection, firstSyncTimestamp, lastSyncTimestamp, nMissed)
+    except Error as e:
+        report(f"The error '{e}' occurred recording missed cycles", logging.ERROR)
+
+def writeLatestSnapshot(connection):
+    try:
+        DBAccess.writeLatestReadingsSnapshot(connection, latestSnapshotPath)
+    except OSError as e:
+        report(f"Couldn't write latest readings to {latestSnapshotPath} : {e}", logging.ERROR)
+
+if __name__ == "__main__":
+    if useLogging:
+        logging.basicConfig(level=getattr(logging, logLevel.upper(), logging.INFO), format="%(asctime)s %(levelname)s %(message)s")
+    
+    # Create connection
+    connection = DBAccess.create_connection(databasePath)
+    DBAccess.configureConnection(connection, journalMode, synchronous, busyTimeout_sec)
+    CreateDBTables.upgradeDatabase(connection)
+    DBAccess.setBusyTimeout(connection, pollingBusyTimeout_sec)
+    devicePoller = DevicePoller(deviceTimeout_sec, cycleDeadline_sec, maxPollWorkers)
+    cyclePublisher = CycleNotifier.CyclePublisher(notifySocketPath)
+    metrics = LoggerMetrics.LoggerMetrics(metricsFilePath, metricsFileMaxBytes)
+    if metricsPort != 0:
+        LoggerMetrics.MetricsServer(metrics, metricsHost, metricsPort)
+    
+    scheduler = CycleScheduler(querySensorsTime_sec, ipAddresses, deviceIntervals_sec, maxBackoff_sec)
+    scheduler.restoreDeviceStatus(DBAccess.getDeviceStatuses(connection))
+    # Anything left in the spool by a previous run is stored first
+    ingestWriter = IngestWriter(databasePath, spoolPath, journalMode, synchronous, busyTimeout_sec, maxQueuedCycles,
+                                onCommitted=lambda writerConnection, readings, stats: onReadingsCommitted(writerConnection, readings, stats, metrics, cyclePublisher),
+                                onFailed=lambda error, readings: onReadingsSpooled(error, readings, metrics),
+                                sensorRegistry=SensorRegistry(onNewSensors=lambda newSensors: onNewSensors(newSensors, metrics)))
+    sensorStatistics = getSensorStatistics()
+    databaseMaintenance = DatabaseMaintenance.getDatabaseMaintenance(maintenanceSettings)
+    maintenanceConnection = getMaintenanceConnection()
+    
+    try:
+        while(True):
+            report("", logging.DEBUG)
+            report("Waiting for the next cycle", logging.DEBUG)
+            syncTimestamp, missedCycles = scheduler.waitForNextCycle()
+            if missedCycles is not None:
+                recordMissedCycles(connection, missedCycles)
+            metrics.recordSchedule(0 if missedCycles is None else missedCycles[2], len(scheduler.getBackedOffDevices()))
+            
+            report("", logging.DEBUG)
+            report("Gathering data from sensors and adding to database", logging.DEBUG)
+            gatherTempsAndUpdate(connection, devicePoller, cyclePublisher, metrics, scheduler, ingestWriter, sensorStatistics)
+            runMaintenance(maintenanceConnection, databaseMaintenance)
+    except KeyboardInterrupt:
+        report("Stopping, storing any readings still waiting to be written")
+        ingestWriter.close()
+        devicePoller.close()
+        cyclePublisher.close()
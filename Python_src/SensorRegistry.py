@@ -0,0 +1,74 @@
+#! /usr/bin/env python3
+
+import pandas as pd
+import DBAccess
+
+# Keeps the sensors and groupings tables in memory for the logger, so a cycle only writes to the sensors table
+# when a sensor it hasn't seen before turns up.
+# The tables are read once and then again only when they've been changed by something else, e.g. sensors being
+# named or grouped in a DB browser. PRAGMA data_version tells us another connection has committed something and
+# metadata_version, which triggers bump on any change to sensors or groupings, tells us whether it was metadata
+
+class SensorRegistry:
+    # onNewSensors(newSensors) is called after new sensors have been committed, with a list of dicts holding
+    # sensorID, ipAddress and the first syncTimestamp and tempDegC seen for each
+    def __init__(self, onNewSensors=None):
+        self.onNewSensors = onNewSensors
+        self.sensors = {} # sensorID -> row of the sensors table as a dict
+        self.groupings = {} # grouping_id -> row of the groupings table as a dict
+        self.dataVersion = None
+        self.metadataVersion = None
+        self.nLoads = 0
+
+    def getMetadataVersion(self, connection):
+        return connection.execute("SELECT version FROM metadata_version WHERE id = 1").fetchone()[0]
+
+    def load(self, connection):
+        sensors_DF = pd.read_sql_query("SELECT * FROM sensors", connection)
+        groupings_DF = pd.read_sql_query("SELECT * FROM groupings", connection)
+        self.sensors = {sensor["sensorID"]: sensor for sensor in sensors_DF.to_dict("records")}
+        self.groupings = {grouping["grouping_id"]: grouping for grouping in groupings_DF.to_dict("records")}
+        self.metadataVersion = self.getMetadataVersion(connection)
+        self.nLoads += 1
+
+    # Cheap enough to call every cycle, the tables are only read again if they've changed
+    def refresh(self, connection):
+        dataVersion = connection.execute("PRAGMA data_version").fetchone()[0]
+        if self.metadataVersion is None or (dataVersion != self.dataVersion and self.getMetadataVersion(connection) != self.metadataVersion):
+            self.load(connection)
+        self.dataVersion = dataVersion
+
+    def isKnownSensor(self, sensorID):
+        return sensorID in self.sensors
+
+    def getSensor(self, sensorID):
+        return self.sensors.get(sensorID)
+
+    def getGrouping(self, groupingID):
+        return self.groupings.get(groupingID)
+
+    # First reading of each sensor that isn't in the sensors table yet
+    def getNewSensors(self, readings):
+        newSensors = {}
+        for reading in readings:
+            if reading["sensorID"] not in self.sensors and reading["sensorID"] not in newSensors:
+                newSensors[reading["sensorID"]] = {
+                    "sensorID": reading["sensorID"],
+                    "ipAddress": reading.get("ipAddress"),
+                    "syncTimestamp": reading["syncTimestamp"],
+                    "tempDegC": reading["tempDegC"]
+                }
+        return list(newSensors.values())
+
+    # Same as DBAccess.insertReadings, but only adds the sensors that are new
+    def insertReadings(self, connection, readings, completesCycle=True):
+        self.refresh(connection)
+        newSensors = self.getNewSensors(readings)
+        stats = DBAccess.insertReadings(connection, readings, completesCycle, [newSensor["sensorID"] for newSensor in newSensors])
+
+        if len(newSensors) > 0:
+            # Pick up the rows as inserted, defaults and all, and the metadata_version our own inserts have bumped
+            self.load(connection)
+            if self.onNewSensors is not None:
+                self.onNewSensors(newSensors)
+        return stats
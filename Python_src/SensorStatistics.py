@@ -0,0 +1,230 @@
+#! /usr/bin/env python3
+
+import json
+import logging
+import subprocess
+import threading
+from sqlite3 import Error
+import DBAccess
+from SensorRegistry import SensorRegistry
+
+# Keeps running statistics for each sensor and grouping as readings come in, and raises alerts from them, so
+# spotting a cold radiator or a dead sensor never needs a query over the readings.
+# Each reading updates its sensor's exponentially weighted mean and variance (weight ewmaAlpha on the newest
+# reading), its rate of change and how long it has stayed within stuckToleranceDegC of the same value, all in
+# constant time. Each grouping's flow minus return delta is averaged the same way. The statistics are saved to
+# the sensor_statistics and grouping_statistics tables every cycle, and read back from them when the logger starts.
+# Alerts are raised once and cleared once, as rows in the alerts table, and optionally passed to alertHookCommand
+# as one line of JSON on its standard input, e.g.
+#   {"event": "raised", "alertType": "stuck", "subject": "28-0316...", "raisedSyncTimestamp": 1608765463, ...}
+
+logger = logging.getLogger("SensorStatistics")
+
+class SensorStatistics:
+    # Set stuckAfter_sec or missingAfter_sec to 0, offlineAfterFailures to 0, or minDeltaDegC or maxDeltaDegC
+    # to None to turn that alert off
+    def __init__(self, ewmaAlpha=0.1, stuckAfter_sec=21600, stuckToleranceDegC=0.1, missingAfter_sec=600,
+                 offlineAfterFailures=3, minDeltaDegC=-2, maxDeltaDegC=30, alertHookCommand=""):
+        self.ewmaAlpha = ewmaAlpha
+        self.stuckAfter_sec = stuckAfter_sec
+        self.stuckToleranceDegC = stuckToleranceDegC
+        self.missingAfter_sec = missingAfter_sec
+        self.offlineAfterFailures = offlineAfterFailures
+        self.minDeltaDegC = minDeltaDegC
+        self.maxDeltaDegC = maxDeltaDegC
+        self.alertHookCommand = alertHookCommand
+        self.sensorRegistry = SensorRegistry()
+        self.sensors = {} # sensorID -> row of sensor_statistics as a dict
+        self.groupings = {} # grouping_id -> row of grouping_statistics as a dict
+        self.devices = {} # ipAddress -> latest device status
+        self.openAlerts = {} # (alertType, subject) -> row of alerts as a dict
+        self.isLoaded = False
+        # Changes not saved yet because the database was locked, saved with the next cycle's
+        self.unsavedSensors = {}
+        self.unsavedGroupings = {}
+        self.unsavedRaised = []
+        self.unsavedCleared = []
+
+    def load(self, connection):
+        self.sensors = {row["sensorID"]: row for row in DBAccess.getSensorStatistics(connection)}
+        self.groupings = {row["grouping_id"]: row for row in DBAccess.getGroupingStatistics(connection)}
+        self.devices = {row["ipAddress"]: row for row in DBAccess.getDeviceStatuses(connection)}
+        self.openAlerts = {(row["alertType"], row["subject"]): row for row in DBAccess.getOpenAlerts(connection)}
+        self.isLoaded = True
+
+    def updateSensor(self, reading):
+        sensor = self.sensors.get(reading["sensorID"])
+        tempDegC = reading["tempDegC"]
+        syncTimestamp = reading["syncTimestamp"]
+        if sensor is None:
+            sensor = self.sensors[reading["sensorID"]] = {
+                "sensorID": reading["sensorID"],
+                "nReadings": 0,
+                "lastSyncTimestamp": syncTimestamp,
+                "lastTempDegC": tempDegC,
+                "ewmaTempDegC": tempDegC,
+                "ewmVarTempDegC": 0.0,
+                "rateDegCPerMin": 0.0,
+                "unchangedSinceSyncTimestamp": syncTimestamp,
+                "unchangedTempDegC": tempDegC,
+                "ipAddress": reading.get("ipAddress")
+            }
+        elif syncTimestamp <= sensor["lastSyncTimestamp"]:
+            # Late or repeated, e.g. a cycle one poller was slow with
+            return None
+        else:
+            difference = tempDegC - sensor["ewmaTempDegC"]
+            increment = self.ewmaAlpha * difference
+            sensor["ewmaTempDegC"] += increment
+            sensor["ewmVarTempDegC"] = (1 - self.ewmaAlpha) * (sensor["ewmVarTempDegC"] + difference * increment)
+            rate = (tempDegC - sensor["lastTempDegC"]) * 60 / (syncTimestamp - sensor["lastSyncTimestamp"])
+            sensor["rateDegCPerMin"] += self.ewmaAlpha * (rate - sensor["rateDegCPerMin"])
+            sensor["lastSyncTimestamp"] = syncTimestamp
+            sensor["lastTempDegC"] = tempDegC
+            if reading.get("ipAddress") is not None:
+                sensor["ipAddress"] = reading["ipAddress"]
+        if abs(tempDegC - sensor["unchangedTempDegC"]) > self.stuckToleranceDegC:
+            sensor["unchangedSinceSyncTimestamp"] = syncTimestamp
+            sensor["unchangedTempDegC"] = tempDegC
+        sensor["nReadings"] += 1
+        return sensor
+
+    def updateGrouping(self, groupingID, syncTimestamp, deltaDegC):
+        grouping = self.groupings.get(groupingID)
+        if grouping is None:
+            grouping = self.groupings[groupingID] = {
+                "grouping_id": groupingID,
+                "nCycles": 0,
+                "lastSyncTimestamp": syncTimestamp,
+                "deltaDegC": deltaDegC,
+                "ewmaDeltaDegC": deltaDegC
+            }
+        elif syncTimestamp <= grouping["lastSyncTimestamp"]:
+            return None
+        else:
+            grouping["lastSyncTimestamp"] = syncTimestamp
+            grouping["deltaDegC"] = deltaDegC
+            grouping["ewmaDeltaDegC"] += self.ewmaAlpha * (deltaDegC - grouping["ewmaDeltaDegC"])
+        grouping["nCycles"] += 1
+        return grouping
+
+    # Raises or clears the (alertType, subject) alert, adding what changed to raised or cleared
+    def setAlert(self, alertType, subject, isActive, syncTimestamp, value, message, raised, cleared):
+        key = (alertType, str(subject))
+        if isActive and key not in self.openAlerts:
+            alert = {
+                "alert_id": None,
+                "alertType": alertType,
+                "subject": str(subject),
+                "raisedSyncTimestamp": syncTimestamp,
+                "clearedSyncTimestamp": None,
+                "value": value,
+                "message": message
+            }
+            self.openAlerts[key] = alert
+            raised.append(alert)
+        elif not isActive and key in self.openAlerts:
+            alert = self.openAlerts.pop(key)
+            alert["clearedSyncTimestamp"] = syncTimestamp
+            cleared.append(alert)
+
+    def isDeviceOffline(self, ipAddress):
+        return ("offline", ipAddress) in self.openAlerts
+
+    # One cycle's readings, and the statuses of the devices polled in it. Saves the statistics and any alerts
+    # raised or cleared, and returns the alerts as two lists, raised and cleared
+    def update(self, connection, syncTimestamp, readings, statuses):
+        if not self.isLoaded:
+            self.load(connection)
+        self.sensorRegistry.refresh(connection)
+        raised = []
+        cleared = []
+
+        for status in statuses:
+            self.devices[status["ipAddress"]] = status
+        for ipAddress, status in self.devices.items():
+            isOffline = self.offlineAfterFailures > 0 and status["consecutiveFailures"] >= self.offlineAfterFailures
+            self.setAlert("offline", ipAddress, isOffline, syncTimestamp, status["consecutiveFailures"],
+                          f"{ipAddress} hasn't answered the last {status['consecutiveFailures']} polls", raised, cleared)
+
+        updatedSensors = []
+        pipeTemps = {} # (grouping_id, flow1_return0) -> temperatures this cycle
+        for reading in readings:
+            # A failed read, the sensor counts as missing until it gives a temperature again
+            if reading["tempDegC"] is None:
+                continue
+            sensor = self.updateSensor(reading)
+            if sensor is None:
+                continue
+            updatedSensors.append(sensor)
+            sensorInfo = self.sensorRegistry.getSensor(reading["sensorID"])
+            if sensorInfo is not None and sensorInfo["flow1_return0"] in (0, 1):
+                pipeTemps.setdefault((sensorInfo["grouping_id"], sensorInfo["flow1_return0"]), []).append(reading["tempDegC"])
+
+        updatedGroupings = []
+        for (groupingID, flow1_return0), flowTemps in pipeTemps.items():
+            returnTemps = pipeTemps.get((groupingID, 0))
+            groupingInfo = self.sensorRegistry.getGrouping(groupingID)
+            if flow1_return0 != 1 or returnTemps is None or groupingInfo is None or not groupingInfo["isGroupingActiveBool"]:
+                continue
+            grouping = self.updateGrouping(groupingID, syncTimestamp, sum(flowTemps) / len(flowTemps) - sum(returnTemps) / len(returnTemps))
+            if grouping is None:
+                continue
+            updatedGroupings.append(grouping)
+            deltaDegC = grouping["ewmaDeltaDegC"]
+            isOutOfRange = (self.minDeltaDegC is not None and deltaDegC < self.minDeltaDegC) or (self.maxDeltaDegC is not None and deltaDegC > self.maxDeltaDegC)
+            self.setAlert("delta", groupingID, isOutOfRange, syncTimestamp, deltaDegC,
+                          f"{groupingInfo['groupingPrettyName']} flow minus return is {deltaDegC:.1f} degC, expected {self.minDeltaDegC} to {self.maxDeltaDegC}", raised, cleared)
+
+        for sensorID, sensor in self.sensors.items():
+            sensorInfo = self.sensorRegistry.getSensor(sensorID)
+            isActive = sensorInfo is None or bool(sensorInfo["isSensorActiveBool"])
+            unchanged_sec = sensor["lastSyncTimestamp"] - sensor["unchangedSinceSyncTimestamp"]
+            self.setAlert("stuck", sensorID, isActive and self.stuckAfter_sec > 0 and unchanged_sec >= self.stuckAfter_sec, syncTimestamp, sensor["lastTempDegC"],
+                          f"{sensorID} has read {sensor['unchangedTempDegC']} degC for {unchanged_sec / 3600:.1f} hours", raised, cleared)
+            # Not as well as the device it's on being offline
+            missing_sec = syncTimestamp - sensor["lastSyncTimestamp"]
+            isMissing = isActive and self.missingAfter_sec > 0 and missing_sec >= self.missingAfter_sec and not self.isDeviceOffline(sensor["ipAddress"])
+            self.setAlert("missing", sensorID, isMissing, syncTimestamp, missing_sec,
+                          f"{sensorID} on {sensor['ipAddress']} hasn't been read for {missing_sec} seconds", raised, cleared)
+
+        self.save(connection, updatedSensors, updatedGroupings, raised, cleared)
+        for alert in raised:
+            self.runAlertHook("raised", alert)
+        for alert in cleared:
+            self.runAlertHook("cleared", alert)
+        return raised, cleared
+
+    def save(self, connection, updatedSensors, updatedGroupings, raised, cleared):
+        self.unsavedSensors.update((sensor["sensorID"], sensor) for sensor in updatedSensors)
+        self.unsavedGroupings.update((grouping["grouping_id"], grouping) for grouping in updatedGroupings)
+        self.unsavedRaised += raised
+        self.unsavedCleared += cleared
+        try:
+            DBAccess.saveStatistics(connection, list(self.unsavedSensors.values()), list(self.unsavedGroupings.values()), self.unsavedRaised, self.unsavedCleared)
+        except Error as e:
+            # The inserts were rolled back, so the alerts get new alert_ids next time
+            for alert in self.unsavedRaised:
+                alert["alert_id"] = None
+            logger.warning("The error '%s' occurred, statistics will be saved with the next cycle", e)
+            return
+        self.unsavedSensors = {}
+        self.unsavedGroupings = {}
+        self.unsavedRaised = []
+        self.unsavedCleared = []
+
+    def getOpenAlerts(self):
+        return list(self.openAlerts.values())
+
+    # From a thread of its own, a slow hook mustn't hold up the cycle
+    def runAlertHook(self, event, alert):
+        if self.alertHookCommand == "":
+            return
+        alertJSON = json.dumps(dict(alert, event=event)) + "\n"
+        threading.Thread(target=runCommand, args=(self.alertHookCommand, alertJSON), daemon=True).start()
+
+def runCommand(command, input, timeout_sec=60):
+    try:
+        subprocess.run(command, shell=True, input=input, text=True, timeout=timeout_sec)
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.error("Alert hook %s failed : %s", command, e)
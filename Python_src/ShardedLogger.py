@@ -0,0 +1,334 @@
+#! /usr/bin/env python3
+
+import sys
+import getopt
+import configparser
+import logging
+import multiprocessing
+import queue
+import signal
+import time
+from sqlite3 import Error
+import pandas as pd
+import DBAccess
+import CreateDBTables
+import CycleNotifier
+import LoggerMetrics
+import DatabaseMaintenance
+import ReadDataIntoDB
+from ReadDataIntoDB import report
+from DevicePoller import DevicePoller
+from CycleScheduler import CycleScheduler
+from IngestWriter import IngestWriter
+from SensorRegistry import SensorRegistry
+
+# Runs the logger as several processes for installs with more devices than one ReadDataIntoDB can keep up with.
+# The ipAddresses are split between nPollerWorkers poller processes, each polling its share on the usual cycle
+# boundaries. They send their readings over a queue to a single writer process, the only one writing to the
+# database, which puts each cycle's readings from all the pollers together and commits them through an IngestWriter.
+# The main process only supervises: a poller that dies is restarted, and one that keeps dying is retired and its
+# devices shared out between the others. SIGTERM or Ctrl+C stops the pollers, then the writer once it has
+# stored (or spooled) everything it was sent.
+# All other settings are the same as for ReadDataIntoDB.py
+
+# Settings
+config = configparser.ConfigParser()
+config.read("Radiator_temp_logger.cnf")
+
+nPollerWorkers = config["DeviceSettings"].getint("nPollerWorkers", 4)
+
+# A poller that has to be restarted more than maxRestarts times in restartWindow_sec is retired
+maxRestarts = 5
+restartWindow_sec = 600
+restartDelay_sec = 5
+
+# How long the writer waits for the rest of a cycle after the first poller's readings for it arrive
+cycleGatherTime_sec = ReadDataIntoDB.cycleDeadline_sec + 5
+
+def getHelpText():
+    helpText = "\r\n"
+    helpText += "ShardedLogger.py logs the devices in Radiator_temp_logger.cnf using several poller processes and one writer process\r\n"
+    helpText += "\r\n"
+    helpText += "Options:-\r\n"
+    helpText += "\r\n"
+    helpText += "   -n  :   --workers <n>           :   Number of poller processes (default nPollerWorkers in the config, or 4)\r\n"
+
+    return helpText
+
+# Deals the devices out like cards, so a range of similar addresses doesn't all end up in one shard
+def getShards(ipAddresses, nShards):
+    nShards = max(1, min(nShards, len(ipAddresses)))
+    return [ipAddresses[shardIndex::nShards] for shardIndex in range(nShards)]
+
+def setUpChildProcess():
+    # Ctrl+C, and SIGTERM from a service manager, can go to the whole process group. Only the supervisor acts
+    # on them, so everything stops in the right order
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if ReadDataIntoDB.useLogging:
+        logging.basicConfig(level=getattr(logging, ReadDataIntoDB.logLevel.upper(), logging.INFO), format="%(asctime)s %(processName)s %(levelname)s %(message)s")
+
+def isSupervisorAlive():
+    return multiprocessing.parent_process() is None or multiprocessing.parent_process().is_alive()
+
+def runPoller(shardIndex, ipAddresses, messageQueue, stopEvent):
+    setUpChildProcess()
+
+    scheduler = CycleScheduler(ReadDataIntoDB.querySensorsTime_sec, ipAddresses, ReadDataIntoDB.deviceIntervals_sec, ReadDataIntoDB.maxBackoff_sec)
+    # Reading is fine, only the writer writes
+    connection = DBAccess.create_connection(ReadDataIntoDB.databasePath)
+    try:
+        scheduler.restoreDeviceStatus(DBAccess.getDeviceStatuses(connection))
+    except (Error, pd.errors.DatabaseError) as e:
+        report(f"The error '{e}' occurred reading device status, starting afresh", logging.WARNING)
+    connection.close()
+
+    devicePoller = DevicePoller(ReadDataIntoDB.deviceTimeout_sec, ReadDataIntoDB.cycleDeadline_sec, ReadDataIntoDB.maxPollWorkers)
+    try:
+        while not stopEvent.is_set() and isSupervisorAlive():
+            syncTimestamp, missedCycles = scheduler.waitForNextCycle(stopEvent)
+            if syncTimestamp is None:
+                break
+
+            pollResults = devicePoller.pollDevices(scheduler.getDueDevices())
+            readings = []
+            for pollResult in pollResults:
+                if pollResult.error is not None:
+                    report(pollResult.error, logging.WARNING)
+                    continue
+                readings += ReadDataIntoDB.getReadingsFromResponse(pollResult.response, syncTimestamp, pollResult.timestamp, pollResult.ipAddress)
+
+            # Sent every cycle, even with nothing in it, so the writer knows this shard is done
+            messageQueue.put({
+                "shardIndex": shardIndex,
+                "syncTimestamp": syncTimestamp,
+                "readings": readings,
+                "statuses": scheduler.recordPollResults(pollResults),
+                "missedCycles": missedCycles
+            })
+    finally:
+        devicePoller.close()
+
+# A cycle's readings as they come in from the pollers
+class PendingCycle:
+    def __init__(self, syncTimestamp):
+        self.syncTimestamp = syncTimestamp
+        self.readings = []
+        self.statuses = []
+        self.shardIndices = set()
+        self.firstArrivalTime = time.monotonic()
+
+def runWriter(messageQueue, nShards):
+    # Carries on until the supervisor says everything has been sent
+    setUpChildProcess()
+
+    # Readings go through the IngestWriter, this connection's writes mustn't hold up the pollers' messages
+    connection = DBAccess.create_connection(ReadDataIntoDB.databasePath)
+    DBAccess.configureConnection(connection, ReadDataIntoDB.journalMode, ReadDataIntoDB.synchronous, ReadDataIntoDB.pollingBusyTimeout_sec)
+    cyclePublisher = CycleNotifier.CyclePublisher(ReadDataIntoDB.notifySocketPath)
+    metrics = LoggerMetrics.LoggerMetrics(ReadDataIntoDB.metricsFilePath, ReadDataIntoDB.metricsFileMaxBytes)
+    metricsServer = None
+    if ReadDataIntoDB.metricsPort != 0:
+        metricsServer = LoggerMetrics.MetricsServer(metrics, ReadDataIntoDB.metricsHost, ReadDataIntoDB.metricsPort)
+    ingestWriter = IngestWriter(ReadDataIntoDB.databasePath, ReadDataIntoDB.spoolPath, ReadDataIntoDB.journalMode, ReadDataIntoDB.synchronous,
+                                ReadDataIntoDB.busyTimeout_sec, ReadDataIntoDB.maxQueuedCycles,
+                                onCommitted=lambda writerConnection, readings, stats: ReadDataIntoDB.onReadingsCommitted(writerConnection, readings, stats, metrics, cyclePublisher),
+                                onFailed=lambda error, readings: ReadDataIntoDB.onReadingsSpooled(error, readings, metrics),
+                                sensorRegistry=SensorRegistry(onNewSensors=lambda newSensors: ReadDataIntoDB.onNewSensors(newSensors, metrics)))
+
+    sensorStatistics = ReadDataIntoDB.getSensorStatistics()
+    databaseMaintenance = DatabaseMaintenance.getDatabaseMaintenance(ReadDataIntoDB.maintenanceSettings)
+    maintenanceConnection = ReadDataIntoDB.getMaintenanceConnection()
+    pendingCycles = {}
+
+    def submitCycle(pendingCycle):
+        del pendingCycles[pendingCycle.syncTimestamp]
+        if len(pendingCycle.shardIndices) < nShards:
+            report(f"Cycle {pendingCycle.syncTimestamp} only heard from {len(pendingCycle.shardIndices)} of {nShards} pollers", logging.WARNING)
+        report(f"Cycle {pendingCycle.syncTimestamp} : {len(pendingCycle.readings)} readings from {len(pendingCycle.statuses)} devices")
+        if len(pendingCycle.readings) > 0 and not ingestWriter.submit(pendingCycle.readings):
+            report(f"Write queue full, {len(pendingCycle.readings)} readings spooled to {ReadDataIntoDB.spoolPath}", logging.WARNING)
+        ReadDataIntoDB.recordDeviceStatuses(connection, pendingCycle.statuses)
+        ReadDataIntoDB.updateStatistics(connection, sensorStatistics, pendingCycle.syncTimestamp, pendingCycle.readings, pendingCycle.statuses, metrics)
+        metrics.recordWriteBacklog(ingestWriter.getQueuedCycles(), ingestWriter.getSpoolSize())
+        if not isStopping:
+            ReadDataIntoDB.runMaintenance(maintenanceConnection, databaseMaintenance)
+
+    isStopping = False
+    while not isStopping:
+        try:
+            message = messageQueue.get(timeout=1)
+        except queue.Empty:
+            message = {}
+            if not isSupervisorAlive():
+                report("Supervisor has gone, stopping", logging.ERROR)
+                message = None
+
+        if message is None:
+            isStopping = True
+        elif "nShards" in message:
+            # The devices have been shared out again
+            nShards = message["nShards"]
+        elif "syncTimestamp" in message:
+            pendingCycle = pendingCycles.setdefault(message["syncTimestamp"], PendingCycle(message["syncTimestamp"]))
+            pendingCycle.readings += message["readings"]
+            pendingCycle.statuses += message["statuses"]
+            pendingCycle.shardIndices.add(message["shardIndex"])
+            if message["missedCycles"] is not None:
+                ReadDataIntoDB.recordMissedCycles(connection, message["missedCycles"])
+
+        # Oldest first, each once every poller has reported or it's waited long enough
+        for syncTimestamp in sorted(pendingCycles):
+            pendingCycle = pendingCycles[syncTimestamp]
+            if isStopping or len(pendingCycle.shardIndices) >= nShards or time.monotonic() - pendingCycle.firstArrivalTime > cycleGatherTime_sec:
+                submitCycle(pendingCycle)
+
+    report("Writer stopping, storing any readings still waiting to be written")
+    ingestWriter.close()
+    cyclePublisher.close()
+    if metricsServer is not None:
+        metricsServer.close()
+    maintenanceConnection.close()
+    connection.close()
+
+class PollerProcess:
+    def __init__(self, shardIndex, ipAddresses, messageQueue):
+        self.shardIndex = shardIndex
+        self.ipAddresses = ipAddresses
+        self.messageQueue = messageQueue
+        self.process = None
+        self.stopEvent = None
+        self.restartTimes = []
+        self.nextStartTime = 0
+
+    def start(self):
+        self.stopEvent = multiprocessing.Event()
+        self.process = multiprocessing.Process(target=runPoller, args=(self.shardIndex, self.ipAddresses, self.messageQueue, self.stopEvent), name=f"Poller{self.shardIndex}", daemon=True)
+        self.process.start()
+
+    def isAlive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def stop(self, timeout_sec):
+        if self.process is None:
+            return
+        self.stopEvent.set()
+        self.process.join(timeout_sec)
+        if self.process.is_alive():
+            # It ignores SIGTERM, see setUpChildProcess
+            report(f"Poller {self.shardIndex} didn't stop, killing it", logging.WARNING)
+            self.process.kill()
+            self.process.join(timeout_sec)
+            if self.process.is_alive():
+                report(f"Poller {self.shardIndex} is still running after being killed, carrying on without it", logging.ERROR)
+
+class ShardSupervisor:
+    def __init__(self, ipAddresses, nWorkers):
+        self.ipAddresses = ipAddresses
+        self.nWorkers = nWorkers
+        self.messageQueue = multiprocessing.Queue()
+        self.isStopping = False
+        self.writer = None
+        self.pollers = []
+
+    def startWriter(self):
+        self.writer = multiprocessing.Process(target=runWriter, args=(self.messageQueue, len(self.pollers)), name="Writer")
+        self.writer.start()
+
+    def startPollers(self, nShards):
+        self.pollers = [PollerProcess(shardIndex, shard, self.messageQueue) for shardIndex, shard in enumerate(getShards(self.ipAddresses, nShards))]
+        for poller in self.pollers:
+            poller.start()
+        report(f"Started {len(self.pollers)} pollers for {len(self.ipAddresses)} devices")
+
+    def stopPollers(self):
+        # A poller can be in the middle of a cycle, give it time to finish
+        for poller in self.pollers:
+            poller.stopEvent.set()
+        for poller in self.pollers:
+            poller.stop(ReadDataIntoDB.cycleDeadline_sec + 5)
+
+    # Shares out all the devices between one fewer pollers
+    def retirePoller(self, poller):
+        report(f"Poller {poller.shardIndex} has been restarted {len(poller.restartTimes)} times in {restartWindow_sec} seconds, sharing its devices between the other pollers", logging.ERROR)
+        self.stopPollers()
+        self.startPollers(len(self.pollers) - 1)
+        self.messageQueue.put({"nShards": len(self.pollers)})
+
+    def checkPollers(self):
+        now = time.monotonic()
+        for poller in list(self.pollers):
+            if poller.isAlive() or now < poller.nextStartTime:
+                continue
+            if poller.process is not None:
+                report(f"Poller {poller.shardIndex} stopped unexpectedly with exit code {poller.process.exitcode}", logging.ERROR)
+                poller.process = None
+                poller.restartTimes = [restartTime for restartTime in poller.restartTimes if now - restartTime < restartWindow_sec] + [now]
+                if len(poller.restartTimes) > maxRestarts and len(self.pollers) > 1:
+                    self.retirePoller(poller)
+                    return
+                # Don't restart in a tight loop if it dies straight away
+                poller.nextStartTime = now + restartDelay_sec
+                continue
+            report(f"Restarting poller {poller.shardIndex}", logging.WARNING)
+            poller.start()
+
+    def checkWriter(self):
+        if self.writer.is_alive():
+            return
+        report(f"Writer stopped unexpectedly with exit code {self.writer.exitcode}, restarting it", logging.ERROR)
+        # Anything still on the queue is picked up by the new one
+        self.startWriter()
+
+    # Only sets a flag, anything more could deadlock with whatever the signal interrupted
+    def requestStop(self, signalNumber=None, frame=None):
+        self.isStopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.requestStop)
+        signal.signal(signal.SIGINT, self.requestStop)
+
+        self.startPollers(self.nWorkers)
+        self.startWriter()
+        while not self.isStopping:
+            time.sleep(1)
+            if self.isStopping:
+                break
+            self.checkWriter()
+            self.checkPollers()
+
+        report("Stopping pollers")
+        self.stopPollers()
+        report("Stopping writer")
+        self.messageQueue.put(None)
+        self.writer.join()
+        report("Stopped")
+
+if __name__ == "__main__":
+    nWorkers = nPollerWorkers
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:", ["workers="])
+    except getopt.GetoptError:
+        print("ShardedLogger.py options error occured")
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "-h":
+            print(getHelpText())
+            sys.exit()
+        elif opt in ("-n", "--workers"):
+            try:
+                nWorkers = int(arg)
+            except ValueError:
+                print("Please supply a whole number of workers")
+                sys.exit(2)
+
+    if ReadDataIntoDB.useLogging:
+        logging.basicConfig(level=getattr(logging, ReadDataIntoDB.logLevel.upper(), logging.INFO), format="%(asctime)s %(processName)s %(levelname)s %(message)s")
+
+    # Schema upgrades are done once, here, before anything else opens the database
+    connection = DBAccess.create_connection(ReadDataIntoDB.databasePath)
+    DBAccess.configureConnection(connection, ReadDataIntoDB.journalMode, ReadDataIntoDB.synchronous, ReadDataIntoDB.busyTimeout_sec)
+    CreateDBTables.upgradeDatabase(connection)
+    connection.close()
+
+    ShardSupervisor(ReadDataIntoDB.ipAddresses, nWorkers).run()
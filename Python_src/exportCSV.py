@@ -1,16 +1,222 @@
 #! /usr/bin/env python3
 
+import sys
+import os
+import getopt
+import gzip
+import json
 import DBAccess
+import CreateDBTables
 import configparser
-import pandas as pd
 
 config = configparser.ConfigParser()
 config.read("Radiator_temp_logger.cnf")
 
-databasePath = config["DatabaseSettings"].get("databasePath")
-dbConnection = DBAccess.create_connection(databasePath)
+def getHelpText():
+    helpText = "\r\n"
+    helpText += "exportCSV.py exports the data in the database pointed to in Radiator_temp_logger.cnf, by default to export.csv\r\n"
+    helpText += "\r\n"
+    helpText += "Options:-\r\n"
+    helpText += "\r\n"
+    helpText += "   -o  :   --output <file>         :   File to write to. Ending in .gz writes gzipped CSV, ending in .parquet writes Parquet\r\n"
+    helpText += "       :   --start <time>          :   Only export data from unix timestamp <time> onwards\r\n"
+    helpText += "       :   --end <time>            :   Only export data up to unix timestamp <time>\r\n"
+    helpText += "   -s  :   --sensor <sensorID>     :   Only export this sensor, can be given more than once\r\n"
+    helpText += "   -g  :   --grouping <id>         :   Only export sensors in this grouping_id, can be given more than once\r\n"
+    helpText += "       :   --incremental           :   Add the data logged since the last incremental export to the end of the same file\r\n"
+    helpText += "       :   --chunkSize <n>         :   Number of rows to read from the database at a time\r\n"
+    helpText += "       :   --calibrated            :   Export the temperatures corrected by the sensor calibrations, see Calibrate.py\r\n"
 
-allData_DF = DBAccess.getAllData_DF(dbConnection)
+    return helpText
 
-# Export allData_DF as csv
-allData_DF.to_csv ("export.csv", index = False, header=True)
+def getStatePath(outputPath):
+    return outputPath + ".state"
+
+# The data_id of the last row written by the previous incremental export to outputPath, and the size the file
+# was then. fileSize is None if there hasn't been one, or it was written before the size was kept
+def readExportState(outputPath):
+    try:
+        with open(getStatePath(outputPath)) as stateFile:
+            state = json.load(stateFile)
+    except FileNotFoundError:
+        return 0, None
+    return state["lastDataID"], state.get("fileSize")
+
+def writeExportState(outputPath, lastDataID, fileSize):
+    tempPath = getStatePath(outputPath) + ".tmp"
+    with open(tempPath, "w") as stateFile:
+        json.dump({"lastDataID": lastDataID, "fileSize": fileSize}, stateFile)
+    os.replace(tempPath, getStatePath(outputPath))
+
+# Parquet files can't be added to, so each later incremental export writes its rows to a file of its own next to outputPath
+def getIncrementalParquetPath(outputPath, afterDataID):
+    root, extension = os.path.splitext(outputPath)
+    return f"{root}.after{afterDataID}{extension}"
+
+# With isAppending the rows go on the end of the file without another header. A gzip file can be added to
+# the same way, readers treat the pieces as one stream
+class CSVChunkWriter:
+    def __init__(self, path, isAppending=False):
+        mode = "at" if isAppending else "wt"
+        if path.endswith(".gz"):
+            self.file = gzip.open(path, mode, newline="")
+        else:
+            self.file = open(path, mode, newline="")
+        self.isFirstChunk = not isAppending
+
+    def write(self, chunk_DF):
+        chunk_DF.to_csv(self.file, index=False, header=self.isFirstChunk)
+        self.isFirstChunk = False
+
+    def close(self):
+        self.file.close()
+
+# Fixed column types, otherwise a chunk where a column is all NULL wouldn't match the others
+parquetColumnTypes = {
+    "syncTimestamp": "int64",
+    "timestamp": "float64",
+    "sensorID": "string",
+    "tempDegC": "float64",
+    "sensorPrettyName": "string",
+    "sensorShortName": "string",
+    "isSensorActiveBool": "int64",
+    "grouping_id": "int64",
+    "flow1_return0": "int64",
+    "calibrationCorrection": "float64",
+    "groupingPrettyName": "string",
+    "groupingShortName": "string",
+    "isGroupingActiveBool": "int64"
+}
+
+class ParquetChunkWriter:
+    def __init__(self, path):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            print("Parquet export needs pyarrow, install it with pip install pyarrow")
+            raise
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([(columnName, pyarrow.type_for_alias(columnType)) for columnName, columnType in parquetColumnTypes.items()])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, chunk_DF):
+        self.writer.write_table(self.pyarrow.Table.from_pandas(chunk_DF, schema=self.schema, preserve_index=False))
+
+    def close(self):
+        self.writer.close()
+
+def getChunkWriter(path):
+    if path.endswith(".parquet"):
+        return ParquetChunkWriter(path)
+    return CSVChunkWriter(path)
+
+def writeChunks(chunkWriter, connection, sensorIDs, groupingIDs, startTimestamp, endTimestamp, afterDataID, chunkSize, isCalibrated):
+    nRows = 0
+    lastDataID = afterDataID
+    try:
+        while True:
+            chunk_DF = DBAccess.getJoinedData_DF(connection, sensorIDs, groupingIDs, startTimestamp, endTimestamp, afterDataID=lastDataID, limit=chunkSize, isCalibrated=isCalibrated)
+            # Always write the first chunk, even if it's empty, so a new file gets its header
+            if nRows == 0 or len(chunk_DF.index) > 0:
+                chunkWriter.write(chunk_DF)
+            nRows += len(chunk_DF.index)
+            if len(chunk_DF.index) > 0:
+                lastDataID = int(chunk_DF.index.max())
+            if len(chunk_DF.index) < chunkSize:
+                break
+    finally:
+        chunkWriter.close()
+    return nRows, lastDataID
+
+# Streams the data to outputPath a chunk at a time, so memory use doesn't grow with the size of the database.
+# Returns the number of rows written and the data_id of the last one.
+# With appendAtSize (CSV only), the rows are added to the end of outputPath instead, after cutting it back to
+# that size in case an earlier append failed part way
+def exportData(connection, outputPath, sensorIDs=None, groupingIDs=None, startTimestamp=None, endTimestamp=None, afterDataID=0, chunkSize=50000, isCalibrated=False, appendAtSize=None):
+    if appendAtSize is not None:
+        os.truncate(outputPath, appendAtSize)
+        try:
+            return writeChunks(CSVChunkWriter(outputPath, isAppending=True), connection, sensorIDs, groupingIDs, startTimestamp, endTimestamp, afterDataID, chunkSize, isCalibrated)
+        except BaseException:
+            os.truncate(outputPath, appendAtSize)
+            raise
+
+    # Write to a temporary file so a failed export doesn't leave a half written file behind
+    root, extension = os.path.splitext(outputPath)
+    if extension == ".gz":
+        root, innerExtension = os.path.splitext(root)
+        extension = innerExtension + extension
+    tempPath = root + ".tmp" + extension
+
+    try:
+        nRows, lastDataID = writeChunks(getChunkWriter(tempPath), connection, sensorIDs, groupingIDs, startTimestamp, endTimestamp, afterDataID, chunkSize, isCalibrated)
+    except BaseException:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+        raise
+
+    os.replace(tempPath, outputPath)
+    return nRows, lastDataID
+
+if __name__ == "__main__":
+    outputPath = "export.csv"
+    sensorIDs = None
+    groupingIDs = None
+    startTimestamp = None
+    endTimestamp = None
+    isIncremental = False
+    chunkSize = 50000
+    isCalibrated = False
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "ho:s:g:", ["output=", "start=", "end=", "sensor=", "grouping=", "incremental", "chunkSize=", "calibrated"])
+    except getopt.GetoptError:
+        print("exportCSV.py options error occured")
+        sys.exit(2)
+    try:
+        for opt, arg in opts:
+            if opt == "-h":
+                print(getHelpText())
+                sys.exit()
+            elif opt in ("-o", "--output"):
+                outputPath = arg
+            elif opt == "--start":
+                startTimestamp = int(arg)
+            elif opt == "--end":
+                endTimestamp = int(arg)
+            elif opt in ("-s", "--sensor"):
+                sensorIDs = (sensorIDs or []) + [arg]
+            elif opt in ("-g", "--grouping"):
+                groupingIDs = (groupingIDs or []) + [int(arg)]
+            elif opt == "--incremental":
+                isIncremental = True
+            elif opt == "--chunkSize":
+                chunkSize = int(arg)
+            elif opt == "--calibrated":
+                isCalibrated = True
+    except ValueError as e:
+        print(e)
+        print("Please supply whole numbers for timestamps, groupings and chunk size")
+        sys.exit(2)
+
+    databasePath = config["DatabaseSettings"].get("databasePath")
+    dbConnection = DBAccess.create_connection(databasePath)
+    # Older databases need the tables the export reads from, such as calibration_backfill_state
+    CreateDBTables.upgradeDatabase(dbConnection)
+
+    afterDataID = 0
+    appendAtSize = None
+    writePath = outputPath
+    if isIncremental:
+        afterDataID, fileSize = readExportState(outputPath)
+        if afterDataID > 0 and outputPath.endswith(".parquet"):
+            writePath = getIncrementalParquetPath(outputPath, afterDataID)
+        elif afterDataID > 0 and os.path.exists(outputPath):
+            appendAtSize = os.path.getsize(outputPath) if fileSize is None else fileSize
+
+    nRows, lastDataID = exportData(dbConnection, writePath, sensorIDs, groupingIDs, startTimestamp, endTimestamp, afterDataID, chunkSize, isCalibrated, appendAtSize)
+    print(f"Exported {nRows} rows to {writePath}")
+
+    if isIncremental:
+        writeExportState(outputPath, lastDataID, os.path.getsize(outputPath) if os.path.exists(outputPath) else None)
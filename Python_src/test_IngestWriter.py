@@ -0,0 +1,73 @@
+#! /usr/bin/env python3
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import DBAccess
+import CreateDBTables
+from IngestWriter import IngestWriter
+
+# Run with python -m unittest test_IngestWriter from this directory
+
+def getReading(syncTimestamp, sensorID):
+    return {"syncTimestamp": syncTimestamp, "timestamp": syncTimestamp + 0.5, "sensorID": sensorID, "tempDegC": 21.5}
+
+class RejectedBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.databasePath = os.path.join(self.directory, "test.sqlite")
+        self.spoolPath = self.databasePath + ".spool"
+        connection = DBAccess.create_connection(self.databasePath)
+        with contextlib.redirect_stdout(io.StringIO()):
+            CreateDBTables.createDBTables(connection)
+        connection.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def getStoredKeys(self):
+        connection = DBAccess.create_connection(self.databasePath)
+        keys = set(connection.execute("SELECT syncTimestamp, sensorID FROM temperature_data").fetchall())
+        connection.close()
+        return keys
+
+    def getRejectedReadings(self):
+        with open(self.spoolPath + ".rejected") as rejectedFile:
+            return [reading for line in rejectedFile for reading in json.loads(line)["readings"]]
+
+    def startWriter(self):
+        return IngestWriter(self.databasePath, self.spoolPath, retryDelay_sec=0.1)
+
+    def test_badSubmittedBatchDoesNotBlockLaterOnes(self):
+        ingestWriter = self.startWriter()
+        ingestWriter.submit([getReading(1000, None)])
+        ingestWriter.submit([getReading(1060, "28-good")])
+        ingestWriter.close()
+        # Submitted together they may have gone in the same transaction, the good one must still be stored
+        ingestWriter = self.startWriter()
+        ingestWriter.submit([getReading(1120, "28-good")])
+        ingestWriter.close()
+
+        self.assertEqual(self.getStoredKeys(), {(1060, "28-good"), (1120, "28-good")})
+        self.assertEqual(self.getRejectedReadings(), [getReading(1000, None)])
+        self.assertFalse(os.path.exists(self.spoolPath))
+
+    def test_badSpooledBatchIsRejectedAndTrimmed(self):
+        with open(self.spoolPath, "w") as spoolFile:
+            for readings in [[getReading(1000, "28-first")], [getReading(1060, None)], [getReading(1120, "28-last")]]:
+                spoolFile.write(json.dumps({"readings": readings}) + "\n")
+
+        ingestWriter = self.startWriter()
+        ingestWriter.submit([getReading(1180, "28-new")])
+        ingestWriter.close()
+
+        self.assertEqual(self.getStoredKeys(), {(1000, "28-first"), (1120, "28-last"), (1180, "28-new")})
+        self.assertEqual(self.getRejectedReadings(), [getReading(1060, None)])
+        self.assertFalse(os.path.exists(self.spoolPath))
+
+if __name__ == "__main__":
+    unittest.main()